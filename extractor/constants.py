@@ -233,6 +233,11 @@ class ACTION_TYPES(Enum):
     mythic = auto()
     lair = auto()
 
+class VALIDATION_MODES(Enum):
+    full = auto()
+    sampled = auto()
+    off = auto()
+
 class ALIGNMENTS(Enum):
     lawful = auto()
     chaotic = auto()
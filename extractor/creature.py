@@ -1,6 +1,5 @@
 from enum import Enum
 from fractions import Fraction
-from math import floor
 from extractor.annotators import LineAnnotationTypes
 from typing import Any, List
 import configparser
@@ -13,49 +12,26 @@ import re
 
 import extractor.creature_schema as cs
 import extractor.constants as constants
-from utils.datatypes import Line, Section
+import extractor.dice_expression as dice_expression
+import extractor.dice_parser as dice_parser
+from extractor.statblock_lexer import StatblockLexer, TokenStream
+from utils.datatypes import Bound, Line, Section
 
 import traceback
 
 class Creature():
     '''Class for constructing a validated creature schema'''
 
-    def __init__(self, config: configparser.ConfigParser, logger: logging.Logger):
+    def __init__(self, config: configparser.ConfigParser, logger: logging.Logger, lexer: StatblockLexer=None):
         self.data = {}
         self.config = config
         self.logger = logger
 
-        add_damage_types = [
-            "damage",
-            "healing"
-        ]
-
-        ### Complex regexes for dice formula
-        average_regex = '[^d](\d+)[^d]' #Finds 5 but not 1d5
-        formula_regex = '\(?((?:\d+d\d+)(?:\s*(?:\+|-|\s+)\s*(?:\d+d\d+|\d+))*)\)?' #Finds 1d6+3 or (1d2-4)
-        damage_type_regex = f"({'|'.join(enum_values(DAMAGE_TYPES) + add_damage_types)})" #Finds damage types
-        dice_formula_regex = f'(?:{formula_regex}|{average_regex})+\s*{damage_type_regex}?' #Finds at least one of the above
-
-        ### Precompile some regexes
-        self.attack_res = {
-            "type":re.compile("^(melee|ranged|melee\s*or\s*ranged)\s*(spell|weapon)?\s*(?:attack)?:", re.IGNORECASE),
-            "hit":re.compile(":\s*([+-]?\s*\d+)\s*to\s*hit", re.IGNORECASE),
-            "reach":re.compile(f"reach\s*(\d+)\s*({'|'.join(enum_values(MEASURES))})"),
-            "range":re.compile(f"(?:range|reach)\s*(\d+)(?:/(\d+))?\s*({'|'.join(enum_values(MEASURES))})"),
-            "target":re.compile(f",\s*(\d+|one|two|three|four|five|six|seven|eight|nine|ten|all|any)\s*(creature|target|object)s?\s*,?\s*([a-zA-Z,\s']+)?\.\s*[Hh]it"),
-            "hit_damage":re.compile(f".\s*hit:?\s*{dice_formula_regex}", re.IGNORECASE),
-            "versatile_damage":re.compile(f"or\s*{dice_formula_regex}\s*[a-zA-Z\s]*\s*two hands", re.IGNORECASE)
-        }
+        ### Share a lexer with the creature factory so each line is only tokenised once
+        self.lexer = lexer if lexer else StatblockLexer()
 
-        self.general_res = {
-            #"dice_damage":re.compile(f"[^\d]\s+([d\d\s\+-]+)\s+({'|'.join(enum_values(DAMAGE_TYPES) + ['damage'])})", re.IGNORECASE),
-            #"damage":re.compile(f"\s*[^d](\d+)\s+(?:\(([\d\s\+-d]+)\))?\s*({'|'.join(enum_values(DAMAGE_TYPES) + ['damage'])})", re.IGNORECASE),
-            "dice_rolls":re.compile(dice_formula_regex, re.IGNORECASE),
-            "saves":re.compile(f"dc\s*(\d+)\s*\(?\s*({'|'.join(enum_values(ABILITIES) + enum_values(SHORT_ABILITIES) + enum_values(SKILLS))})\s*\(?", re.IGNORECASE),
-            "escape":re.compile(f"escape\s*dc\s*(\d+)", re.IGNORECASE),
-            "conditions":re.compile(f"({'|'.join(enum_values(CONDITIONS))})", re.IGNORECASE),
-            "halves":re.compile('half\s*as\s*much\s*damage', re.IGNORECASE)
-        }
+        ### Per-field validation only runs in 'full' mode, other modes validate the finished creature
+        self.validation = config.get("creature", "validation", fallback=VALIDATION_MODES.full.name)
 
     def is_valid(self):
 
@@ -102,13 +78,17 @@ class Creature():
 
     def __validate_part(self, key: str) -> bool:
         '''Validate a subcomponent of the creature data against the schema'''
+        if self.validation != VALIDATION_MODES.full.name:
+            return True
+        return self.__check_part(key)
+
+    def __check_part(self, key: str) -> bool:
+        '''Run the compiled schema validator for a single key'''
         try:
-            if key in cs.CreatureSchema.schema:
-                schema.Schema(cs.CreatureSchema.schema[key]).validate(self.data[key])
-            elif schema.Optional(key) in cs.CreatureSchema.schema:
-                schema.Schema(cs.CreatureSchema.schema[schema.Optional(key)]).validate(self.data[key])
-            else:
+            validator = cs.part_validator(key)
+            if validator is None:
                 raise schema.SchemaError("{}: Did not find correct key type in schema for key {}".format(self.data["name"], key))
+            validator(self.data[key])
         except schema.SchemaError as e:
             self.logger.error("{}: Failed to validate parsed schema for {}.".format(self.data["name"], key))
             self.logger.error(e.__str__())
@@ -117,6 +97,13 @@ class Creature():
 
         return True
 
+    def validate(self) -> bool:
+        '''Validate the whole creature at once. Used when per-field validation is disabled'''
+        valid = True
+        for key in self.data:
+            valid &= self.__check_part(key)
+        return valid
+
     def _parse_enum_with_pre_post(self, text: str, enum: Enum):
         results = []
         
@@ -429,19 +416,20 @@ class Creature():
     ################################### Features #######################################
     ####################################################################################
 
-    def add_normal_feature(self, title: str, text: str):
+    def add_normal_feature(self, title: str, text: str, stream: TokenStream=None, tokens: List[dice_parser.Token]=None):
+        '''Add a feature. If the token stream for the feature body is not provided, the text is tokenised'''
         if "features" not in self.data:
             self.data["features"] = []
         
         self.logger.debug("Adding feature {}".format(title))
         
+        if stream is None:
+            stream = self.lexer.lex_section(Section([Line("feature", text, Bound(0, 0, 0, 0), -1, [])]))
+            tokens = stream.tokens
+
         ### Start parsing the main feature text
-        # Run a set of regexes over the text to pull out key information
         # General damage and effects
-        properties = {}
-        for r in self.general_res:
-            v = [(match.end(), match.groups()) for match in self.general_res[r].finditer(text.lower(), pos=0)]
-            properties[r] = v if len(v) > 0 else None
+        properties = dice_parser.find_effects(stream.text, tokens)
 
         feature = {
             "title":title,
@@ -683,7 +671,7 @@ class Creature():
 
         
         target_count_map = {
-            "one":1, "two":2, "three":3, "four":4, "five":5,"six":6,"seven":7,"eight":8,"nine":9,"any":"any","all":"all"
+            "one":1, "two":2, "three":3, "four":4, "five":5,"six":6,"seven":7,"eight":8,"nine":9,"ten":10,"any":"any","all":"all"
         }
 
         max_parsed = properties["type"][0] 
@@ -734,7 +722,7 @@ class Creature():
                 
                 #Formula but no number
                 if v[0] and not v[1]:
-                    v[1] = self.__calculate_average_formula(v[1])
+                    v[1] = self.__calculate_average_formula(v[0])
 
                 attack["damage"] = {"damage":{"average":int(v[1]), "formula":v[0]}, "type":v[2].strip() if v[2] else None}
                 max_parsed = max(properties["hit_damage"][0], max_parsed)
@@ -752,7 +740,7 @@ class Creature():
                 
                 #Formula but no number
                 if v[0] and not v[1]:
-                    v[1] = self.__calculate_average_formula(v[1])
+                    v[1] = self.__calculate_average_formula(v[0])
 
                 attack["versatile"] = {"damage":{"average":int(v[1]), "formula":v[0]}, "type":v[2].strip() if v[2] else None}
                 max_parsed = max(properties["versatile_damage"][0], max_parsed)
@@ -764,44 +752,20 @@ class Creature():
         return attack
 
     def __normalise_formula(self, formula: str) -> str:
-        last_was_num = False
-        parts = [f.strip() for f in formula.split() if f.strip()]
-        normed_parts = []
-        for p in parts:
-            if p.replace('d','').isnumeric():
-                if last_was_num:
-                    self.logger.warn(f"Unnormalised formula {formula}, adding '+'")
-                    normed_parts.append("+")
-                normed_parts.append(p.strip())
-                last_was_num = True
-            elif p in ['+','-']:
-                last_was_num = False
-                normed_parts.append(p.strip())
-
-        return " ".join(normed_parts)
+        '''Returns the formula in a standard form (e.g. 2d6 + 3)'''
+        expr = dice_expression.try_compile_formula(formula)
+        if expr is None:
+            self.logger.warn(f"Failed to parse formula {formula}")
+            return formula
+        if expr.implicit_operators:
+            self.logger.warn(f"Unnormalised formula {formula}, adding '+'")
+        return expr.text
 
     @staticmethod
     def __calculate_average_formula(formula: str) -> int:
-        '''
-        Performs a dirty quick calculation to get the average of a maths formula.
-        Does not handle brackets!
-        '''
-        total = 0
-        next_pos = 1
-        for part in formula.split():
-            part = part.strip()
-            if "d" in part:
-                num,size = part.split("d")
-                num = int(num)
-                size = int(size)
-                total += floor(next_pos * num * ((size / 2) + 0.5))
-                next_pos = 1
-            elif part == "-":
-                next_pos = -1
-            else:
-                total += next_pos * int(part)
-                next_pos = 1
-        return total
+        '''Returns the average of a dice formula, rounded down'''
+        expr = dice_expression.try_compile_formula(formula)
+        return expr.average if expr is not None else 0
 
     def __create_effects(self, properties: Any, start_char=0):
         '''Use results of precompiled regexes to turn action text into structred effect data'''
@@ -925,8 +889,8 @@ class Creature():
 
         has_colon = title.find(":")
         if has_colon > 0:
+            text = title[has_colon+1:].strip() + " " + text
             title = title[:has_colon]
-            text = title[has_colon:] + " " + text
         
         self.logger.debug("Adding action {}".format(title))
         
@@ -940,13 +904,12 @@ class Creature():
         if not action_type.name in self.data:
             self.data[action_type.name] = []
 
-        ### Start parsing the main action text
-        # Run a set of regexes over the text to pull out key information
-        # First regexes handle the attack header
+        ### Start parsing the main action text from the lexed token stream
+        # First parsers handle the attack header
+        stream = self.lexer.lex_section(section)
+        _, tokens = stream.split_title()
         properties = {"text": [0,section.get_section_text()]}
-        for r in self.attack_res:
-            v = self.attack_res[r].search(text.lower())
-            properties[r] = [v.end(), v.groups()] if v else None
+        properties.update(dice_parser.parse_attack(stream.text, tokens))
 
         ### Track where the 'attack header' ends so we don't double count damage
         attack_line_end = 0
@@ -956,10 +919,8 @@ class Creature():
                 if v:
                     attack_line_end = max(attack_line_end, v[0])
 
-        # Seconds regexes handle more general damage and effects
-        for r in self.general_res:
-            v = [(match.end(), match.groups()) for match in self.general_res[r].finditer(text.lower(), pos=attack_line_end)]
-            properties[r] = v if len(v) > 0 else None
+        # Second parsers handle more general damage and effects
+        properties.update(dice_parser.find_effects(stream.text, tokens, attack_line_end))
 
         action = {
             "title":title,
@@ -1123,10 +1084,12 @@ class Creature():
 
         has_colon = title.find(":")
         if has_colon > 0:
+            text = title[has_colon+1:].strip() + " " + text
             title = title[:has_colon]
-            text = title[has_colon:] + " " + text
 
         if "spellcasting" in title.lower():
             self.add_spell_feature(section)
         else:
-            self.add_normal_feature(title, text.replace("\n", " ").replace("  ", " "))
\ No newline at end of file
+            stream = self.lexer.lex_section(section)
+            _, tokens = stream.split_title()
+            self.add_normal_feature(title, text.replace("\n", " ").replace("  ", " "), stream, tokens)
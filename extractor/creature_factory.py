@@ -6,6 +6,7 @@ from utils.datatypes import Section, Line
 from extractor import constants
 from extractor.creature import Creature
 from extractor.annotators import LineAnnotationTypes
+from extractor.statblock_lexer import StatblockLexer
 
 from typing import Dict
 
@@ -21,34 +22,37 @@ class CreatureFactory():
         features = 4
         actions = 5
 
+    __ACTION_BLOCK_TITLE = re.compile("({})\s*actions?".format("|".join(constants.enum_values(constants.ACTION_TYPES))), re.IGNORECASE)
+    __SPELL_LIST_START = re.compile("^\s*(at will|rest|daily|cantrip|1st|2nd|3rd|[4-9]th|[1-9]+\s*/\s*(day|long rest|short rest|encounter))", re.IGNORECASE)
+    __SPELLCASTING_ABILITY = re.compile("spellcasting\s*ability\s*is", re.IGNORECASE)
+
     def __init__(self, config: ConfigParser, logger: Logger):
         self.config = config
         self.logger = logger.getChild("parser")
+        self.lexer = StatblockLexer()
+
+        self.validation = config.get("creature", "validation", fallback=constants.VALIDATION_MODES.full.name)
+        self.validation_sample_every = max(1, config.getint("creature", "validation_sample_every", fallback=10))
+        self.num_parsed = 0
 
 
     def __update_feature_block(self, creature: Creature, current_section : Section, line: Line, is_end=False):
         # Get first sentence from text to treat as a potential title
-        parts = line.text.split('.')
-        title = parts[0]
-        has_colon = title.find(":")
-        if has_colon > 0:
-            title = title[:has_colon]
+        lexed = self.lexer.lex_line(line)
 
         ### Conditions for starting a new block
         #Easy case, new block
         new_block = len(current_section.lines) == 0
         #Check first sentence is less than 6 words (not including anything in brackets) and starts with a capital
-        has_title = len(re.sub("\(.+?\)", "", title).split()) < 6  and title[0].isupper()\
-             and title.split()[0].lower() not in constants.enum_values(constants.ABILITIES)\
-             and len(parts) > 1 and parts[1] != ''
+        has_title = lexed.has_title()
 
 
         #Check if we're in a spell list
         spell_list = False
         if len(current_section.lines) > 0 and "spellcasting" in current_section.lines[0].text.lower():
-            if re.search("^\s*(at will|rest|daily|cantrip|1st|2nd|3rd|[4-9]th|[1-9]+\s*/\s*(day|long rest|short rest|encounter))", line.text, re.IGNORECASE) is not None:
+            if CreatureFactory.__SPELL_LIST_START.search(line.text) is not None:
                 spell_list = True
-            if re.search("spellcasting\s*ability\s*is", line.text, re.IGNORECASE) is not None:
+            if CreatureFactory.__SPELLCASTING_ABILITY.search(line.text) is not None:
                 spell_list = True
 
         #Check if we're at the start of a new feature
@@ -66,24 +70,15 @@ class CreatureFactory():
     def __update_action_block(self, creature: Creature, current_section: Section, line: Line, 
                                     action_type: constants.ACTION_TYPES, handled_action_block: Dict[constants.ACTION_TYPES, bool]):
 
-        parts = line.text.split('.')
-        title = parts[0]
-
-        has_colon = title.find(":")
-        if has_colon > 0:
-            title = title[:has_colon]
+        lexed = self.lexer.lex_line(line)
 
-        
-
-        in_brackets = current_section.get_section_text().count("(") > current_section.get_section_text().count(")")
+        in_brackets = current_section.in_brackets()
 
         ### Conditions for starting a new block
         #Easy case, new block
         new_block = len(current_section.lines) == 0 
         #Check first sentence is less than 6 words (not including anything in brackets) and starts with a capital
-        has_title = len(re.sub("\(.+?\)", "", title).split()) < 6  and title[0].isupper()\
-             and title.split()[0].lower() not in constants.enum_values(constants.ABILITIES)\
-             and len(parts) > 1 and parts[1] != ''
+        has_title = lexed.has_title()
 
         is_multiattack = "multiattack" in line.attributes
 
@@ -114,7 +109,7 @@ class CreatureFactory():
                 current_section = Section()
         else:
             if is_table:
-                current_section.lines[-1].text += "\n"
+                current_section.append_to_last_line("\n")
         
         current_section.add_line(line, sort=False)
 
@@ -123,7 +118,8 @@ class CreatureFactory():
 
     def statblock_to_creature(self, statblock: Section) -> Creature:
 
-        cr = Creature(self.config, self.logger)
+        self.lexer.reset()
+        cr = Creature(self.config, self.logger, lexer=self.lexer)
         state = CreatureFactory.ParserState.title
 
         current_section = Section()
@@ -180,8 +176,7 @@ class CreatureFactory():
                 continue
 
             ### Check if line is simply an action block title
-            action_regex = re.compile("({})\s*actions?".format("|".join(constants.enum_values(constants.ACTION_TYPES))), re.IGNORECASE)
-            at = action_regex.match(line.text.strip())
+            at = CreatureFactory.__ACTION_BLOCK_TITLE.match(line.text.strip())
             if line.text[0].isupper() and (at is not None or 'reaction_header' in line.attributes):
 
                 if at is not None:
@@ -300,6 +295,12 @@ class CreatureFactory():
                     if current_action_type == constants.ACTION_TYPES.lair:
                         cr.add_lair_block(current_section)
 
+        ### When per-field validation is skipped, validate a sample of finished creatures once
+        if self.validation == constants.VALIDATION_MODES.sampled.name:
+            if self.num_parsed % self.validation_sample_every == 0:
+                cr.validate()
+            self.num_parsed += 1
+
         if not cr.is_valid():
             return None
 
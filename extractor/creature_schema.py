@@ -1,8 +1,10 @@
 import extractor.constants as constants
 from enum import Enum
+from functools import lru_cache
 import re
 
-from schema import Schema, And, Or, Use, Optional
+from typing import Any, Callable
+from schema import Schema, SchemaError, And, Or, Use, Optional
 
 def enum_str(options: Enum):
     return And(str, Use(str.lower), lambda s: constants.is_in_enum(s.replace(" ", "_"), options))
@@ -287,3 +289,120 @@ CreatureSchema = Schema(
 
     }
 )
+
+
+
+####################################################################################
+############################### Compiled Validators ################################
+####################################################################################
+
+def _compile_dict(s: dict) -> Callable[[Any], Any]:
+    required = set()
+    checkers = {}
+    for k, v in s.items():
+        if isinstance(k, Optional):
+            checkers[k.schema] = compile_schema(v)
+        else:
+            required.add(k)
+            checkers[k] = compile_schema(v)
+
+    def check(data):
+        if not isinstance(data, dict):
+            raise SchemaError(f"{data!r} should be instance of 'dict'")
+        for k, v in data.items():
+            if k not in checkers:
+                raise SchemaError(f"Wrong key {k!r} in {data!r}")
+            try:
+                checkers[k](v)
+            except SchemaError as e:
+                raise SchemaError(f"Key '{k}' error:\n{e}")
+        missing = required.difference(data.keys())
+        if missing:
+            raise SchemaError(f"Missing key{'s' if len(missing) > 1 else ''}: {', '.join(repr(m) for m in sorted(missing))}")
+        return data
+    return check
+
+def _compile_list(s: list) -> Callable[[Any], Any]:
+    options = _compile_or(s)
+
+    def check(data):
+        if not isinstance(data, list):
+            raise SchemaError(f"{data!r} should be instance of 'list'")
+        for d in data:
+            options(d)
+        return data
+    return check
+
+def _compile_or(s: list) -> Callable[[Any], Any]:
+    options = [compile_schema(o) for o in s]
+    if len(options) == 1:
+        return options[0]
+
+    def check(data):
+        for o in options:
+            try:
+                return o(data)
+            except SchemaError:
+                continue
+        raise SchemaError(f"{data!r} did not validate against any of {s!r}")
+    return check
+
+def _compile_and(s: list) -> Callable[[Any], Any]:
+    steps = [compile_schema(a) for a in s]
+
+    def check(data):
+        for step in steps:
+            data = step(data)
+        return data
+    return check
+
+def compile_schema(s: Any) -> Callable[[Any], Any]:
+    '''Turn a schema definition into a plain python checker. The checker raises a SchemaError on failure and 
+    returns the (possibly transformed) data on success'''
+    if isinstance(s, Optional):
+        return compile_schema(s.schema)
+    if isinstance(s, Schema):
+        return compile_schema(s.schema)
+    if isinstance(s, dict):
+        return _compile_dict(s)
+    if isinstance(s, list):
+        return _compile_list(s)
+    # Or is a subclass of And so must be checked first
+    if isinstance(s, Or):
+        return _compile_or(list(s.args))
+    if isinstance(s, And):
+        return _compile_and(s.args)
+    if isinstance(s, Use):
+        return s.validate
+    if isinstance(s, type):
+        def check(data):
+            if not isinstance(data, s):
+                raise SchemaError(f"{data!r} should be instance of {s.__name__!r}")
+            return data
+        return check
+    if callable(s):
+        def check(data):
+            try:
+                ok = s(data)
+            except Exception as e:
+                raise SchemaError(f"{s!r}({data!r}) raised {e!r}")
+            if not ok:
+                raise SchemaError(f"{s!r}({data!r}) should evaluate to True")
+            return data
+        return check
+
+    def check(data):
+        if data != s:
+            raise SchemaError(f"{s!r} does not match {data!r}")
+        return data
+    return check
+
+@lru_cache(maxsize=None)
+def part_validator(key: str) -> Callable[[Any], Any]:
+    '''Returns the compiled validator for a top level creature key, or None if the key is not part of the schema.
+    Validators are compiled once per key and shared between all creatures'''
+    if key in CreatureSchema.schema:
+        return compile_schema(CreatureSchema.schema[key])
+    if Optional(key) in CreatureSchema.schema:
+        return compile_schema(CreatureSchema.schema[Optional(key)])
+    return None
@@ -0,0 +1,265 @@
+import dataclasses
+from functools import cached_property, lru_cache
+from math import floor
+from typing import Dict, List, Optional, Tuple, Union
+
+from extractor.dice_parser import Token, TokenTypes, tokenise
+
+### Dice expressions (e.g. "2d6 + 3", "(1d8 + 2) * 2") are compiled once into a small AST and cached, since a
+### bestiary reuses a few hundred distinct formulas thousands of times. Compiled expressions are immutable so the
+### cached instances can be shared freely.
+
+CACHE_SIZE = 1024
+
+### Words that are read as multiplication, e.g. "2d6 x 2"
+_MULTIPLY_WORDS = set(["x", "times"])
+_MULTIPLY_SYMBOLS = set(["*", "×"])
+
+Distribution = Dict[int, float]
+
+@dataclasses.dataclass(frozen=True)
+class Constant:
+    value: int
+
+    def text(self) -> str:
+        return str(self.value)
+
+    def average(self) -> float:
+        return self.value
+
+    def bounds(self) -> Tuple[int, int]:
+        return self.value, self.value
+
+    def distribution(self) -> Distribution:
+        return {self.value: 1.0}
+
+@dataclasses.dataclass(frozen=True)
+class Dice:
+    count: int
+    size: int
+
+    def text(self) -> str:
+        return f"{self.count}d{self.size}"
+
+    def average(self) -> float:
+        return self.count * (self.size + 1) / 2
+
+    def bounds(self) -> Tuple[int, int]:
+        if self.size == 0:
+            return 0, 0
+        return self.count, self.count * self.size
+
+    def distribution(self) -> Distribution:
+        if self.size == 0:
+            return {0: 1.0}
+        single = {v: 1.0 / self.size for v in range(1, self.size + 1)}
+        dist = {0: 1.0}
+        for i in range(self.count):
+            dist = _combine(dist, single, lambda a, b: a + b)
+        return dist
+
+@dataclasses.dataclass(frozen=True)
+class Negate:
+    operand: "Node"
+
+    def text(self) -> str:
+        return "-" + _bracket(self.operand, Negate)
+
+    def average(self) -> float:
+        return -self.operand.average()
+
+    def bounds(self) -> Tuple[int, int]:
+        low, high = self.operand.bounds()
+        return -high, -low
+
+    def distribution(self) -> Distribution:
+        return {-k: p for k, p in self.operand.distribution().items()}
+
+@dataclasses.dataclass(frozen=True)
+class BinaryOp:
+    op: str
+    left: "Node"
+    right: "Node"
+
+    def text(self) -> str:
+        return f"{_bracket(self.left, self)} {self.op} {_bracket(self.right, self, right=True)}"
+
+    def average(self) -> float:
+        if self.op == "+":
+            return self.left.average() + self.right.average()
+        if self.op == "-":
+            return self.left.average() - self.right.average()
+        # Both sides are independent so the expectation of the product is the product of expectations
+        return self.left.average() * self.right.average()
+
+    def bounds(self) -> Tuple[int, int]:
+        l_low, l_high = self.left.bounds()
+        r_low, r_high = self.right.bounds()
+        if self.op == "+":
+            return l_low + r_low, l_high + r_high
+        if self.op == "-":
+            return l_low - r_high, l_high - r_low
+        products = [l_low * r_low, l_low * r_high, l_high * r_low, l_high * r_high]
+        return min(products), max(products)
+
+    def distribution(self) -> Distribution:
+        if self.op == "+":
+            return _combine(self.left.distribution(), self.right.distribution(), lambda a, b: a + b)
+        if self.op == "-":
+            return _combine(self.left.distribution(), self.right.distribution(), lambda a, b: a - b)
+        return _combine(self.left.distribution(), self.right.distribution(), lambda a, b: a * b)
+
+Node = Union[Constant, Dice, Negate, BinaryOp]
+
+_PRECEDENCE = {"+": 1, "-": 1, "*": 2}
+
+def _precedence(node: Node) -> int:
+    if isinstance(node, BinaryOp):
+        return _PRECEDENCE[node.op]
+    if isinstance(node, Negate):
+        return 3
+    return 4
+
+def _bracket(node: Node, parent: Union[Node, type], right: bool=False) -> str:
+    '''Text for a child node, bracketed only when needed to keep the meaning'''
+    parent_precedence = 3 if parent is Negate else _precedence(parent)
+    child_precedence = _precedence(node)
+    # Subtraction isn't associative, so a right hand side of the same precedence needs brackets
+    if child_precedence < parent_precedence or (right and child_precedence == parent_precedence and parent.op == "-"):
+        return f"({node.text()})"
+    return node.text()
+
+def _combine(a: Distribution, b: Distribution, op) -> Distribution:
+    '''Distribution of op(x, y) for independent x ~ a and y ~ b'''
+    result = {}
+    for ka, pa in a.items():
+        for kb, pb in b.items():
+            k = op(ka, kb)
+            result[k] = result.get(k, 0.0) + pa * pb
+    return result
+
+class DiceExpression(object):
+    '''A compiled dice formula. Use compile_formula rather than creating these directly so they get cached'''
+
+    def __init__(self, root: Node, implicit_operators: bool=False):
+        self.root = root
+        # True if operators had to be inserted between terms (e.g. "1d8 1d4")
+        self.implicit_operators = implicit_operators
+
+    def __repr__(self) -> str:
+        return f"<DiceExpression {self.text}>"
+
+    @cached_property
+    def text(self) -> str:
+        '''Normalised formula text, e.g. "2d6 + 3"'''
+        return self.root.text()
+
+    @cached_property
+    def mean(self) -> float:
+        '''Exact expected value'''
+        return self.root.average()
+
+    @cached_property
+    def average(self) -> int:
+        '''Average as printed in a statblock (expected value rounded down)'''
+        return floor(self.mean)
+
+    @cached_property
+    def minimum(self) -> int:
+        return self.root.bounds()[0]
+
+    @cached_property
+    def maximum(self) -> int:
+        return self.root.bounds()[1]
+
+    @cached_property
+    def distribution(self) -> Distribution:
+        '''Probability of each possible total'''
+        return dict(sorted(self.root.distribution().items()))
+
+class _Parser(object):
+    '''Recursive descent parser over dice_parser tokens.
+        expr   := term (('+' | '-') term)*
+        term   := factor (('*' | 'x') factor)*
+        factor := number | dice | '(' expr ')' | '-' factor
+    Adjacent terms with no operator between them are added together'''
+
+    def __init__(self, tokens: List[Token]):
+        self.tokens = tokens
+        self.i = 0
+        self.implicit_operators = False
+
+    def peek(self) -> Optional[Token]:
+        return self.tokens[self.i] if self.i < len(self.tokens) else None
+
+    def starts_factor(self) -> bool:
+        t = self.peek()
+        return t is not None and t.type in [TokenTypes.number, TokenTypes.dice, TokenTypes.open_bracket]
+
+    def is_multiply(self) -> bool:
+        t = self.peek()
+        if t is None:
+            return False
+        return (t.type == TokenTypes.other and t.text in _MULTIPLY_SYMBOLS) or \
+            (t.type == TokenTypes.word and t.text.lower() in _MULTIPLY_WORDS)
+
+    def parse(self) -> Node:
+        node = self.expr()
+        if self.peek() is not None:
+            raise ValueError(f"Unexpected '{self.peek().text}' in dice formula")
+        return node
+
+    def expr(self) -> Node:
+        node = self.term()
+        while True:
+            t = self.peek()
+            if t is not None and t.type in [TokenTypes.plus, TokenTypes.minus]:
+                self.i += 1
+                node = BinaryOp(t.text, node, self.term())
+            elif self.starts_factor():
+                self.implicit_operators = True
+                node = BinaryOp("+", node, self.term())
+            else:
+                return node
+
+    def term(self) -> Node:
+        node = self.factor()
+        while self.is_multiply():
+            self.i += 1
+            node = BinaryOp("*", node, self.factor())
+        return node
+
+    def factor(self) -> Node:
+        t = self.peek()
+        if t is None:
+            raise ValueError("Dice formula ended unexpectedly")
+        self.i += 1
+        if t.type == TokenTypes.number:
+            return Constant(int(t.text))
+        if t.type == TokenTypes.dice:
+            count, size = t.text.lower().split("d")
+            return Dice(int(count), int(size))
+        if t.type == TokenTypes.minus:
+            return Negate(self.factor())
+        if t.type == TokenTypes.open_bracket:
+            node = self.expr()
+            closing = self.peek()
+            if closing is None or closing.type != TokenTypes.close_bracket:
+                raise ValueError("Unclosed bracket in dice formula")
+            self.i += 1
+            return node
+        raise ValueError(f"Unexpected '{t.text}' in dice formula")
+
+@lru_cache(maxsize=CACHE_SIZE)
+def compile_formula(formula: str) -> DiceExpression:
+    '''Compile a dice formula, raises a ValueError if it can't be parsed. Results are cached'''
+    parser = _Parser(tokenise(formula.strip()))
+    root = parser.parse()
+    return DiceExpression(root, implicit_operators=parser.implicit_operators)
+
+def try_compile_formula(formula: str) -> Optional[DiceExpression]:
+    '''Compile a dice formula, returning None if it can't be parsed'''
+    try:
+        return compile_formula(formula)
+    except ValueError:
+        return None
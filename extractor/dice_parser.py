@@ -0,0 +1,349 @@
+import dataclasses
+from enum import Enum, auto
+from typing import Any, Dict, List, Optional, Tuple
+
+from extractor.constants import DAMAGE_TYPES, MEASURES, enum_values
+
+### The dice parser replaces the nested dice/attack/effect regexes with a hand written tokeniser and a set of
+### small recursive descent parsers. Every parser only moves forwards through the token list so the
+### whole scan is linear in the length of the text, regardless of how malformed the OCR is.
+
+class TokenTypes(Enum):
+    number = auto()
+    dice = auto()
+    word = auto()
+    plus = auto()
+    minus = auto()
+    open_bracket = auto()
+    close_bracket = auto()
+    colon = auto()
+    comma = auto()
+    full_stop = auto()
+    slash = auto()
+    other = auto()
+
+class TokenTags(Enum):
+    damage_type = auto()
+    condition = auto()
+    ability = auto()
+    measure = auto()
+    dc = auto()
+
+@dataclasses.dataclass
+class Token:
+    type: TokenTypes
+    text: str
+    start: int
+    end: int
+    tag: Any = None
+
+_PUNCTUATION = {
+    "+": TokenTypes.plus,
+    "-": TokenTypes.minus,
+    "(": TokenTypes.open_bracket,
+    ")": TokenTypes.close_bracket,
+    ":": TokenTypes.colon,
+    ",": TokenTypes.comma,
+    ".": TokenTypes.full_stop,
+    "/": TokenTypes.slash,
+}
+
+ROLL_TYPES = set(enum_values(DAMAGE_TYPES) + ["damage", "healing"])
+MEASURE_TYPES = set(enum_values(MEASURES))
+TARGET_COUNTS = set(["one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten", "all", "any"])
+TARGET_TYPES = set(["creature", "target", "object"])
+
+def _is_digit(c: str) -> bool:
+    '''ASCII digits only. str.isdigit also accepts OCR artefacts like superscripts (e.g. '5²') that int() can't read'''
+    return '0' <= c <= '9'
+
+def tokenise(text: str, word_tags: Dict[str, Any]=None) -> List[Token]:
+    '''Split text into dice, number, word and punctuation tokens in a single pass. Words found in
+    word_tags are tagged with the mapped value as they are read'''
+    tokens = []
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if c.isspace():
+            i += 1
+        elif _is_digit(c):
+            start = i
+            while i < n and _is_digit(text[i]):
+                i += 1
+            # Dice are only recognised without spaces (e.g. 2d6) to match the written statblock format
+            if i + 1 < n and text[i] in "dD" and _is_digit(text[i+1]):
+                i += 1
+                while i < n and _is_digit(text[i]):
+                    i += 1
+                tokens.append(Token(TokenTypes.dice, text[start:i], start, i))
+            else:
+                tokens.append(Token(TokenTypes.number, text[start:i], start, i))
+        elif c.isalpha():
+            start = i
+            while i < n and (text[i].isalpha() or text[i] == "'"):
+                i += 1
+            word = text[start:i]
+            tokens.append(Token(TokenTypes.word, word, start, i, word_tags.get(word.lower()) if word_tags else None))
+        else:
+            tokens.append(Token(_PUNCTUATION.get(c, TokenTypes.other), c, i, i+1))
+            i += 1
+    return tokens
+
+def _is(tokens: List[Token], i: int, type: TokenTypes, text: Optional[str]=None) -> bool:
+    '''Check the type (and optionally the text) of the token at position i'''
+    if i >= len(tokens) or tokens[i].type != type:
+        return False
+    return text is None or tokens[i].text == text
+
+def _is_word_in(tokens: List[Token], i: int, words: set) -> bool:
+    return _is(tokens, i, TokenTypes.word) and tokens[i].text in words
+
+def parse_formula(tokens: List[Token], i: int) -> Tuple[Optional[str], int]:
+    '''Parse a dice formula starting at token i (e.g. 2d6 + 3 or 1d8 1d4). Returns the formula text and
+    the index of the first token after it'''
+    if not _is(tokens, i, TokenTypes.dice):
+        return None, i
+
+    parts = [tokens[i].text]
+    i += 1
+    while i < len(tokens):
+        if (_is(tokens, i, TokenTypes.plus) or _is(tokens, i, TokenTypes.minus)) and\
+             (_is(tokens, i+1, TokenTypes.dice) or _is(tokens, i+1, TokenTypes.number)):
+            parts += [tokens[i].text, tokens[i+1].text]
+            i += 2
+        elif _is(tokens, i, TokenTypes.dice):
+            # Unnormalised formula with a missing operator, leave it for the normaliser to fix
+            parts.append(tokens[i].text)
+            i += 1
+        else:
+            break
+    return " ".join(parts), i
+
+def parse_roll(tokens: List[Token], i: int) -> Tuple[Optional[Tuple[Optional[str], Optional[str], Optional[str]]], int]:
+    '''Parse a roll of the form '7 (2d6 + 3) fire', '2d6', '(1d4)' or '5 piercing' starting at token i.
+    Returns a (formula, average, type) tuple and the index after the roll, or None if no roll starts here'''
+    average = None
+    formula = None
+    start = i
+
+    if _is(tokens, i, TokenTypes.number):
+        average = tokens[i].text
+        i += 1
+
+    bracketed = _is(tokens, i, TokenTypes.open_bracket) and _is(tokens, i+1, TokenTypes.dice)
+    if bracketed:
+        i += 1
+    formula, i = parse_formula(tokens, i)
+    if bracketed and _is(tokens, i, TokenTypes.close_bracket):
+        i += 1
+
+    if average is None and formula is None:
+        return None, start
+
+    roll_type = None
+    if _is_word_in(tokens, i, ROLL_TYPES):
+        roll_type = tokens[i].text
+        i += 1
+
+    return (formula, average, roll_type), i
+
+def find_rolls(text: str, tokens: List[Token], start_char: int=0) -> List[Tuple[int, Tuple[Optional[str], Optional[str], Optional[str]]]]:
+    '''Find every roll in the text after start_char. Returns a list of (end_char, (formula, average, type))'''
+    rolls = []
+    i = 0
+    while i < len(tokens) and tokens[i].start < start_char:
+        i += 1
+
+    while i < len(tokens):
+        roll, next_i = parse_roll(tokens, i)
+        if roll is None:
+            i += 1
+            continue
+        rolls.append((tokens[next_i-1].end, roll))
+        i = next_i
+    return rolls
+
+def find_hit_damage(text: str, tokens: List[Token]) -> Optional[Tuple[int, Tuple[Optional[str], Optional[str], Optional[str]]]]:
+    '''Find the first roll following 'hit' or 'hit:'. Returns (end_char, (formula, average, type))'''
+    for i in range(len(tokens)):
+        if not _is(tokens, i, TokenTypes.word, "hit"):
+            continue
+        j = i + 1
+        if _is(tokens, j, TokenTypes.colon):
+            j += 1
+        roll, j = parse_roll(tokens, j)
+        if roll is not None:
+            return tokens[j-1].end, roll
+    return None
+
+def find_versatile_damage(text: str, tokens: List[Token]) -> Optional[Tuple[int, Tuple[Optional[str], Optional[str], Optional[str]]]]:
+    '''Find a roll of the form 'or 8 (1d8 + 4) slashing damage if used with two hands'.
+    Returns (end_char, (formula, average, type))'''
+    i = 0
+    while i < len(tokens):
+        if not _is(tokens, i, TokenTypes.word, "or"):
+            i += 1
+            continue
+        roll, j = parse_roll(tokens, i+1)
+        if roll is None:
+            i += 1
+            continue
+
+        # Only words are allowed between the roll and 'two hands'
+        while _is(tokens, j, TokenTypes.word) and not (tokens[j].text == "two" and _is(tokens, j+1, TokenTypes.word, "hands")):
+            j += 1
+        if _is(tokens, j, TokenTypes.word, "two") and _is(tokens, j+1, TokenTypes.word, "hands"):
+            return tokens[j+1].end, roll
+        i = max(i + 1, j)
+    return None
+
+def _parse_attack_type(tokens: List[Token]) -> Optional[Tuple[int, Tuple[str, Optional[str]]]]:
+    '''Parse 'melee weapon attack:', 'ranged spell attack:', 'melee or ranged weapon attack:' or 'melee:' at the start of the text'''
+    if not _is_word_in(tokens, 0, set(["melee", "ranged"])):
+        return None
+    attack_type = tokens[0].text
+    i = 1
+    if attack_type == "melee" and _is(tokens, i, TokenTypes.word, "or") and _is(tokens, i+1, TokenTypes.word, "ranged"):
+        attack_type = "melee or ranged"
+        i += 2
+
+    weapon = None
+    if _is_word_in(tokens, i, set(["spell", "weapon"])):
+        weapon = tokens[i].text
+        i += 1
+    if _is(tokens, i, TokenTypes.word, "attack"):
+        i += 1
+    if not _is(tokens, i, TokenTypes.colon):
+        return None
+    return tokens[i].end, (attack_type, weapon)
+
+def _parse_hit(tokens: List[Token]) -> Optional[Tuple[int, Tuple[str]]]:
+    '''Parse ': +5 to hit'''
+    for i in range(len(tokens)):
+        if not _is(tokens, i, TokenTypes.colon):
+            continue
+        j = i + 1
+        sign = ""
+        if _is(tokens, j, TokenTypes.plus) or _is(tokens, j, TokenTypes.minus):
+            sign = tokens[j].text
+            j += 1
+        if _is(tokens, j, TokenTypes.number) and _is(tokens, j+1, TokenTypes.word, "to") and _is(tokens, j+2, TokenTypes.word, "hit"):
+            return tokens[j+2].end, (sign + tokens[j].text,)
+    return None
+
+def _parse_reach(tokens: List[Token]) -> Optional[Tuple[int, Tuple[str, str]]]:
+    '''Parse 'reach 5 ft'''
+    for i in range(len(tokens)):
+        if _is(tokens, i, TokenTypes.word, "reach") and _is(tokens, i+1, TokenTypes.number) and _is_word_in(tokens, i+2, MEASURE_TYPES):
+            return tokens[i+2].end, (tokens[i+1].text, tokens[i+2].text)
+    return None
+
+def _parse_range(tokens: List[Token]) -> Optional[Tuple[int, Tuple[str, Optional[str], str]]]:
+    '''Parse 'range 80/320 ft' or 'reach 5 ft'''
+    for i in range(len(tokens)):
+        if not (_is_word_in(tokens, i, set(["range", "reach"])) and _is(tokens, i+1, TokenTypes.number)):
+            continue
+        j = i + 2
+        long_range = None
+        if _is(tokens, j, TokenTypes.slash) and _is(tokens, j+1, TokenTypes.number):
+            long_range = tokens[j+1].text
+            j += 2
+        if _is_word_in(tokens, j, MEASURE_TYPES):
+            return tokens[j].end, (tokens[i+1].text, long_range, tokens[j].text)
+    return None
+
+def _parse_target(text: str, tokens: List[Token]) -> Optional[Tuple[int, Tuple[str, str, Optional[str]]]]:
+    '''Parse ', one target. Hit' or ', two creatures, each of which must be prone. Hit'''
+    i = 0
+    while i < len(tokens):
+        if not (_is(tokens, i, TokenTypes.comma) and
+                (_is(tokens, i+1, TokenTypes.number) or _is_word_in(tokens, i+1, TARGET_COUNTS))):
+            i += 1
+            continue
+
+        target = tokens[i+2].text if _is(tokens, i+2, TokenTypes.word) else ""
+        if target.endswith("s") and target[:-1] in TARGET_TYPES:
+            target = target[:-1]
+        if target not in TARGET_TYPES:
+            i += 1
+            continue
+
+        j = i + 3
+        if _is(tokens, j, TokenTypes.comma):
+            j += 1
+
+        # Post text may only contain words and commas
+        post_start = j
+        while _is(tokens, j, TokenTypes.word) or _is(tokens, j, TokenTypes.comma):
+            j += 1
+        post_text = text[tokens[post_start].start:tokens[j-1].end] if j > post_start else None
+
+        if _is(tokens, j, TokenTypes.full_stop) and _is(tokens, j+1, TokenTypes.word, "hit"):
+            return tokens[j+1].end, (tokens[i+1].text, target, post_text)
+        i = max(i + 1, j)
+    return None
+
+def parse_attack(text: str, tokens: List[Token]) -> Dict[str, Any]:
+    '''Parse the attack header and damage of an action. Returns a dictionary of [end_char, groups] entries
+    (or None when not found) for type, hit, reach, range, target, hit_damage and versatile_damage'''
+    properties = {
+        "type": _parse_attack_type(tokens),
+        "hit": _parse_hit(tokens),
+        "reach": _parse_reach(tokens),
+        "range": _parse_range(tokens),
+        "target": _parse_target(text, tokens),
+        "hit_damage": find_hit_damage(text, tokens),
+        "versatile_damage": find_versatile_damage(text, tokens)
+    }
+    return {k: list(v) if v else None for k,v in properties.items()}
+
+def find_saves(tokens: List[Token], start_char: int=0) -> List[Tuple[int, Tuple[str, str]]]:
+    '''Find saving throws of the form 'DC 13 Dexterity' or 'DC 13 (Dex)'. Returns a list of (end_char, (value, ability))'''
+    saves = []
+    for i in range(len(tokens)):
+        if tokens[i].start < start_char or tokens[i].tag != TokenTags.dc or not _is(tokens, i+1, TokenTypes.number):
+            continue
+        j = i + 2
+        if _is(tokens, j, TokenTypes.open_bracket):
+            j += 1
+        if j < len(tokens) and tokens[j].tag == TokenTags.ability:
+            end = tokens[j].end
+            if _is(tokens, j+1, TokenTypes.open_bracket):
+                end = tokens[j+1].end
+            saves.append((end, (tokens[i+1].text, tokens[j].text)))
+    return saves
+
+def find_escapes(tokens: List[Token], start_char: int=0) -> List[Tuple[int, Tuple[str]]]:
+    '''Find grapple escape DCs ('escape DC 13'). Returns a list of (end_char, (value,))'''
+    escapes = []
+    for i in range(len(tokens)):
+        if tokens[i].start >= start_char and _is(tokens, i, TokenTypes.word, "escape")\
+                and i+1 < len(tokens) and tokens[i+1].tag == TokenTags.dc and _is(tokens, i+2, TokenTypes.number):
+            escapes.append((tokens[i+2].end, (tokens[i+2].text,)))
+    return escapes
+
+def find_conditions(tokens: List[Token], start_char: int=0) -> List[Tuple[int, Tuple[str]]]:
+    '''Find every condition. Returns a list of (end_char, (condition,))'''
+    return [(t.end, (t.text,)) for t in tokens if t.start >= start_char and t.tag == TokenTags.condition]
+
+def find_halves(tokens: List[Token], start_char: int=0) -> List[Tuple[int, Tuple]]:
+    '''Find 'half as much damage'. Returns a list of (end_char, ())'''
+    halves = []
+    for i in range(len(tokens)):
+        if tokens[i].start >= start_char and _is(tokens, i, TokenTypes.word, "half") and _is(tokens, i+1, TokenTypes.word, "as")\
+                and _is(tokens, i+2, TokenTypes.word, "much") and _is(tokens, i+3, TokenTypes.word, "damage"):
+            halves.append((tokens[i+3].end, ()))
+    return halves
+
+def find_effects(text: str, tokens: List[Token], start_char: int=0) -> Dict[str, Any]:
+    '''Find rolls, saves, escapes, conditions and halved damage after start_char. Returns a dictionary of
+    lists of (end_char, groups), or None when nothing is found'''
+    properties = {
+        "dice_rolls": find_rolls(text, tokens, start_char),
+        "saves": find_saves(tokens, start_char),
+        "escape": find_escapes(tokens, start_char),
+        "conditions": find_conditions(tokens, start_char),
+        "halves": find_halves(tokens, start_char)
+    }
+    return {k: v if len(v) > 0 else None for k,v in properties.items()}
@@ -6,9 +6,10 @@ from extractor.creature_schema import CreatureSchema
 from preprocessing.columniser import Columniser
 from data_loaders.data_loader_interface import DataLoaderInterface
 
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from logging import Logger
-from typing import Tuple, Dict, List, Any
+from typing import Callable, Tuple, Dict, List, Any
 
 from utils.datatypes import Section, Source
 from utils.drawing import drawBoundingBoxes
@@ -18,6 +19,7 @@ from preprocessing.clusterer import Clusterer
 
 from extractor.annotators import LineAnnotator, SectionAnnotator
 from extractor.statblock_builder import StatblockBuilder
+from extractor.statblock_filter import StatblockFilter
 from extractor.creature_factory import CreatureFactory
 
 from outputs.writer_interface import WriterInterface
@@ -32,12 +34,16 @@ class StatblockExtractor(object):
         self.loaders_by_filetype = {}
         self.writers_by_name = {}
         self.writer = ''
+        self.writers = []
+        self.creature_callbacks = []
+        self.statblock_callbacks = []
 
         self.columniser = Columniser(config, logger)
         self.line_annotator = LineAnnotator(config, logger)
         self.clusterer = Clusterer(config, logger)
         self.cluster_annotator = SectionAnnotator(config, logger)
         self.statblock_generator = StatblockBuilder(config, logger)
+        self.statblock_filter = StatblockFilter(config, logger)
 
         self.data = None
         self.statblocks = {}
@@ -75,6 +81,15 @@ class StatblockExtractor(object):
         '''Registers an output writer. Passes kwargs through to the writer'''
         self.writers_by_name[writer.get_name()] = writer(self.config, self.logger, **kwargs)
 
+    def register_creature_callback(self, callback: Callable[[Source, Any], Any]):
+        '''Call this function with (source, creature) as soon as each creature is parsed, before parse returns'''
+        self.creature_callbacks.append(callback)
+
+    def register_statblock_callback(self, callback: Callable[[Source, Section, Any], Any]):
+        '''Call this function with (source, statblock, creature) for every candidate statblock that passes the pre-filter,
+        once it has been parsed. The creature is None if the statblock didn't parse'''
+        self.statblock_callbacks.append(callback)
+
     def select_writer(self, writer: str) -> bool:
         '''Select an output writer, returns True if successful'''
         if writer not in self.writers_by_name:
@@ -82,6 +97,46 @@ class StatblockExtractor(object):
             return False
 
         self.writer = self.writers_by_name[writer]
+        self.writers = [self.writer]
+        return True
+
+    def select_writers(self, writers: List[str]) -> bool:
+        '''Select several output writers that will all be given the same creatures, returns True if successful'''
+        for w in writers:
+            if w not in self.writers_by_name:
+                self.logger.error("No Output Writer named {} registered".format(w))
+                return False
+
+        self.writers = [self.writers_by_name[w] for w in dict.fromkeys(writers)]
+        self.writer = self.writers[0]
+        return True
+
+    def summary(self) -> List[str]:
+        '''Returns lines describing the work done while parsing, printed at the end of a run'''
+        return self.statblock_filter.summary()
+
+    def writer_filename(self, output_file: str, writer: WriterInterface) -> str:
+        '''Output file for a writer. When several writers are selected the writer name is added so they don't share a file'''
+        if len(self.writers) <= 1:
+            return output_file
+        base = output_file
+        if len(os.path.basename(output_file).split(".")) > 1:
+            base = ".".join(output_file.split(".")[:-1])
+        return "{}.{}.{}".format(base, writer.get_name(), writer.get_filetype())
+
+    def __run_writers(self, write: Callable[[WriterInterface], Any]):
+        '''Run a write with every selected writer. Writers are mostly waiting on files so they run in a thread pool,
+        unless they might need to ask the user for input'''
+        if len(self.writers) == 1 or not self.config.getboolean("default", "use_defaults", fallback=False):
+            for w in self.writers:
+                write(w)
+        else:
+            with ThreadPoolExecutor(max_workers=len(self.writers)) as pool:
+                for future in [pool.submit(write, w) for w in self.writers]:
+                    future.result()
+
+        for w in self.writers:
+            w.append = True #Always append any additional creatures after the first
 
 
     def load_data(self, filepath: str) -> List[Source]:
@@ -121,8 +176,6 @@ class StatblockExtractor(object):
         '''Load data from the file and try to find the statblocks. Use the draw options to show individual parts of the statblock discovery pipeline. Set output file
         to a filename to write using the selected writer.'''
 
-        draw = draw_lines or draw_columns or draw_statblocks or draw_clusters
-
         sources = []
         for f in filepaths:
             s = self.load_data(f)
@@ -131,6 +184,14 @@ class StatblockExtractor(object):
             else:
                 sources += s
 
+        return self.parse_sources(sources, pages, draw_lines, draw_columns, draw_statblocks, draw_clusters, draw_final_columns)
+
+    def parse_sources(self, sources: List[Source], pages: List[int]=None, draw_lines=False, draw_columns=False, draw_statblocks=False, draw_clusters=False, draw_final_columns=False) \
+            -> Tuple[Dict[str, Tuple[Source, Dict[str, List[Any]]]], Dict[int, List[Section]]]:
+        '''Find the statblocks in already loaded sources. Takes the same draw options as parse'''
+
+        draw = draw_lines or draw_columns or draw_statblocks or draw_clusters
+
         finished_ps = {}
         finished_sb = {}
         for source in sources:
@@ -176,7 +237,7 @@ class StatblockExtractor(object):
                 for col in columns:
                     self.line_annotator.annotate(col.lines)
 
-                if self.config.get("default", "debug"):
+                if self.config.getboolean("default", "debug", fallback=False):
                     self.logger.debug("Annotated Lines")
                     for c in columns:
                         self.logger.debug("COLUMN START")
@@ -226,15 +287,24 @@ class StatblockExtractor(object):
 
             #     statblocks = columned_statblocks
 
+            ### Drop candidates that are missing too many core annotations to be a creature
+            candidates, rejected = self.statblock_filter.filter(statblocks)
+            if len(rejected) > 0:
+                self.logger.info("Pre-filter rejected {} of {} candidate statblocks".format(len(rejected), len(statblocks)))
+
             # Parse the creatures
-            if len(statblocks) > 0:
+            if len(candidates) > 0:
                 parsed_statblocks = []
-                for sb in statblocks:
+                for sb in candidates:
                     cr = cp.statblock_to_creature(sb)
                     if cr:
                         cr.add_background(background)
                         cr.set_source(source.name, sb.page+1)
                         parsed_statblocks.append(cr)
+                        for callback in self.creature_callbacks:
+                            callback(source, cr)
+                    for callback in self.statblock_callbacks:
+                        callback(source, sb, cr if cr else None)
 
             self.logger.info("Found {} statblocks".format(len(parsed_statblocks)))
 
@@ -252,5 +322,20 @@ class StatblockExtractor(object):
             for page in parsed_statblocks:
                 creatures += parsed_statblocks[page]
             
-            self.writer.write(output_file, source, creatures)
-            self.writer.append = True #Always append any additional creatures after the first
+            for w in self.writers:
+                w.prepare(creatures)
+            self.__run_writers(lambda w: w.write(self.writer_filename(output_file, w), source, creatures))
+
+    def write_many_to_file(self, output_file: str, sources: List[Tuple[Source, Dict[str, List[Any]]]]):
+            # Write several sources to one file, letting the writer read and write the file only once
+            self.logger.info("Writing {} sources to file {}".format(len(sources), output_file))
+            batch = []
+            for source, parsed_statblocks in sources:
+                creatures = []
+                for page in parsed_statblocks:
+                    creatures += parsed_statblocks[page]
+                batch.append((source, creatures))
+
+            for w in self.writers:
+                w.prepare([c for _, creatures in batch for c in creatures])
+            self.__run_writers(lambda w: w.write_many(self.writer_filename(output_file, w), batch))
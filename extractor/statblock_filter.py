@@ -0,0 +1,82 @@
+import configparser
+import logging
+
+import numpy as np
+
+from typing import List, Tuple
+from utils.datatypes import Section
+
+class StatblockFilter(object):
+    '''Cheaply scores candidate statblocks from their annotations and drops those that can't become a valid creature,
+    before they reach the (much more expensive) CreatureFactory'''
+
+    ### Each feature is satisfied by any of its line or section tags. These mirror the core stats Creature.is_valid checks for
+    FEATURES = [
+        ("race_type_header", ["race_type_header", "sb_header"]),
+        ("ac", ["ac"]),
+        ("hp", ["hp"]),
+        ("speed", ["speed"]),
+        ("array_values", ["array_values", "sb_array_value"]),
+    ]
+
+    def __init__(self, config: configparser.ConfigParser, logger: logging.Logger):
+        self.config = config
+        self.logger = logger.getChild("filter")
+
+        self.threshold = config.getfloat("filter", "threshold", fallback=0.4)
+        self.weights = np.array([config.getfloat("filter", "weight_" + name, fallback=1.0) for name,_ in StatblockFilter.FEATURES])
+
+        self.tag_columns = {}
+        for i,(_,tags) in enumerate(StatblockFilter.FEATURES):
+            for t in tags:
+                self.tag_columns[t] = i
+
+        self.num_seen = 0
+        self.num_rejected = 0
+
+    def feature_matrix(self, statblocks: List[Section]) -> np.ndarray:
+        '''Returns a (statblocks x features) boolean matrix marking which features are present in each candidate'''
+        rows = []
+        cols = []
+        for i,sb in enumerate(statblocks):
+            for a in sb.attributes:
+                if a in self.tag_columns:
+                    rows.append(i)
+                    cols.append(self.tag_columns[a])
+            for line in sb.lines:
+                for a in line.attributes:
+                    if a in self.tag_columns:
+                        rows.append(i)
+                        cols.append(self.tag_columns[a])
+
+        matrix = np.zeros((len(statblocks), len(StatblockFilter.FEATURES)), dtype=bool)
+        matrix[rows, cols] = True
+        return matrix
+
+    def score(self, statblocks: List[Section]) -> np.ndarray:
+        '''Returns the weighted fraction of features present for each candidate, between 0 and 1'''
+        if len(statblocks) == 0:
+            return np.zeros(0)
+        return self.feature_matrix(statblocks) @ self.weights / self.weights.sum()
+
+    def filter(self, statblocks: List[Section]) -> Tuple[List[Section], List[Section]]:
+        '''Split candidates into those worth parsing and those rejected'''
+        if self.threshold <= 0 or len(statblocks) == 0:
+            return statblocks, []
+
+        keep = self.score(statblocks) >= self.threshold
+        kept = [sb for sb,k in zip(statblocks, keep) if k]
+        rejected = [sb for sb,k in zip(statblocks, keep) if not k]
+
+        for sb in rejected:
+            self.logger.debug("Rejected candidate statblock starting '{}'".format(sb.lines[0].text if len(sb.lines) > 0 else ""))
+
+        self.num_seen += len(statblocks)
+        self.num_rejected += len(rejected)
+        return kept, rejected
+
+    def summary(self) -> List[str]:
+        '''Returns lines describing the candidates rejected over the run'''
+        if self.num_seen == 0:
+            return []
+        return ["Pre-filter rejected {} of {} candidate statblocks".format(self.num_rejected, self.num_seen)]
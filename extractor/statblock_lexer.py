@@ -0,0 +1,154 @@
+import dataclasses
+import re
+from typing import Dict, List, Optional, Tuple
+
+import extractor.constants as constants
+from extractor.dice_parser import Token, TokenTags, TokenTypes, tokenise
+from utils.datatypes import Line, Section
+
+_TAGGED_OPTIONS = [
+    (constants.ABILITIES, TokenTags.ability),
+    (constants.SHORT_ABILITIES, TokenTags.ability),
+    (constants.SKILLS, TokenTags.ability),
+    (constants.MEASURES, TokenTags.measure),
+    (constants.CONDITIONS, TokenTags.condition),
+    (constants.DAMAGE_TYPES, TokenTags.damage_type)]
+
+def _build_word_tags() -> Dict[str, TokenTags]:
+    '''Map single words to the semantic tag they carry within a statblock'''
+    tags = {}
+    for options, tag in _TAGGED_OPTIONS:
+        for v in constants.enum_values(options):
+            if " " not in v:
+                tags[v] = tag
+    tags["dc"] = TokenTags.dc
+    return tags
+
+def _build_phrase_tags() -> Dict[str, List[Tuple[List[str], TokenTags]]]:
+    '''Map the first word of multi-word values (e.g. 'sleight of hand') to the words of each phrase and its tag'''
+    phrases = {}
+    for options, tag in _TAGGED_OPTIONS:
+        for v in constants.enum_values(options):
+            if " " in v:
+                words = v.split()
+                phrases.setdefault(words[0], []).append((words, tag))
+    return phrases
+
+WORD_TAGS = _build_word_tags()
+PHRASE_TAGS = _build_phrase_tags()
+
+def merge_phrases(tokens: List[Token]) -> List[Token]:
+    '''Join runs of word tokens that spell a multi-word value into a single tagged word token'''
+    merged = []
+    i = 0
+    while i < len(tokens):
+        t = tokens[i]
+        for words, tag in PHRASE_TAGS.get(t.text, []) if t.type == TokenTypes.word else []:
+            end = i + len(words)
+            if end <= len(tokens) and all(tokens[i+k].type == TokenTypes.word and tokens[i+k].text == w for k, w in enumerate(words)):
+                merged.append(Token(TokenTypes.word, " ".join(words), t.start, tokens[end-1].end, tag))
+                i = end
+                break
+        else:
+            merged.append(t)
+            i += 1
+    return merged
+
+@dataclasses.dataclass
+class LexedLine:
+    '''A single line split into tagged tokens, along with the title information used to split features and actions'''
+    tokens: List[Token]
+    title: str
+    title_words: int
+    has_body: bool
+
+    def has_title(self) -> bool:
+        '''Returns true if the line starts with a short, capitalised sentence that is followed by more text'''
+        return self.title_words < 6 and len(self.title) > 0 and self.title[0].isupper()\
+            and self.title.split()[0].lower() not in constants.enum_values(constants.ABILITIES)\
+            and self.has_body
+
+@dataclasses.dataclass
+class TokenStream:
+    '''Tokens for a whole section, with offsets into the lowercased section text'''
+    text: str
+    tokens: List[Token]
+
+    def split_title(self) -> Tuple[List[Token], List[Token]]:
+        '''Split the stream into title tokens (up to the first full stop, or a colon within the first sentence) and body tokens'''
+        end = None
+        for i,t in enumerate(self.tokens):
+            if t.type == TokenTypes.colon and end is None and i > 0:
+                end = i
+            if t.type == TokenTypes.full_stop:
+                end = i if end is None else end
+                break
+        if end is None:
+            return self.tokens, []
+        return self.tokens[:end], self.tokens[end+1:]
+
+class StatblockLexer(object):
+    '''Turns statblock lines into tagged token streams. Each line is only scanned once, later requests for the same
+    line (or sections containing it) reuse the cached tokens'''
+
+    __BRACKETS = re.compile("\(.+?\)")
+
+    def __init__(self):
+        self.lines = {}
+
+    def reset(self):
+        '''Clear cached lines'''
+        self.lines = {}
+
+    def lex_line(self, line: Line) -> LexedLine:
+        '''Tokenise a single line and pull out its potential title'''
+        key = (line.id, line.text)
+        if key in self.lines:
+            return self.lines[key]
+
+        text = line.text
+        stop = text.find(".")
+        title = text if stop < 0 else text[:stop]
+        has_colon = title.find(":")
+        if has_colon > 0:
+            title = title[:has_colon]
+
+        lexed = LexedLine(
+            tokens=tokenise(text.lower(), WORD_TAGS),
+            title=title,
+            title_words=len(StatblockLexer.__BRACKETS.sub("", title).split()),
+            has_body=stop >= 0 and stop + 1 < len(text) and text[stop+1] != "."
+        )
+        self.lines[key] = lexed
+        return lexed
+
+    def lex_section(self, section: Section, join_char: str=" ") -> TokenStream:
+        '''Join the cached tokens of each line into a stream matching Section.get_section_text'''
+        text = ""
+        tokens = []
+        joining = False
+        for line in section.lines:
+            lexed = self.lex_line(line)
+            offset = len(text)
+            line_tokens = [dataclasses.replace(t, start=t.start+offset, end=t.end+offset) for t in lexed.tokens]
+
+            # Rejoin words that were hyphenated over a line break
+            if joining and len(line_tokens) > 0 and line_tokens[0].type == TokenTypes.word\
+                    and len(tokens) > 0 and tokens[-1].type == TokenTypes.word and tokens[-1].end == offset:
+                word = tokens[-1].text + line_tokens[0].text
+                tokens[-1] = Token(TokenTypes.word, word, tokens[-1].start, line_tokens[0].end, WORD_TAGS.get(word))
+                line_tokens = line_tokens[1:]
+            tokens += line_tokens
+
+            lowered = line.text.lower()
+            joining = len(lowered) > 0 and lowered[-1] == "-"
+            if joining:
+                text += lowered[:-1]
+                # Drop the hyphen token
+                if len(tokens) > 0 and tokens[-1].type == TokenTypes.minus:
+                    tokens.pop()
+            else:
+                text += lowered + join_char
+
+        ### Phrases are merged once the lines are joined so they can span a line break
+        return TokenStream(text=text, tokens=merge_phrases(tokens))
@@ -3,11 +3,12 @@ import json
 from schema import Schema, Optional
 from configparser import ConfigParser
 from logging import Logger
-from typing import Any, List
+from typing import Any, List, Tuple
 
 from utils.datatypes import Source
 from extractor.creature_schema import CreatureSchema
 from outputs.writer_interface import WriterInterface
+from outputs.line_store import append_lines, read_lines, storage_mode, with_extension
 
 
 
@@ -27,6 +28,7 @@ class DefaultWriter(WriterInterface):
         self.logger = logger.getChild("default_out")
         self.config = config
         self.append = append
+        self.storage = storage_mode(config)
 
     @staticmethod
     def get_long_name() -> str:
@@ -43,6 +45,11 @@ class DefaultWriter(WriterInterface):
         '''Returns the output filetype of this writer'''
         return "json"
 
+    @staticmethod
+    def get_line_filetype() -> str:
+        '''Returns the filetype used when writing one record per line'''
+        return "jsonl"
+
     @staticmethod
     def prettify_name(s: str) -> str:
         '''Turn a filepath into a nicer name'''
@@ -57,13 +64,19 @@ class DefaultWriter(WriterInterface):
 
     def write(self, filename: str, source: Source, creatures: List[Any], append: bool=None) -> bool:
         '''Writes the creatures to the specified file. If append is set to true, creatures will be inserted into the existing file. Returns True if write is successful'''
+        return self.write_many(filename, [(source, creatures)], append)
+
+    def write_many(self, filename: str, sources: List[Tuple[Source, List[Any]]], append: bool=None) -> bool:
+        '''Writes the creatures of several sources to the specified file, reading and writing it only once. Returns True if write is successful'''
 
         ### Apply configuration overrides
         if append is None:
             append = self.append
 
         ### Ensure we're writing something with the correct filetype
-        if not filename.endswith(DefaultWriter.get_filetype()):
+        if self.storage == "lines":
+            filename = with_extension(filename, DefaultWriter.get_line_filetype())
+        elif not filename.endswith(DefaultWriter.get_filetype()):
             filename = ".".join(filename.split(".")[:-1]) + "." + DefaultWriter.get_filetype()
 
         make_file = False
@@ -74,15 +87,49 @@ class DefaultWriter(WriterInterface):
             self.logger.error("Output file is a directory. Can't write")
             return False
 
-
-        if make_file:
+        if make_file or self.storage == "lines":
             data = []
         else:
             with open(filename, 'r', encoding='utf-8') as f:
                 data = json.load(f)
 
-        pretty_name = DefaultWriter.prettify_name(source.name)
+        ### Title -> source entry, built once per write. The first entry wins if a file has duplicate titles
+        entries = {}
+        for source_entry in data:
+            entries.setdefault(source_entry['source']["title"], source_entry)
+
+        records = []
+        for source, creatures in sources:
+            pretty_name = DefaultWriter.prettify_name(source.name)
+            source_data = DefaultWriter.__source_data(source, pretty_name)
+
+            if self.storage == "lines":
+                ### One line for the source followed by one line per creature, merged into source entries by compact
+                records.append(DefaultWriter.__source_entry(source, source_data, []))
+                records += [{"title": pretty_name, "creature": c.to_json()} for c in creatures]
+                continue
+
+            if pretty_name in entries:
+                self.logger.debug("Appending creatures to existing source")
+                entries[pretty_name]["creatures"] += [c.to_json() for c in creatures]
+                entries[pretty_name]['source'] = source_data
+            else:
+                self.logger.debug("Making new source entry")
+                entries[pretty_name] = DefaultWriter.__source_entry(source, source_data, [c.to_json() for c in creatures])
+                data.append(entries[pretty_name])
+
+        if self.storage == "lines":
+            append_lines(filename, records, append=not make_file)
+            return True
+
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4)
+
+        return True
 
+    @staticmethod
+    def __source_data(source: Source, pretty_name: str) -> Any:
+        '''Create the source details stored with each source entry'''
         source_data = {
             'title': pretty_name,
         }
@@ -94,30 +141,41 @@ class DefaultWriter(WriterInterface):
         if source.authors is not None and len(source.authors) > 0:
             source_data['authors'] = source.authors
 
-        written = False
-        for source_entry in data:
-            if source_entry['source']["title"] == pretty_name:
-                source_entry["creatures"] += [c.to_json() for c in creatures]
-                source_entry['source'] = source_data
-                written = True
-                self.logger.debug("Appending creatures to existing source")
-                break
-        
-        if not written:
-            self.logger.debug("Making new source entry")
-            data.append(
-                {
-                    "source": source_data,
-                    'title': source_data['title'],
-                    "creatures": [c.to_json() for c in creatures]
-                }
-            )
-            if source.authors is not None:
-                data[-1]["authors"] = source.authors
-            if source.url is not None:
-                data[-1]["url"] = source.url
+        return source_data
 
-        with open(filename, 'w', encoding='utf-8') as f:
+    @staticmethod
+    def __source_entry(source: Source, source_data: Any, creatures: List[Any]) -> Any:
+        '''Create a new source entry holding the given creatures'''
+        entry = {
+            "source": source_data,
+            'title': source_data['title'],
+            "creatures": creatures
+        }
+        if source.authors is not None:
+            entry["authors"] = source.authors
+        if source.url is not None:
+            entry["url"] = source.url
+        return entry
+
+    def compact(self, filename: str, out_filename: str) -> bool:
+        '''Combine a line file written in lines storage mode into a single internal format JSON file'''
+        data = []
+        entries = {}
+        for record in read_lines(filename):
+            title = record["title"]
+            if "creature" in record:
+                if title not in entries:
+                    entries[title] = {"source": {"title": title}, "title": title, "creatures": []}
+                    data.append(entries[title])
+                entries[title]["creatures"].append(record["creature"])
+            elif title in entries:
+                ### A later write of the same source updates its details, as appending in json storage does
+                entries[title]["source"] = record["source"]
+            else:
+                entries[title] = record
+                data.append(record)
+
+        with open(out_filename, 'w', encoding='utf-8') as f:
             json.dump(data, f, indent=4)
 
         return True
@@ -0,0 +1,293 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+from collections.abc import Mapping
+from configparser import ConfigParser
+from logging import Logger
+from typing import Any, Dict, Iterator, List, Optional
+
+from outputs.fvtt.types import CompendiumTypes
+
+### The compendium index holds everything the FVTT converter needs from the Foundry compendia (normalised name tables
+### and image maps). It is built once, saved as a binary file in the cache directory and shared by every writer in
+### the process. It is rebuilt whenever one of the compendium files changes.
+###
+### The saved file is a small JSON header (file fingerprints, image maps and the offset of every entry) followed by
+### each compendium entry as JSON. Loading memory maps the file and only reads the header, entries are decoded the
+### first time they are looked up. Conversion worker processes load the same file, so they share its pages through
+### the OS page cache rather than each holding a copy of the compendia.
+
+def compendium_files(config: ConfigParser) -> List[str]:
+    '''Returns the paths of all compendium files set in the config'''
+    compendiums = []
+    compendium_dir = config.get("foundry", "compendium-dir", fallback="./foundry")
+    for f in sorted(os.listdir(compendium_dir)):
+        if ".json" not in f:
+            continue
+        compendiums.append(os.path.join(compendium_dir, f))
+    for f in config.get("foundry", "compendia", fallback="").split(","):
+        if f != "":
+            compendiums.append(f)
+    return compendiums
+
+def index_path(config: ConfigParser) -> str:
+    '''Returns where the compendium index is saved'''
+    cache_dir = config.get("default", "cache", fallback=".cache")
+    return config.get("foundry", "index-path", fallback=os.path.join(cache_dir, "compendium_index.idx"))
+
+def file_hash(path: str) -> str:
+    '''SHA1 of a file's contents'''
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class MappedEntries(Mapping):
+    '''Read-only name -> entry table over a memory mapped index file. Entries are decoded on first use and kept'''
+
+    def __init__(self, buffer: mmap.mmap, base: int, offsets: Dict[str, List[int]]):
+        self.buffer = buffer
+        self.base = base
+        # Name -> [offset from base, length] of the entry's JSON
+        self.offsets = offsets
+        self.decoded = {}
+
+    def raw(self, name: str) -> bytes:
+        '''The undecoded JSON of an entry'''
+        start, length = self.offsets[name]
+        return self.buffer[self.base + start:self.base + start + length]
+
+    def __getitem__(self, name: str) -> Any:
+        entry = self.decoded.get(name)
+        if entry is None:
+            entry = self.decoded[name] = json.loads(self.raw(name))
+        return entry
+
+    def __contains__(self, name: Any) -> bool:
+        return name in self.offsets
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+class CompendiumIndex(object):
+    '''Normalised name tables and image maps for a set of compendium files'''
+
+    VERSION = 2
+
+    ### Little-endian length of the JSON header at the start of a saved index
+    HEADER_LENGTH = struct.Struct("<Q")
+
+    def __init__(self, compendia: Dict[str, Dict[str, Any]], image_paths: Dict[str, str], actor_image_paths: Dict[str, str],
+            files: Dict[str, List[Any]]):
+        self.compendia = compendia
+        self.image_paths = image_paths
+        self.actor_image_paths = actor_image_paths
+        # Path -> [size, modified time, sha1] of each compendium file the index was built from
+        self.files = files
+        self.touched = False
+
+    @staticmethod
+    def format_name(s: str) -> str:
+        return s.lower()
+
+    @staticmethod
+    def format_image_name(s: str) -> str:
+        return " ".join([s.strip() for s in s.lower().split() if s])
+
+    @staticmethod
+    def __merge_dicts(d1, d2):
+        for k in d2:
+            if k in d1:
+                for n in d2[k]:
+                    if n in d1[k]:
+                        d1[k][n] += d2[k][n]
+                    else:
+                        d1[k][n] = d2[k][n]
+            else:
+                d1[k] = d2[k]
+
+    @staticmethod
+    def __get_images(data):
+        '''Count how often each image is used for each name'''
+        images = {}
+        if isinstance(data, dict):
+            if "name" in data and "img" in data:
+                name = data["name"]
+                img = data["img"]
+                if "tokens" not in img and "mystery-man" not in img:
+                    name = CompendiumIndex.format_image_name(name)
+                    images[name] = {data["img"]:1}
+
+            for k in data:
+                if k == "name" or k == "img":
+                    continue
+
+                CompendiumIndex.__merge_dicts(images, CompendiumIndex.__get_images(data[k]))
+
+        elif isinstance(data, list):
+            for entry in data:
+                CompendiumIndex.__merge_dicts(images, CompendiumIndex.__get_images(entry))
+
+        return images
+
+    @staticmethod
+    def to_map(images):
+        '''Pick the most commonly used image for each name'''
+        data = {}
+        for k in images:
+            path = max(images[k].items(), key=lambda x: x[1])[0]
+            data[k] = path
+
+        return data
+
+    @staticmethod
+    def fingerprint(path: str, previous: Optional[List[Any]]=None) -> List[Any]:
+        '''Returns [size, modified time, sha1] for a file. The hash is reused if size and time are unchanged'''
+        stat = os.stat(path)
+        if previous is not None and previous[0] == stat.st_size and previous[1] == stat.st_mtime_ns:
+            return previous
+        return [stat.st_size, stat.st_mtime_ns, file_hash(path)]
+
+    @staticmethod
+    def build(paths: List[str], logger: Logger) -> CompendiumIndex:
+        '''Load every compendium file and build the index'''
+        compendia = {}
+        files = {}
+        for c in paths:
+            logger.info(f"Loading compendium {c}")
+            files[c] = CompendiumIndex.fingerprint(c)
+            with open(c, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+
+            if data["type"].lower() not in compendia:
+                compendia[data["type"].lower()] = {}
+            target = compendia[data["type"].lower()]
+            for item in data["items"]:
+                target[CompendiumIndex.format_name(item["name"])] = item
+
+        for c in compendia:
+            logger.info(f"Processing {len(compendia[c])} entries of type {c}")
+
+        image_paths = CompendiumIndex.to_map(CompendiumIndex.__get_images(compendia.get(CompendiumTypes.Item.name.lower(), {})))
+        actor_image_paths = CompendiumIndex.to_map(CompendiumIndex.__get_images(compendia.get(CompendiumTypes.Actor.name.lower(), {})))
+
+        return CompendiumIndex(compendia, image_paths, actor_image_paths, files)
+
+    def is_stale(self, paths: List[str]) -> bool:
+        '''Returns true if the compendium files have been added, removed or changed since the index was built'''
+        if set(paths) != set(self.files.keys()):
+            return True
+        for p in paths:
+            if not os.path.exists(p):
+                return True
+            current = CompendiumIndex.fingerprint(p, self.files[p])
+            if current[2] != self.files[p][2]:
+                return True
+            # Keep the new modified time so we don't rehash a touched but unchanged file
+            if current is not self.files[p]:
+                self.files[p] = current
+                self.touched = True
+        return False
+
+    @property
+    def hash(self) -> str:
+        '''A single hash covering every compendium file in the index'''
+        sha = hashlib.sha1()
+        for p in sorted(self.files.keys()):
+            sha.update(self.files[p][2].encode("utf8"))
+        return sha.hexdigest()
+
+    def save(self, path: str):
+        '''Write the index to a binary file that load can memory map'''
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        header = {
+            "version": CompendiumIndex.VERSION,
+            "files": self.files,
+            "image_paths": self.image_paths,
+            "actor_image_paths": self.actor_image_paths,
+            "compendia": {}
+        }
+        entries = []
+        offset = 0
+        for t, table in self.compendia.items():
+            offsets = header["compendia"][t] = {}
+            for name in table:
+                data = table.raw(name) if isinstance(table, MappedEntries) else json.dumps(table[name], separators=(",", ":")).encode("utf8")
+                offsets[name] = [offset, len(data)]
+                entries.append(data)
+                offset += len(data)
+        encoded = json.dumps(header, separators=(",", ":")).encode("utf8")
+
+        tmp = path + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(CompendiumIndex.HEADER_LENGTH.pack(len(encoded)))
+            f.write(encoded)
+            for data in entries:
+                f.write(data)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path: str) -> Optional[CompendiumIndex]:
+        '''Memory map an index written by save. Returns None if it is missing or from a different version'''
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            (length,) = CompendiumIndex.HEADER_LENGTH.unpack_from(buffer, 0)
+            header = json.loads(buffer[CompendiumIndex.HEADER_LENGTH.size:CompendiumIndex.HEADER_LENGTH.size + length])
+        except Exception:
+            return None
+        if not isinstance(header, dict) or header.get("version") != CompendiumIndex.VERSION:
+            return None
+
+        base = CompendiumIndex.HEADER_LENGTH.size + length
+        compendia = {t: MappedEntries(buffer, base, offsets) for t, offsets in header["compendia"].items()}
+        return CompendiumIndex(compendia, header["image_paths"], header["actor_image_paths"], header["files"])
+
+_shared_index = None
+
+def get_compendium_index(config: ConfigParser, logger: Logger, rebuild: bool=False) -> CompendiumIndex:
+    '''Returns the process-wide compendium index, loading it from disk or building it on first use'''
+    global _shared_index
+    if _shared_index is not None and not rebuild:
+        return _shared_index
+
+    logger = logger.getChild("fvtt_cmp_index")
+    paths = compendium_files(config)
+    path = index_path(config)
+    index = None if rebuild else CompendiumIndex.load(path)
+    if index is not None and index.is_stale(paths):
+        logger.info("Compendium files have changed, rebuilding index")
+        index = None
+
+    if index is None:
+        index = CompendiumIndex.build(paths, logger)
+        index.save(path)
+        logger.info(f"Saved compendium index to {path}")
+        ### Use the mapped copy so this process only holds the entries it looks up, the same as conversion workers
+        index = CompendiumIndex.load(path) or index
+    else:
+        # Save updated modified times so unchanged files aren't hashed again next run
+        if index.touched:
+            try:
+                index.save(path)
+            except OSError as e:
+                ### e.g. Windows won't replace a file another process has mapped, the times are saved on a later run
+                logger.debug(f"Couldn't update compendium index times: {e}")
+        logger.info(f"Loaded compendium index from {path}")
+
+    _shared_index = index
+    return index
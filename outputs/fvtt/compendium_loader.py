@@ -1,16 +1,14 @@
-from distutils.log import Log
-import json
 import os
-from copy import deepcopy
+import re
+import threading
 
 from configparser import ConfigParser
 from logging import Logger
-from typing import List, Optional, Any
+from typing import List, Optional, Any, Tuple
 
-import editdistance
+import numpy as np
 
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics import pairwise_distances
 #Detect whether to use the advanced image mapping techiques or not
 try:
     from sentence_transformers import SentenceTransformer
@@ -19,6 +17,10 @@ except:
     HAS_TRANSFORMERS=False
 
 from outputs.fvtt.types import CompendiumTypes
+from outputs.fvtt.compendium_index import CompendiumIndex, get_compendium_index, index_path
+from utils.bk_tree import BKTree
+from utils.cache import LRUCache
+from utils.copy_on_write import copy_on_write
 
 
 class TfidfIconSimilarity():
@@ -31,121 +33,158 @@ class TfidfIconSimilarity():
         self.ip_index = ip
         self.vm = self.tfv.fit_transform(ip)
 
+    def get_match_batch(self, queries: List[str]) -> List[str]:
+        '''Returns the closest image name for each query. Tfidf rows are L2 normalised so cosine similarity is a dot product'''
+        scores = self.tfv.transform(queries) @ self.vm.T
+        best = np.asarray(scores.argmax(axis=1)).ravel()
+        return [self.ip_index[i] for i in best]
+
     def get_match(self, q):
-        vec = self.tfv.transform(q)
-        dists = pairwise_distances(vec.reshape(1, -1), self.vm, metric="cosine")
-        return self.ip_index[dists.argmin()]
+        return self.get_match_batch([q])[0]
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    '''Indices of the k highest scores, best first'''
+    k = min(k, len(scores))
+    best = np.argpartition(-scores, k-1)[:k]
+    return best[np.argsort(-scores[best])]
 
 class TransformerIconSimilarity():
 
-    def __init__(self):
-        self.model = SentenceTransformer('all-MiniLM-L12-v2')
+    MODEL_NAME = 'all-MiniLM-L12-v2'
 
-    def fit(self, ip):
+    ### Number of queries scored against the image matrix at once
+    QUERY_CHUNK = 512
+
+    def __init__(self, cache_dir: Optional[str]=None, model_name: str=MODEL_NAME):
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.__model = None
+
+    @property
+    def model(self):
+        '''The sentence transformer, only loaded the first time something needs encoding'''
+        if self.__model is None:
+            self.__model = SentenceTransformer(self.model_name)
+        return self.__model
+
+    def __embedding_path(self, key: str) -> str:
+        slug = re.sub("[^a-zA-Z0-9_-]", "_", self.model_name)
+        return os.path.join(self.cache_dir, f"icon_embeddings_{slug}_{key[:16]}.npy")
+
+    def fit(self, ip, key: Optional[str]=None):
+        '''Encode the image names. If a key (the compendium hash) is given the L2 normalised matrix is saved and
+        memory mapped on later runs instead of being re-encoded'''
         self.ip_index = ip
-        self.vm = self.model.encode(ip)
+        path = self.__embedding_path(key) if key and self.cache_dir else None
+
+        if path and os.path.exists(path):
+            vm = np.load(path, mmap_mode='r')
+            if vm.shape[0] == len(ip):
+                self.vm = vm
+                return
+
+        vm = np.asarray(self.model.encode(ip, normalize_embeddings=True), dtype=np.float32)
+        if path is None:
+            self.vm = vm
+            return
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        with open(path + ".tmp", 'wb') as f:
+            np.save(f, vm)
+        os.replace(path + ".tmp", path)
+        self.vm = np.load(path, mmap_mode='r')
+
+    def get_matches(self, q, k: int=1) -> List[str]:
+        '''Returns the k closest image names by cosine similarity'''
+        vec = self.model.encode([q], normalize_embeddings=True)[0]
+        scores = self.vm @ vec
+        return [self.ip_index[i] for i in top_k(scores, k)]
+
+    def get_match_batch(self, queries: List[str]) -> List[str]:
+        '''Returns the closest image name for each query, encoding all the queries in one call'''
+        vecs = np.asarray(self.model.encode(queries, normalize_embeddings=True), dtype=np.float32)
+        matches = []
+        for i in range(0, len(queries), TransformerIconSimilarity.QUERY_CHUNK):
+            scores = vecs[i:i+TransformerIconSimilarity.QUERY_CHUNK] @ self.vm.T
+            matches += [self.ip_index[j] for j in scores.argmax(axis=1)]
+        return matches
 
     def get_match(self, q):
-        vec = self.model.encode(q)
-        dists = pairwise_distances(vec.reshape(1, -1), self.vm, metric="cosine")
-        return self.ip_index[dists.argmin()]
+        return self.get_match_batch([q])[0]
 
 class CompendiumLoader(object):
 
     def __format_name(self, s):
-        return s.lower()#.replace(" ","")
+        return CompendiumIndex.format_name(s)
 
     def __format_image_name(self, s):
-        return " ".join([s.strip() for s in s.lower().split() if s])
-
-    def load_compendium(self, data):
-        if data["type"].lower() not in self.compendia:
-            self.compendia[data["type"].lower()] = {}
-        target = self.compendia[data["type"].lower()]
-        for item in data["items"]:
-            target[self.__format_name(item["name"])] = item
-
-    def __merge_dicts(self, d1, d2):
-        for k in d2:
-            if k in d1:
-                for n in d2[k]:
-                    if n in d1[k]:
-                        d1[k][n] += d2[k][n]
-                    else:
-                        d1[k][n] = d2[k][n]
-            else:
-                d1[k] = d2[k]
-
-    def __get_images(self, data):
-        images = {}
-        if isinstance(data, dict):
-            if "name" in data and "img" in data:
-                name = data["name"]
-                img = data["img"]
-                if "tokens" not in img and "mystery-man" not in img:
-                    name = self.__format_image_name(name)
-                    images[name] = {data["img"]:1}
-
-            for k in data:
-                if k == "name" or k == "img":
-                    continue
-
-                self.__merge_dicts(images, self.__get_images(data[k]))
-
-        elif isinstance(data, list):
-            for entry in data:
-                self.__merge_dicts(images, self.__get_images(entry))
-
-        return images
-
-    def to_map(self, images):
-        data = {}
-        for k in images:
-            path = max(images[k].items(), key=lambda x: x[1])[0]
-            data[k] = path
-
-        return data
+        return CompendiumIndex.format_image_name(s)
 
     def __init__(self, config: ConfigParser, logger: Logger):
         self.config = config
         self.logger = logger.getChild("fvtt_cmp_loader")
 
-        compendiums = []
-        compendium_dir = self.config.get("foundry", "compendium-dir", fallback="./foundry")
-        for f in os.listdir(compendium_dir):
-            if ".json" not in f:
-                continue
-            compendiums.append(os.path.join(compendium_dir, f))
-        for f in self.config.get("foundry", "compendia", fallback="").split(","):
-            if f != "":
-                compendiums.append(f)
-
-        self.compendia = {}
-        for c in compendiums:
-            self.logger.info(f"Loading compendium {c}")
-            with open(c, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                self.load_compendium(data)
-
-        for c in self.compendia:
-            self.logger.info(f"Processing {len(self.compendia[c])} entries of type {c}")
-
-        self.image_paths = self.to_map(self.__get_images(self.compendia[CompendiumTypes.Item.name.lower()]))
-        self.actor_image_paths = self.to_map(self.__get_images(self.compendia[CompendiumTypes.Actor.name.lower()]))
+        self.index = get_compendium_index(config, logger)
+        self.compendia = self.index.compendia
+        self.image_paths = self.index.image_paths
+        self.actor_image_paths = self.index.actor_image_paths
 
         self.logger.info(f"Loaded {len(self.image_paths)} entries of type 'item'")
         self.logger.info(f"Loaded {len(self.actor_image_paths)} entries of type 'actor'")
 
-        ### Backup image guesser that choose an image based on sentence similarity
-        if HAS_TRANSFORMERS and self.config.getboolean("foundry", "advanced-image-search", fallback=True):
-            self.logger.debug("Found transformer package. Configuring advanced image search")
-            self.image_guesser = TransformerIconSimilarity()
-        else:
-            self.logger.debug("No transformer package or disabled in config. Using basic image search")
-            self.image_guesser = TfidfVectorizer()
-        self.image_guesser.fit(list(self.image_paths.keys()))
-        self.logger.info("Setup image search model")
+        ### Backup image guesser, set up the first time an image has to be guessed
+        self.__image_guesser = None
+        self.__image_guesser_lock = threading.Lock()
+
+        ### Raw title -> guessed image path
+        self.guessed_images = {}
+        # Titles guessed since the counters were last reset
+        self.added_guesses = set()
+
+        ### Titles like 'Multiattack' or 'Bite' repeat across hundreds of creatures so remember recent lookups. Queries
+        ### store the name of the matching entry rather than the entry, so the cache is cheap to send to workers
+        self.image_cache = LRUCache(self.config.getint("foundry", "image-cache-size", fallback=4096))
+        self.query_cache = LRUCache(self.config.getint("foundry", "query-cache-size", fallback=4096))
+
+        ### Compendium type -> first letter -> BK-tree of names, built the first time a fuzzy search is needed
+        self.name_trees = {}
+
+    @property
+    def image_guesser(self):
+        '''Chooses an image for a name without an exact match based on sentence similarity'''
+        with self.__image_guesser_lock:
+            if self.__image_guesser is None:
+                if HAS_TRANSFORMERS and self.config.getboolean("foundry", "advanced-image-search", fallback=True):
+                    self.logger.debug("Found transformer package. Configuring advanced image search")
+                    guesser = TransformerIconSimilarity(cache_dir=os.path.dirname(index_path(self.config)))
+                    guesser.fit(list(self.image_paths.keys()), key=self.index.hash)
+                else:
+                    self.logger.debug("No transformer package or disabled in config. Using basic image search")
+                    guesser = TfidfIconSimilarity()
+                    guesser.fit(list(self.image_paths.keys()))
+                self.logger.info("Setup image search model")
+                self.__image_guesser = guesser
+        return self.__image_guesser
+
+    def prefetch_queries(self, queries: List[Tuple[CompendiumTypes, str, int]]):
+        '''Resolve (type, name, distance threshold) compendium queries ahead of time, so conversion workers are handed
+        the matches instead of each building the fuzzy search trees'''
+        for type, name, distance_threshold in queries:
+            self.__resolve(type.name.lower(), name, distance_threshold)
+
+    def __resolve(self, target_type: str, name: str, distance_threshold: int) -> Optional[str]:
+        '''Name of the entry a query matches, through the query cache'''
+        if target_type not in self.compendia:
+            return None
 
+        n = self.__format_name(name)
+        key = (target_type, n, distance_threshold)
+        found, match = self.query_cache.get(key)
+        if not found:
+            match = self.__find_compendium_entry(target_type, n, distance_threshold)
+            self.query_cache.put(key, match)
+        return match
 
     def query_compendium(self, type: CompendiumTypes, name: str, distance_threshold: int=0) -> Optional[Any]:
         '''
@@ -153,48 +192,42 @@ class CompendiumLoader(object):
         type: A foundry compendium type (e.g. Actor or Item)
         name: The name of the item you're looking for
         fuzzy_threshold: If greater than zero, the maximum edit distance away to accept if an exact match is not found (default=0)
-        returns: Json blob of the item or None
+        returns: Copy-on-write view of the item (the shared compendium entry is never modified) or None
         '''
         target_type = type.name.lower()
-        if target_type not in self.compendia:
-            return None
+        match = self.__resolve(target_type, name, distance_threshold)
+        return copy_on_write(self.compendia[target_type][match]) if match is not None else None
 
-        n = self.__format_name(name)
+    def __find_compendium_entry(self, target_type: str, n: str, distance_threshold: int) -> Optional[str]:
+        '''Exact then fuzzy search for a formatted name, returns the name of the matching entry'''
         if n in self.compendia[target_type]:
-            return deepcopy(self.compendia[target_type][n])
+            return n
 
-        ###If we haven't found anything, do edit distance
-        best=None
-        best_dist = 1000000
-        for k in self.compendia[target_type].keys():
-            if k[0] != n[0]:
-                continue
-            dist = editdistance.eval(n, k)
-            if dist < best_dist:
-                best = k
-                best_dist = dist
-
-        if best_dist <= distance_threshold:
-            self.logger.debug(f"Found best fuzzy match for '{n}: '{best}', distance={best_dist}")
-            return deepcopy(self.compendia[target_type][best])
-        else:
+        if distance_threshold <= 0 or len(n) == 0:
             return None
 
-    def query_compendium_image(self, name: str, remove_brackets=True, type='item') -> Optional[str]:
-        '''
-        Looks for an existing compendium entry with the same name to take an image from
-        name: Name of the item you wish to search for. This currently trys to find an exact match
-        type: Can be either 'item' or 'actor'
-        '''
+        ###If we haven't found anything, find the closest name within the edit distance that shares a first letter
+        if target_type not in self.name_trees:
+            self.name_trees[target_type] = BKTree.by_first_letter(self.compendia[target_type].keys())
+
+        tree = self.name_trees[target_type].get(n[0])
+        matches = tree.query(n, distance_threshold) if tree is not None else []
+        if len(matches) == 0:
+            return None
 
+        dist, _, best = matches[0]
+        self.logger.debug(f"Found best fuzzy match for '{n}: '{best}', distance={dist}")
+        return best
+
+    def __image_paths(self, type: str) -> Optional[Any]:
         if type == 'item':
-            paths = self.image_paths
+            return self.image_paths
         elif type == 'actor':
-            paths = self.actor_image_paths
-        else:
-            self.logger.debug(f"Unknown compendium type '{type}'. Cannot do image search")
-            return None
+            return self.actor_image_paths
+        return None
 
+    def __find_image(self, name: str, paths: Any, remove_brackets: bool=True) -> Optional[str]:
+        '''Look for an exact match, optionally ignoring anything in brackets'''
         ### Try full name first
         n = self.__format_image_name(name)
         if n in paths:
@@ -203,13 +236,100 @@ class CompendiumLoader(object):
 
         ### Try after removing brackets
         if remove_brackets and "(" in n:
-            n = n.split("(")[0]
+            n = n.split("(")[0].strip()
 
         if n in paths:
             self.logger.debug(f"Found matching ability for {name}")
             return paths[n]
+        return None
+
+    def prefetch_images(self, queries: List[Tuple[str, str]], remove_brackets=True):
+        '''
+        Guess images for every (name, type) query without an exact match in a single batch, so the image search
+        model is only loaded and run once. Later calls to query_compendium_image use the stored guesses.
+        '''
+        unresolved = []
+        seen = set()
+        for name, type in queries:
+            paths = self.__image_paths(type)
+            if paths is None or name in seen or name in self.guessed_images:
+                continue
+            seen.add(name)
+            if self.__find_image(name, paths, remove_brackets) is None:
+                unresolved.append(name)
+
+        if len(unresolved) == 0:
+            return
+
+        self.logger.debug(f"Guessing images for {len(unresolved)} titles")
+        for name, backup_feature in zip(unresolved, self.image_guesser.get_match_batch(unresolved)):
+            self.logger.debug(f"Guessing '{backup_feature}' as image for '{name}'")
+            self.guessed_images[name] = self.image_paths[backup_feature]
+            self.added_guesses.add(name)
+
+    def query_compendium_image(self, name: str, remove_brackets=True, type='item') -> Optional[str]:
+        '''
+        Looks for an existing compendium entry with the same name to take an image from
+        name: Name of the item you wish to search for. This currently trys to find an exact match
+        type: Can be either 'item' or 'actor'
+        '''
+
+        paths = self.__image_paths(type)
+        if paths is None:
+            self.logger.debug(f"Unknown compendium type '{type}'. Cannot do image search")
+            return None
+
+        key = (self.__format_image_name(name), type, remove_brackets)
+        found, path = self.image_cache.get(key)
+        if not found:
+            path = self.__lookup_image(name, paths, remove_brackets)
+            self.image_cache.put(key, path)
+        return path
+
+    def __lookup_image(self, name: str, paths: Any, remove_brackets: bool) -> str:
+        '''Exact match, falling back to a guessed image'''
+        path = self.__find_image(name, paths, remove_brackets)
+        if path is not None:
+            return path
 
         ### If we dont have a path yet, use backup image search
-        backup_feature = self.image_guesser.get_match(name)
-        self.logger.debug(f"Guessing '{backup_feature}' as image for '{name}'")
-        return self.image_paths[backup_feature]
+        if name not in self.guessed_images:
+            backup_feature = self.image_guesser.get_match(name)
+            self.logger.debug(f"Guessing '{backup_feature}' as image for '{name}'")
+            self.guessed_images[name] = self.image_paths[backup_feature]
+            self.added_guesses.add(name)
+        return self.guessed_images[name]
+
+    def cache_snapshot(self, added_only: bool=False) -> Any:
+        '''Export the lookup caches so they can be shared with (or collected from) worker processes. With added_only
+        only the lookups made since the counters were reset are exported'''
+        guessed = {n: self.guessed_images[n] for n in self.added_guesses} if added_only else dict(self.guessed_images)
+        return {"image": self.image_cache.snapshot(added_only), "query": self.query_cache.snapshot(added_only), "guessed": guessed}
+
+    def merge_cache_snapshot(self, snapshot: Any, counters: bool=True):
+        '''Add lookups made by another process'''
+        self.image_cache.merge(snapshot["image"], counters)
+        self.query_cache.merge(snapshot["query"], counters)
+        self.guessed_images.update(snapshot["guessed"])
+
+    def reset_cache_stats(self):
+        '''Zero the hit and miss counters, keeping the cached lookups'''
+        for cache in [self.image_cache, self.query_cache]:
+            cache.reset_stats()
+        self.added_guesses = set()
+
+    def cache_stats(self) -> List[str]:
+        '''Hit/miss summary of the lookup caches'''
+        return [f"Compendium image lookups: {self.image_cache.stats()}",
+                f"Compendium queries: {self.query_cache.stats()}"]
+
+_shared_loader = None
+_shared_loader_lock = threading.Lock()
+
+def get_compendium_loader(config: ConfigParser, logger: Logger) -> CompendiumLoader:
+    '''Returns a compendium loader shared by every converter in the process, creating it on first use'''
+    global _shared_loader
+    with _shared_loader_lock:
+        if _shared_loader is None:
+            _shared_loader = CompendiumLoader(config, logger)
+    return _shared_loader
@@ -1,5 +1,5 @@
+import hashlib
 import os
-import random
 
 from math import floor
 import string
@@ -10,13 +10,14 @@ from logging import Logger
 from extractor.creature_schema import ActionSchema, SpellLevelSchema, SpellSchema, SpellcastingSchema
 
 from outputs.fvtt.types import CompendiumTypes
-from outputs.fvtt.compendium_loader import CompendiumLoader
+from outputs.fvtt.compendium_loader import get_compendium_loader
 
 from extractor.creature import Creature
+from extractor.dice_expression import try_compile_formula
 
 import utils.text_format as fmt
 
-from typing import Any
+from typing import Any, List, Optional
 
 class FVTTConverter(object):
 
@@ -112,12 +113,28 @@ class FVTTConverter(object):
 
     __IDCHARS = string.ascii_letters + "0123456789"
 
-    def __generate_id(self):
-        return "".join([random.choice(FVTTConverter.__IDCHARS) for i in range(16)])
+    ### Edit distance accepted when a spell has no exact match in the compendia
+    SPELL_DISTANCE = 2
+
+    @staticmethod
+    def generate_id(*parts: Any) -> str:
+        '''Foundry style 16 character id derived from a hash of the parts, so re-exports of the same data get the same ids'''
+        value = int(hashlib.sha1("\x1f".join(str(p) for p in parts).encode("utf8")).hexdigest(), 16)
+        chars = []
+        for i in range(16):
+            value, c = divmod(value, len(FVTTConverter.__IDCHARS))
+            chars.append(FVTTConverter.__IDCHARS[c])
+        return "".join(chars)
+
+    @staticmethod
+    def __formula(formula: str) -> str:
+        '''Normalise a dice formula for Foundry's roller, leaving it untouched if it can't be parsed'''
+        expr = try_compile_formula(formula)
+        return expr.text if expr is not None else formula
 
     def __make_feature(self, title: str, description: str, get_image: bool=True):
         return  {
-        "_id": self.__generate_id(),
+        "_id": None,
         "name": title,
         "type": "feat",
         "img": self.cl.query_compendium_image(title, type='actor'),
@@ -151,7 +168,7 @@ class FVTTConverter(object):
 
     def __make_spell(self, spell: SpellSchema):
         return  {
-          "_id": "1VqHo34RfZWxXk7R",
+          "_id": None,
           "name": spell["name"],
           "type": "spell",
           "img": self.cl.query_compendium_image(spell["name"]),
@@ -181,7 +198,7 @@ class FVTTConverter(object):
     def __make_action(self, action: ActionSchema, current_data: Any):
 
         core_data =   {
-          "_id": self.__generate_id(),
+          "_id": None,
           "name": action["title"],
           "type": "feat",
           "img": self.cl.query_compendium_image(action["title"]),
@@ -260,12 +277,12 @@ class FVTTConverter(object):
             ### Apply damage formula
             if "damage" in action_data:
                 core_data["data"]["damage"] = {
-                    "parts": [[action_data["damage"]["damage"]["formula"], action_data["damage"]["type"]]]
+                    "parts": [[self.__formula(action_data["damage"]["damage"]["formula"]), action_data["damage"]["type"]]]
                 }
 
             ### Add versatile damage
             if "versatile" in action_data:
-                core_data["data"]["damage"]["versatile"] = action_data["versatile"]["damage"]["formula"]
+                core_data["data"]["damage"]["versatile"] = self.__formula(action_data["versatile"]["damage"]["formula"])
                 core_data["data"]["properties"]["ver"] = True
 
             ### Handle effects. Note Foundry only supports a single save-based effect!
@@ -280,19 +297,19 @@ class FVTTConverter(object):
                         }  
                         if "damage" in effect:
                             for dmg in effect["damage"]:
-                                core_data["data"]["formula"] = f'{dmg["damage"]["formula"]}[{dmg["type"]}]'
+                                core_data["data"]["formula"] = f'{self.__formula(dmg["damage"]["formula"])}[{dmg["type"]}]'
                     else:
                         #Handle non-save related damage
                         if "damage" in effect:
                             for dmg in effect["damage"]:
-                                core_data["data"]["damage"]["parts"].append([dmg["damage"]["formula"],dmg["type"]])
+                                core_data["data"]["damage"]["parts"].append([self.__formula(dmg["damage"]["formula"]),dmg["type"]])
 
         if "effects" in action:
             effect_data = action["effects"]
             for effect in effect_data:
                     if "damage" in effect:
                         for dmg in effect["damage"]:
-                            core_data["data"]["formula"] = f'{dmg["damage"]["formula"]}[{dmg["type"]}]'
+                            core_data["data"]["formula"] = f'{self.__formula(dmg["damage"]["formula"])}[{dmg["type"]}]'
 
                     #Only add first save since that's probably the most important
                     if "save" in effect:
@@ -311,7 +328,7 @@ class FVTTConverter(object):
     def __init__(self, config: ConfigParser, logger: Logger):
         self.config = config
         self.logger = logger.getChild("fvtt_conv")
-        self.cl = CompendiumLoader(config, logger)
+        self.cl = get_compendium_loader(config, logger)
 
     def __handle_dr(self, values, enums):
         custom = []
@@ -327,13 +344,39 @@ class FVTTConverter(object):
                         custom.append(d)
         return {"value":dis, "custom":",".join(custom)}
 
-    def convert_creature(self, creature: Creature) -> Any:
-        '''Converts a creature from the default format to the FoundryVTT Actor format'''
+    def prefetch(self, creatures: List[Creature]):
+        '''Collect every feature, action and spell title for a batch of creatures so images without an exact match
+        can be guessed in one go, and look up their spells'''
+        queries = []
+        spells = []
+        for creature in creatures:
+            cr = creature.data
+            for f in cr.get("features", []):
+                queries.append((f["title"], 'actor'))
+            for sc in cr.get("spellcasting", []):
+                queries.append((sc["title"], 'actor'))
+                for level in sc["levels"]:
+                    for spell in level["spells"]:
+                        queries.append((spell["name"], 'item'))
+                        spells.append((CompendiumTypes.Item, spell["name"], FVTTConverter.SPELL_DISTANCE))
+            for action_type in ["action", "bonus", "reaction", "legendary"]:
+                for action in cr.get(action_type, []):
+                    queries.append((action["title"], 'item'))
+        self.cl.prefetch_images(queries)
+        self.cl.prefetch_queries(spells)
+
+    def convert_creature(self, creature: Creature, key: Optional[str]=None) -> Any:
+        '''Converts a creature from the default format to the FoundryVTT Actor format. The ids are made from key, a name
+        unique within the source (see creature_keys), so creatures sharing a name don't share ids'''
 
         new_creature = {}
         cr = creature.data
+        source = cr["source"]["title"] if "source" in cr else ""
+
+        key = key if key else cr["name"]
 
         #### Header ####
+        new_creature["_id"] = FVTTConverter.generate_id(source, key)
         new_creature["name"] = cr["name"]
         new_creature["type"] = "npc"
         new_creature["img"] = None#self.cl.query_compendium_image(cr["name"], type='actor')
@@ -360,16 +403,20 @@ class FVTTConverter(object):
 
         new_creature["items"] += self.actions(cr, data)
 
+        ### Item ids come from the item's place in the creature so unchanged creatures export identically
+        for i, item in enumerate(new_creature["items"]):
+            item["_id"] = FVTTConverter.generate_id(source, key, item["name"], i)
+
         new_creature['data'] = data
         return new_creature
 
     def ability_scores(self, data, current_state):
         conv = {}
-        if "abilities" not in data:
-            data["abilities"] = {}
+        ### Don't add missing keys to the creature, other writers may be reading it at the same time
+        abilities = data["abilities"] if "abilities" in data else {}
         for abs in constants.enum_values(constants.SHORT_ABILITIES):
-            if abs in data['abilities']:
-                ab_data = data['abilities'][abs]
+            if abs in abilities:
+                ab_data = abilities[abs]
             else:
                 ab_data = 10
             if "saves" in data and abs in data["saves"]:
@@ -606,7 +653,7 @@ class FVTTConverter(object):
 
             for level in sc["levels"]:
                 for spell in level["spells"]:
-                    resolved_spell = self.cl.query_compendium(CompendiumTypes.Item, spell["name"], distance_threshold=2)
+                    resolved_spell = self.cl.query_compendium(CompendiumTypes.Item, spell["name"], distance_threshold=FVTTConverter.SPELL_DISTANCE)
                     if resolved_spell is None:
                         self.logger.warning(f"Could not find spell {spell} in compendium")
                         resolved_spell = self.__make_spell(spell)
@@ -0,0 +1,67 @@
+import multiprocessing
+import traceback
+
+from concurrent.futures import ProcessPoolExecutor
+from configparser import ConfigParser
+from logging import Logger
+from typing import Any, List, Optional, Tuple
+
+from outputs.fvtt.converter import FVTTConverter
+
+### Converts creatures to Foundry actors in worker processes. The workers are spawned rather than forked: the writer
+### may be running on one of the extractor's writer threads and the sentence transformer may already have started its
+### own threads, and forking a process with live threads can leave the children waiting on locks nobody will release.
+### Each worker memory maps the compendium index file the parent has already saved to the cache (and the same icon
+### embeddings file), reading only the header and the entries it looks up, so the compendia are shared through the OS
+### page cache rather than copied into every worker. The parent prefetches image guesses and spell lookups for the
+### whole batch and hands the workers its lookup caches, which only hold names and image paths, so workers don't
+### need the image search model or the fuzzy search trees. Converted actors come back in input order along with only
+### the lookups each chunk added, which are merged into the parent's caches.
+
+# Converter of this worker process, created by _init_worker
+_worker_converter = None
+
+def _init_worker(config: ConfigParser, logger: Logger, level: int, snapshot: Any):
+    global _worker_converter
+    # The logger comes across by name only, keep the parent's level so the workers aren't noisier than it
+    logger.setLevel(level)
+    _worker_converter = FVTTConverter(config, logger)
+    _worker_converter.cl.merge_cache_snapshot(snapshot, counters=False)
+
+def _convert_chunk(start: int, creatures: List[Any], keys: List[str]) -> Tuple[int, List[Optional[Any]], List[Tuple[int, str]], Any]:
+    converter = _worker_converter
+    # Only report lookups made for this chunk, the parent already has the rest
+    converter.cl.reset_cache_stats()
+    actors = []
+    errors = []
+    for i, (creature, key) in enumerate(zip(creatures, keys)):
+        try:
+            actors.append(converter.convert_creature(creature, key))
+        except Exception:
+            actors.append(None)
+            errors.append((start + i, traceback.format_exc()))
+    return start, actors, errors, converter.cl.cache_snapshot(added_only=True)
+
+def convert_parallel(converter: FVTTConverter, creatures: List[Any], keys: List[str], workers: int, logger: Logger) -> List[Optional[Any]]:
+    '''Convert creatures with a pool of worker processes, returning the actors in the same order as the creatures.
+    Creatures that fail to convert are logged and returned as None'''
+    ### A few chunks per worker keeps them busy when some creatures take much longer than others
+    chunk_size = max(1, -(-len(creatures) // (workers * 4)))
+
+    actors = [None] * len(creatures)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker, initargs=(converter.config, logger, logger.getEffectiveLevel(), converter.cl.cache_snapshot())) as pool:
+        futures = [pool.submit(_convert_chunk, i, creatures[i:i + chunk_size], keys[i:i + chunk_size]) for i in range(0, len(creatures), chunk_size)]
+        for future in futures:
+            try:
+                start, converted, errors, snapshot = future.result()
+            except Exception:
+                ### The worker died (or the chunk couldn't be sent), its creatures are left as None
+                logger.exception("Conversion worker failed")
+                continue
+            actors[start:start + len(converted)] = converted
+            converter.cl.merge_cache_snapshot(snapshot)
+            for index, error in errors:
+                logger.error(f"Error converting {creatures[index].data['name']}:\n{error.rstrip()}")
+
+    return actors
@@ -5,18 +5,22 @@ import string
 
 from configparser import ConfigParser
 from logging import Logger
-from typing import Any, List
+from typing import Any, List, Optional
 
 from extractor import constants
 from utils.datatypes import Source
 from utils.interacter import get_input
 from outputs.writer_interface import WriterInterface
+from outputs.line_store import append_lines, latest_records, read_lines, storage_mode, with_extension
+from outputs.output_manifest import OutputManifest, creature_keys, incremental_enabled, prune_enabled, summarise
 
 from outputs.fvtt.converter import FVTTConverter
+from outputs.fvtt.compendium_loader import get_compendium_loader
+from outputs.fvtt.parallel_converter import convert_parallel
 from outputs.fvtt.types import CompendiumTypes
 
 from enum import Enum, auto
-import traceback
+from collections import Counter
 
 def int_to_add_string(i: int):
     if i >= 0:
@@ -35,6 +39,12 @@ class FVTTWriter(WriterInterface):
         self.SYSTEMVERSION='1.5.7'
         self.SYSTEM='dnd5e'
 
+        self.used_converter = False
+        self.storage = storage_mode(config)
+        self.incremental = incremental_enabled(config)
+        self.prune = prune_enabled(config)
+        self.incremental_counts = Counter()
+
     @staticmethod
     def get_long_name() -> str:
         '''Returns a human readable name for this output writer'''
@@ -50,6 +60,16 @@ class FVTTWriter(WriterInterface):
         '''Returns the output filetype of this writer'''
         return "json"
 
+    @staticmethod
+    def get_line_filetype() -> str:
+        '''Returns the filetype used when writing one actor per line, the same layout as a Foundry NeDB pack'''
+        return "db"
+
+    @staticmethod
+    def pack_header_filename(filename: str) -> str:
+        '''Returns where the pack metadata for a line file is kept, the line file itself only holds actors'''
+        return filename + ".pack.json"
+
     def create_compendium_pack(self, label: str, entity: CompendiumTypes=CompendiumTypes.Actor, root: str='p2v', package: str=None):
 
         if package == None:
@@ -114,6 +134,18 @@ class FVTTWriter(WriterInterface):
         name = name[0].upper() + name[1:]
         return name
 
+    def prepare(self, creatures: List[Any]):
+        '''Load the shared compendium loader before the writers start so it is only built once'''
+        if len(creatures) > 0:
+            get_compendium_loader(self.config, self.logger)
+
+    def summary(self) -> List[str]:
+        '''Returns lines describing the work done by this writer, printed at the end of a run'''
+        lines = summarise(self.incremental_counts)
+        if self.used_converter:
+            lines += get_compendium_loader(self.config, self.logger).cache_stats()
+        return lines
+
     def write(self, filename: str, source: Source, creatures: List[Any], append: bool=None) -> bool:
         '''Writes the creatures to the specified file. If append is set to true, creatures will be inserted into the existing file. Returns True if write is successful'''
 
@@ -122,7 +154,9 @@ class FVTTWriter(WriterInterface):
             append = self.append
 
         ### Ensure we're writing something with the correct filetype
-        if not filename.endswith(FVTTWriter.get_filetype()):
+        if self.storage == "lines":
+            filename = with_extension(filename, FVTTWriter.get_line_filetype())
+        elif not filename.endswith(FVTTWriter.get_filetype()):
             if len(filename.split(".")) > 1:
                 filename = ".".join(filename.split(".")[:-1])
             filename += "." + FVTTWriter.get_filetype()
@@ -155,47 +189,98 @@ class FVTTWriter(WriterInterface):
             label = source.name
 
 
+        if self.storage == "lines":
+            ### Only the new actors are written, the pack metadata is kept next to the line file
+            items = [cr for cr in self.__convert_creatures(creatures, creature_keys(creatures)) if cr is not None]
+            if make_file:
+                with open(FVTTWriter.pack_header_filename(filename), 'w', encoding='utf-8') as f:
+                    json.dump(self.create_compendium_pack(label), f, indent=2)
+            append_lines(filename, items, append=not make_file)
+            return True
+
+        manifest = None
+        if self.incremental:
+            manifest = OutputManifest(filename, FVTTWriter.get_name(), self.logger)
+
         data = None
         if make_file:
             data = self.create_compendium_pack(label)
         else:
             with open(filename, 'r') as f:
                 data = json.load(f)
-        
+
+        if manifest is not None:
+            ### Actors from the previous file can still be reused when it is being replaced
+            previous = data['items']
+            if make_file and manifest.valid and os.path.isfile(filename):
+                with open(filename, 'r') as f:
+                    previous = json.load(f)['items']
+            manifest.attach(previous, replace=make_file)
+            data['items'] = manifest.update(data['items'], label, creatures, self.__convert_creatures, context=self.__context(), prune=self.prune)
+        else:
+            data['items'] += [cr for cr in self.__convert_creatures(creatures, creature_keys(creatures)) if cr is not None]
+
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+
+        if manifest is not None:
+            manifest.save()
+            self.incremental_counts.update(manifest.counts)
+
+        return True
+
+    def __convert_creatures(self, creatures: List[Any], keys: List[str]) -> List[Optional[Any]]:
+        '''Convert creatures to Foundry actors, failed conversions are returned as None. Keys are the creature_keys of
+        the creatures within their source, which the actor ids are made from'''
+        items = []
+        if len(creatures) == 0:
+            return items
+
         converter = FVTTConverter(self.config, self.logger)
-        for creature in creatures:
+        self.used_converter = True
+        converter.prefetch(creatures)
+
+        workers = self.config.getint("foundry", "workers", fallback=1)
+        if workers > 1 and len(creatures) > 1:
+            self.logger.debug(f"Converting {len(creatures)} creatures with {workers} workers")
             try:
-                cr = converter.convert_creature(creature)
-            except Exception as e:
-                traceback.print_exc()
-                exit(e)
+                items = convert_parallel(converter, creatures, keys, workers, self.logger)
+            except Exception:
+                self.logger.exception("Failed to start conversion workers")
+                items = [None] * len(creatures)
+        else:
+            for creature, key in zip(creatures, keys):
+                try:
+                    items.append(converter.convert_creature(creature, key))
+                except Exception:
+                    self.logger.exception("Error converting {}".format(creature.data['name']))
+                    items.append(None)
+
+        for creature, cr in zip(creatures, items):
             if cr is None: 
-                self.logger.error("Failed to convert {}".format(creature['name']))
-                continue
-            #     # cr["source"] = source_meta["json"]
-            # except Exception as e:
-            #     self.logger.error(f"Failed to convert creature {creature['name']}")
-            #     self.logger.error(f"Error: {e}")
-            #     continue
-
-            data['items'].append(cr)
-
-        #     ### Replace monsters with the same name from the same source
-        #     replaced=False
-        #     for i,monster in enumerate(data["monster"]):
-        #         if monster["name"] == cr["name"] and monster["source"] == source_meta["json"]:
-        #             data["monster"][i] = cr
-        #             replaced = True
-        #             break
-            
-        #     if not replaced:
-        #         data["monster"].append(cr)
-
-        # if make_file:
-        #     data["_meta"]["dateAdded"] = int(time.time())
-        # data["_meta"]["dateLastModified"] = int(time.time())
+                self.logger.error("Failed to convert {}".format(creature.data['name']))
 
-        with open(filename, 'w', encoding='utf-8') as f:
+        return items
+
+    def __context(self) -> str:
+        '''Everything besides the creature itself that changes the converted actors, used by incremental writes'''
+        loader = get_compendium_loader(self.config, self.logger)
+        return f"{self.COREVERSION}:{self.SYSTEMVERSION}:{loader.index.hash}:{type(loader.image_guesser).__name__}"
+
+    def compact(self, filename: str, out_filename: str) -> bool:
+        '''Combine a line file written in lines storage mode into a single compendium pack JSON file'''
+        header_filename = FVTTWriter.pack_header_filename(filename)
+        if os.path.exists(header_filename):
+            with open(header_filename, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        else:
+            self.logger.warning(f"No pack metadata found for {filename}, using the filename as the label")
+            data = self.create_compendium_pack(self.__prettify_name(os.path.basename(filename).split(".")[0]))
+
+        ### Re-running a source appends its actors again with the same ids, only the last copy is kept
+        data["items"] = latest_records(read_lines(filename), lambda a: a["_id"])
+
+        with open(out_filename, 'w', encoding='utf-8') as f:
             json.dump(data, f, indent=2)
 
         return True
@@ -0,0 +1,46 @@
+import json
+import os
+
+from typing import Any, Callable, Hashable, Iterable, Iterator, List
+
+### Append-friendly storage shared by the writers. Each entity is written as one compact JSON document per line
+### (JSON Lines, the same layout as a Foundry NeDB pack), so adding creatures to a large file only costs the size of
+### the new creatures. Writers provide a compaction step to turn a line file back into their aggregated JSON format.
+
+STORAGE_MODES = ["json", "lines"]
+
+def storage_mode(config) -> str:
+    '''Returns the configured output storage mode, either 'json' or 'lines\''''
+    mode = config.get("output", "storage", fallback="json")
+    return mode if mode in STORAGE_MODES else "json"
+
+def with_extension(filename: str, extension: str) -> str:
+    '''Replace the extension of a filename'''
+    if filename.endswith("." + extension):
+        return filename
+    if len(os.path.basename(filename).split(".")) > 1:
+        filename = ".".join(filename.split(".")[:-1])
+    return filename + "." + extension
+
+def append_lines(filename: str, records: List[Any], append: bool=True):
+    '''Write each record as a line of compact JSON, appending unless told otherwise'''
+    with open(filename, 'a' if append else 'w', encoding='utf-8') as f:
+        for r in records:
+            f.write(json.dumps(r, separators=(",", ":")))
+            f.write("\n")
+
+def read_lines(filename: str) -> Iterator[Any]:
+    '''Yield each record from a line file, skipping blank lines'''
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def latest_records(records: Iterable[Any], key: Callable[[Any], Hashable]) -> List[Any]:
+    '''Collapse records written more than once to the last one written, as a NeDB pack does for an _id. Each record
+    keeps the position of its first write, matching the in place replacement of json storage'''
+    latest = {}
+    for r in records:
+        latest[key(r)] = r
+    return list(latest.values())
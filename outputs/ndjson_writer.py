@@ -0,0 +1,85 @@
+import json
+import sys
+
+from configparser import ConfigParser
+from logging import Logger
+from typing import Any, List, TextIO
+
+from utils.datatypes import Source
+from outputs.writer_interface import WriterInterface
+
+class NdjsonWriter(WriterInterface):
+    '''Stream creatures as newline delimited JSON, one compact creature per line, to stdout or a named pipe'''
+
+    def __init__(self, config: ConfigParser, logger: Logger, append: bool=False):
+        self.logger = logger.getChild("ndjson_out")
+        self.config = config
+        self.append = append
+
+        # '-' is stdout, anything else is opened for writing (e.g. a FIFO)
+        self.target = config.get("output", "ndjson-target", fallback="-")
+        self.stream = None
+        self.written = set()
+        self.closed = False
+        self.count = 0
+
+    @staticmethod
+    def get_long_name() -> str:
+        '''Returns a human readable name for this output writer'''
+        return "Newline Delimited JSON Stream"
+
+    @staticmethod
+    def get_name() -> str:
+        '''Returns an internal name for this output writer'''
+        return "ndjson"
+
+    @staticmethod
+    def get_filetype() -> str:
+        '''Returns the output filetype of this writer'''
+        return "ndjson"
+
+    def uses_stdout(self) -> bool:
+        '''True if records are written to stdout, so nothing else should be printed there'''
+        return self.target == "-"
+
+    def __get_stream(self) -> TextIO:
+        if self.stream is None:
+            if self.uses_stdout():
+                self.stream = sys.stdout
+            else:
+                # Opening a FIFO blocks until a reader connects
+                self.stream = open(self.target, 'a' if self.append else 'w', encoding='utf-8')
+        return self.stream
+
+    def write_creature(self, source: Source, creature: Any):
+        '''Emit a single creature as soon as it has been parsed. Each record is flushed so readers see it straight away'''
+        if self.closed or id(creature) in self.written:
+            return
+        self.written.add(id(creature))
+
+        try:
+            stream = self.__get_stream()
+            stream.write(json.dumps(creature.to_json(), separators=(",", ":")))
+            stream.write("\n")
+            stream.flush()
+            self.count += 1
+        except BrokenPipeError:
+            self.logger.warning("NDJSON reader closed the stream, no more creatures will be written")
+            self.closed = True
+
+    def write(self, filename: str, source: Source, creatures: List[Any], append: bool=None) -> bool:
+        '''Emits any creatures that weren't already streamed while parsing. The filename is ignored, records go to the
+        configured ndjson target. Returns True if the stream is still open'''
+        for creature in creatures:
+            self.write_creature(source, creature)
+        return not self.closed
+
+    def close(self):
+        '''Close the target if it was opened by this writer'''
+        if self.stream is not None and not self.uses_stdout():
+            self.stream.close()
+        self.stream = None
+
+    def summary(self) -> List[str]:
+        '''Returns lines describing the work done by this writer, printed at the end of a run'''
+        return [f"Streamed {self.count} creatures as NDJSON"]
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+
+from collections import Counter
+from logging import Logger
+from typing import Any, Callable, List, Optional, Tuple
+
+### A manifest of content hashes is kept next to each output file so a re-run only converts and rewrites the
+### creatures that were added or changed. Entries line up one to one with the converted entries in the output file
+### and the manifest is only trusted while the output file is exactly as it was left (same size and modified time).
+
+def incremental_enabled(config) -> bool:
+    '''Returns true if writers should skip creatures that haven't changed since the last run'''
+    return config.getboolean("output", "incremental", fallback=True)
+
+def prune_enabled(config) -> bool:
+    '''Returns true if creatures missing from a re-run source should be removed from the output'''
+    return config.getboolean("output", "prune", fallback=False)
+
+def creature_hash(creature: Any, context: str="") -> str:
+    '''Stable hash of a creature's internal JSON and anything else the converted output depends on'''
+    sha = hashlib.sha1(context.encode("utf8"))
+    sha.update(json.dumps(creature, sort_keys=True, separators=(",", ":")).encode("utf8"))
+    return sha.hexdigest()
+
+def creature_keys(creatures: List[Any]) -> List[str]:
+    '''Names used to match creatures between runs, repeated names within a source get a counter'''
+    seen = Counter()
+    return [numbered_key(c.to_json()["name"], seen) for c in creatures]
+
+def numbered_key(name: str, seen: Counter) -> str:
+    '''Key for the next occurrence of a name, "Name", then "Name #2" and so on'''
+    seen[name] += 1
+    return name if seen[name] == 1 else f"{name} #{seen[name]}"
+
+def summarise(counts: Counter) -> List[str]:
+    '''Lines describing the work skipped by incremental writes'''
+    if sum(counts.values()) == 0:
+        return []
+    return [
+        f"Incremental output: skipped {counts['unchanged']} unchanged creatures, converted {counts['changed']} changed "
+        f"and {counts['added']} new creatures, removed {counts['removed']}"
+    ]
+
+class OutputManifest(object):
+    '''Content hashes of the creatures in an output file. Each entry is [source, key, hash], or None for an entry
+    that was in the file before it was tracked'''
+
+    VERSION = 1
+
+    def __init__(self, filename: str, writer: str, logger: Logger):
+        self.filename = filename
+        self.path = filename + ".hashes.json"
+        self.writer = writer
+        self.logger = logger.getChild("manifest")
+
+        self.entries = []
+        # Entries and items from the previous file when it is being replaced, kept so they can still be reused
+        self.previous = {}
+        self.counts = Counter()
+        self.valid = self.__load()
+
+    def __fingerprint(self) -> Optional[List[int]]:
+        if not os.path.exists(self.filename):
+            return None
+        stat = os.stat(self.filename)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def __load(self) -> bool:
+        '''Load the manifest, returns False if it is missing or the output file has changed since it was saved'''
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get("version") != OutputManifest.VERSION or data.get("writer") != self.writer:
+            return False
+        if data.get("file") != self.__fingerprint():
+            self.logger.info(f"{self.filename} has changed since it was written, converting every creature")
+            return False
+        self.entries = data["entries"]
+        return True
+
+    def attach(self, items: List[Any], replace: bool=False):
+        '''Line the manifest up with the entries already in the output file. If the file is being replaced the old
+        entries are only kept for reuse'''
+        if not self.valid or len(self.entries) != len(items):
+            self.entries = [None] * len(items)
+        if replace:
+            for item, entry in zip(items, self.entries):
+                if entry is not None:
+                    self.previous[(entry[0], entry[1])] = (item, entry[2])
+            self.entries = []
+
+    def update(self, items: List[Any], source: str, creatures: List[Any], convert: Callable[[List[Any], List[str]], List[Optional[Any]]],
+            context: str="", identify: Callable[[Any], Optional[Tuple[str, str]]]=None, prune: bool=False) -> List[Any]:
+        '''Add or replace the entries for a source, converting only the creatures that are new or have changed.
+        Entries of the source that aren't in creatures are kept unless prune is set. Untracked entries are matched
+        with identify, which returns (source, key) for an entry. convert is given the creatures to convert and their
+        keys. Returns the new list of items'''
+        keys = creature_keys(creatures)
+        hashes = [creature_hash(c.to_json(), context) for c in creatures]
+
+        ### Pull out the existing entries for this source, remembering where the source was in the file
+        existing = {}
+        kept_items, kept_entries = [], []
+        position = None
+        ### Untracked entries sharing a name are numbered in file order, the same as creature_keys, so none are lost
+        seen = Counter()
+        for item, entry in zip(items, self.entries):
+            if entry is None and identify is not None:
+                found = identify(item)
+                if found is not None and found[0] == source:
+                    entry = [found[0], numbered_key(found[1], seen), None]
+            if entry is not None and entry[0] == source:
+                existing[entry[1]] = (item, entry[2])
+                position = len(kept_items) if position is None else position
+                continue
+            kept_items.append(item)
+            kept_entries.append(entry)
+
+        ### Only convert creatures without a matching hash
+        to_convert = []
+        for i, (k, h) in enumerate(zip(keys, hashes)):
+            previous = existing.get(k, self.previous.get((source, k)))
+            if previous is None or previous[1] != h:
+                to_convert.append(i)
+        converted = dict(zip(to_convert, convert([creatures[i] for i in to_convert], [keys[i] for i in to_convert]))) if to_convert else {}
+
+        updated = {}
+        for i, (k, h) in enumerate(zip(keys, hashes)):
+            if i in converted:
+                if converted[i] is None:
+                    continue
+                self.counts["changed" if k in existing or (source, k) in self.previous else "added"] += 1
+                updated[k] = (converted[i], [source, k, h])
+            else:
+                self.counts["unchanged"] += 1
+                updated[k] = (existing.get(k, self.previous.get((source, k)))[0], [source, k, h])
+
+        ### Existing entries keep their place, replaced if they were written again, and new ones follow them
+        new_items, new_entries = [], []
+        for k, (item, h) in existing.items():
+            if k in updated:
+                new_items.append(updated[k][0])
+                new_entries.append(updated[k][1])
+            elif prune:
+                self.counts["removed"] += 1
+            else:
+                new_items.append(item)
+                new_entries.append([source, k, h])
+        for k in keys:
+            if k in updated and k not in existing:
+                new_items.append(updated[k][0])
+                new_entries.append(updated[k][1])
+
+        if position is None:
+            position = len(kept_items)
+        self.entries = kept_entries[:position] + new_entries + kept_entries[position:]
+        return kept_items[:position] + new_items + kept_items[position:]
+
+    def save(self):
+        '''Save the manifest, call this after the output file has been written'''
+        data = {
+            "version": OutputManifest.VERSION,
+            "writer": self.writer,
+            "file": self.__fingerprint(),
+            "entries": self.entries
+        }
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, separators=(",", ":"))
@@ -1,17 +1,23 @@
 
 import os
-import re
 import json
 import time
 
+from collections import Counter
+
 from configparser import ConfigParser
 from logging import Logger
-from typing import Any, List
+from typing import Any, Dict, List, Optional, Tuple
 
+import extractor.dice_parser as dice_parser
 from extractor import constants
+from extractor.dice_expression import try_compile_formula
+from extractor.dice_parser import Token, TokenTypes
 from utils.datatypes import Source
 from utils.interacter import get_input
 from outputs.writer_interface import WriterInterface
+from outputs.line_store import append_lines, latest_records, read_lines, storage_mode, with_extension
+from outputs.output_manifest import OutputManifest, incremental_enabled, prune_enabled, summarise
 
 def int_to_add_string(i: int):
     if i >= 0:
@@ -21,10 +27,16 @@ def int_to_add_string(i: int):
 
 class PlutoWriter(WriterInterface):
 
+    __DAMAGE_TYPES = set(constants.enum_values(constants.DAMAGE_TYPES))
+
     def __init__(self, config: ConfigParser, logger: Logger, append: bool=False):
         self.logger = logger.getChild("pluto_out")
         self.config = config
         self.append = append
+        self.storage = storage_mode(config)
+        self.incremental = incremental_enabled(config)
+        self.prune = prune_enabled(config)
+        self.incremental_counts = Counter()
 
     @staticmethod
     def get_long_name() -> str:
@@ -41,15 +53,34 @@ class PlutoWriter(WriterInterface):
         '''Returns the output filetype of this writer'''
         return "json"
 
+    @staticmethod
+    def get_line_filetype() -> str:
+        '''Returns the filetype used when writing one record per line'''
+        return "jsonl"
+
+    @staticmethod
+    def __new_meta() -> Any:
+        return {
+            "sources":[],
+            "dateAdded":int(time.time()),
+            "dateLastModified":int(time.time())
+        }
+
     def write(self, filename: str, source: Source, creatures: List[Any], append: bool=None) -> bool:
         '''Writes the creatures to the specified file. If append is set to true, creatures will be inserted into the existing file. Returns True if write is successful'''
+        return self.write_many(filename, [(source, creatures)], append)
+
+    def write_many(self, filename: str, sources: List[Tuple[Source, List[Any]]], append: bool=None) -> bool:
+        '''Writes the creatures of several sources to the specified file, reading and writing it only once. Monsters with the same name and source replace existing ones. Returns True if write is successful'''
 
         ### Apply configuration overrides
         if append is None:
             append = self.append
 
         ### Ensure we're writing something with the correct filetype
-        if not filename.endswith(PlutoWriter.get_filetype()):
+        if self.storage == "lines":
+            filename = with_extension(filename, PlutoWriter.get_line_filetype())
+        elif not filename.endswith(PlutoWriter.get_filetype()):
             if len(filename.split(".")) > 1:
                 filename = ".".join(filename.split(".")[:-1])
             filename += "." + PlutoWriter.get_filetype()
@@ -62,27 +93,90 @@ class PlutoWriter(WriterInterface):
             self.logger.error("Output file is a directory. Can't write")
             return False
 
+        manifest = None
+        if self.incremental and self.storage != "lines":
+            manifest = OutputManifest(filename, PlutoWriter.get_name(), self.logger)
+
         data = None
-        if make_file:
+        if make_file or self.storage == "lines":
             data = {
-                "_meta":{
-                    "sources":[],
-                    "dateAdded":int(time.time()),
-                    "dateLastModified":int(time.time())
-                }
+                "_meta":PlutoWriter.__new_meta()
             }
         else:
             with open(filename, 'r') as f:
                 data = json.load(f)
 
+        if "monster" not in data:
+            data["monster"] = []
+
+        if manifest is not None:
+            ### Monsters from the previous file can still be reused when it is being replaced
+            previous = data["monster"]
+            if make_file and manifest.valid and os.path.isfile(filename):
+                with open(filename, 'r') as f:
+                    previous = json.load(f).get("monster", [])
+            manifest.attach(previous, replace=make_file)
+
+        ### Built once per write and kept up to date, so each upsert is a lookup rather than a scan
+        sources_by_json = {s["json"]: s for s in data["_meta"]["sources"]}
+        monster_index = {(m["name"], m["source"]): i for i, m in enumerate(data["monster"])}
+
+        records = [{"_meta": dict(data["_meta"], sources=[])}] if make_file else []
+        for source, creatures in sources:
+            source_meta = self.__add_source(data, sources_by_json, source)
+            convert = lambda batch, keys=None, source_meta=source_meta: self.__convert_creatures(batch, source_meta)
+
+            if manifest is not None:
+                ### Untracked monsters are matched on name and source, the same as a normal upsert
+                data["monster"] = manifest.update(data["monster"], source_meta["json"], creatures, convert,
+                    identify=lambda m: (m["source"], m["name"]), prune=self.prune)
+                continue
+
+            monsters = [cr for cr in convert(creatures) if cr is not None]
+
+            if self.storage == "lines":
+                ### Sources and monsters are appended as they are, compact replaces earlier entries with later ones
+                records.append({"source": source_meta})
+                records += [{"monster": cr} for cr in monsters]
+                continue
+
+            ### Replace monsters with the same name from the same source
+            for cr in monsters:
+                key = (cr["name"], cr["source"])
+                if key in monster_index:
+                    data["monster"][monster_index[key]] = cr
+                else:
+                    monster_index[key] = len(data["monster"])
+                    data["monster"].append(cr)
+
+        if self.storage == "lines":
+            append_lines(filename, records, append=not make_file)
+            return True
+
+        if make_file:
+            data["_meta"]["dateAdded"] = int(time.time())
+        data["_meta"]["dateLastModified"] = int(time.time())
+
+        with open(filename, 'w') as f:
+            json.dump(data, f)
+
+        if manifest is not None:
+            manifest.save()
+            self.incremental_counts.update(manifest.counts)
+
+        return True
+
+    def summary(self) -> List[str]:
+        '''Returns lines describing the work done by this writer, printed at the end of a run'''
+        return summarise(self.incremental_counts)
+
+    def __add_source(self, data: Any, sources_by_json: Dict[str, Any], source: Source) -> Any:
+        '''Find or create the metadata entry for a source, asking for any missing details'''
         source_meta = self.__source_to_meta(source)
 
-        source_exists = False
-        for source_entry in data["_meta"]["sources"]:
-            if source_entry["json"] == source_meta["json"]:
-                source_exists = True
-                source_meta = source_entry
-                break
+        source_exists = source_meta["json"] in sources_by_json
+        if source_exists:
+            source_meta = sources_by_json[source_meta["json"]]
 
         ### Get additional information
         if not self.config.getboolean("default", "use_defaults"):
@@ -96,38 +190,46 @@ class PlutoWriter(WriterInterface):
         if not source_exists:
             self.logger.debug("Making new source entry")
             data["_meta"]["sources"].append(source_meta)
-        
-        if "monster" not in data:
-            data["monster"] = []
+            sources_by_json[source_meta["json"]] = source_meta
 
+        return source_meta
+
+    def __convert_creatures(self, creatures: List[Any], source_meta: Any) -> List[Optional[Any]]:
+        '''Convert creatures to the 5e tools format, failed conversions are returned as None'''
+        monsters = []
         for creature in creatures:
             try:
                 cr = self.__convert_creature(creature.to_json())
                 if cr is None: 
                     self.logger.error("Failed to convert {}".format(creature['name']))
-                    continue
-                cr["source"] = source_meta["json"]
+                else:
+                    cr["source"] = source_meta["json"]
             except Exception as e:
                 self.logger.error(e)
-                continue
-
-
-            ### Replace monsters with the same name from the same source
-            replaced=False
-            for i,monster in enumerate(data["monster"]):
-                if monster["name"] == cr["name"] and monster["source"] == source_meta["json"]:
-                    data["monster"][i] = cr
-                    replaced = True
-                    break
-            
-            if not replaced:
-                data["monster"].append(cr)
-
-        if make_file:
-            data["_meta"]["dateAdded"] = int(time.time())
+                cr = None
+            monsters.append(cr)
+        return monsters
+
+    def compact(self, filename: str, out_filename: str) -> bool:
+        '''Combine a line file written in lines storage mode into a single 5e tools JSON file'''
+        meta = None
+        sources = {}
+        monsters = []
+        for record in read_lines(filename):
+            if "_meta" in record:
+                meta = record["_meta"] if meta is None else meta
+            elif "source" in record:
+                sources[record["source"]["json"]] = record["source"]
+            elif "monster" in record:
+                monsters.append(record["monster"])
+
+        data = {"_meta": meta if meta is not None else PlutoWriter.__new_meta()}
+        data["_meta"]["sources"] = list(sources.values())
         data["_meta"]["dateLastModified"] = int(time.time())
+        ### Monsters written again are matched on source and name, the same as a normal upsert
+        data["monster"] = latest_records(monsters, lambda m: (m["source"], m["name"]))
 
-        with open(filename, 'w') as f:
+        with open(out_filename, 'w') as f:
             json.dump(data, f)
 
         return True
@@ -268,7 +370,7 @@ class PlutoWriter(WriterInterface):
                 new_creature["trait"].append(
                     {
                         "name":feature["title"],
-                        "entries":[self.__format_text(feature["text"])]
+                        "entries":[PlutoWriter.format_text(feature["text"])]
                     }
                 )
 
@@ -321,7 +423,7 @@ class PlutoWriter(WriterInterface):
                 new_creature["action"].append(
                     {
                         "name": action["title"],
-                        "entries": [self.__format_text(action["text"])]
+                        "entries": [PlutoWriter.format_text(action["text"])]
                     }
                 )
 
@@ -332,7 +434,7 @@ class PlutoWriter(WriterInterface):
                 new_creature["legendary"].append(
                     {
                         "name": legendary["title"],
-                        "entries": [self.__format_text(legendary["text"])]
+                        "entries": [PlutoWriter.format_text(legendary["text"])]
                     }
                 )
 
@@ -343,7 +445,7 @@ class PlutoWriter(WriterInterface):
                 new_creature["bonus"].append(
                     {
                         "name": bonus["title"],
-                        "entries": [self.__format_text(bonus["text"])]
+                        "entries": [PlutoWriter.format_text(bonus["text"])]
                     }
                 )
             
@@ -354,7 +456,7 @@ class PlutoWriter(WriterInterface):
                 new_creature["reaction"].append(
                     {
                         "name": reaction["title"],
-                        "entries": [self.__format_text(reaction["text"])]
+                        "entries": [PlutoWriter.format_text(reaction["text"])]
                     }
                 )
 
@@ -365,7 +467,7 @@ class PlutoWriter(WriterInterface):
                 new_creature["lair"].append(
                     {
                         "name": lair["title"],
-                        "entries": [self.__format_text(lair["text"])]
+                        "entries": [PlutoWriter.format_text(lair["text"])]
                     }
                 )
 
@@ -477,28 +579,125 @@ class PlutoWriter(WriterInterface):
 
         return new_v
 
-    def __replace_damage(self, text):
-        return re.sub("\s*([0-9]+\s)?(\()?((?:[+-]?\s*[0-9]+d[0-9]+\s*)+(?:[+-]?\s*[0-9]+)?)(\)?\s+)(({})\s+damage)".format("|".join(constants.enum_values(constants.DAMAGE_TYPES))),
-            " \g<1>\g<2>{@damage \g<3>}\g<4>\g<5>", text, flags=re.IGNORECASE)
+    @staticmethod
+    def __tag_attack(tokens: List[Token], i: int) -> Optional[Tuple[str, int]]:
+        '''Match 'Melee Weapon Attack:', 'Ranged Weapon Attack:' or 'Melee or Ranged Weapon Attack:' at token i'''
+        words = []
+        j = i
+        while j < len(tokens) and tokens[j].type == TokenTypes.word and len(words) < 5:
+            words.append(tokens[j].text.lower())
+            j += 1
+            if words[-1] == "attack":
+                break
+
+        kinds = {
+            ("melee", "or", "ranged", "weapon", "attack"): "mw,rw",
+            ("melee", "weapon", "attack"): "mw",
+            ("ranged", "weapon", "attack"): "rw",
+        }
+        kind = kinds.get(tuple(words))
+        if kind is None:
+            return None
+        if j < len(tokens) and tokens[j].type == TokenTypes.colon:
+            j += 1
+        return "{{@atk {}}}".format(kind), j
+
+    @staticmethod
+    def __tag_hit(tokens: List[Token], i: int) -> Optional[Tuple[str, int]]:
+        '''Match '+4 to hit' at token i'''
+        j = i
+        sign = ""
+        if tokens[j].type in [TokenTypes.plus, TokenTypes.minus] and j+1 < len(tokens) and tokens[j+1].start == tokens[j].end:
+            sign = tokens[j].text
+            j += 1
+        if tokens[j].type != TokenTypes.number or j+2 >= len(tokens):
+            return None
+        if tokens[j+1].text.lower() != "to" or tokens[j+2].text.lower() != "hit":
+            return None
+        return "{{@hit {}{}}} to hit".format(sign, tokens[j].text), j+3
+
+    @staticmethod
+    def __tag_damage(tokens: List[Token], i: int) -> Optional[Tuple[int, int, str, int]]:
+        '''Match '7 (2d6 + 3) piercing damage' at token i. Only the formula is replaced, so this returns the
+        token range of the formula, its tag and the index to continue from'''
+        j = i
+        if tokens[j].type == TokenTypes.number:
+            j += 1
+        if j < len(tokens) and tokens[j].type == TokenTypes.open_bracket:
+            j += 1
+        formula, end = dice_parser.parse_formula(tokens, j)
+        if formula is None:
+            return None
+        k = end
+        if k < len(tokens) and tokens[k].type == TokenTypes.close_bracket:
+            k += 1
+        if k+1 >= len(tokens) or tokens[k].text.lower() not in PlutoWriter.__DAMAGE_TYPES or tokens[k+1].text.lower() != "damage":
+            return None
+        return j, end, "{{@damage {}}}".format(PlutoWriter.__normalise_formula(formula)), k+2
 
-    def __replace_dcs(self, text):
-        return re.sub("\s+(dc)\s*([0-9]+)([()\s,])".format("|".join(constants.enum_values(constants.ABILITIES))), " {@dc \g<2>}\g<3>", text, flags=re.IGNORECASE)
+    @staticmethod
+    def __normalise_formula(formula: str) -> str:
+        expr = try_compile_formula(formula)
+        return expr.text if expr is not None else formula
 
-    def __replace_hit(self, text):
-        return re.sub("\s([+-]?[0-9]+)\s*to\s*hit", " {@hit \g<1>} to hit", text, flags=re.IGNORECASE)
+    @staticmethod
+    def format_text(text: str) -> str:
+        '''Add 5e tools tags ({@atk}, {@hit}, {@h}, {@damage}, {@dc} and {@dice}) to the text in a single scan'''
+        tokens = dice_parser.tokenise(text)
+        replacements = []
+        i = 0
+        while i < len(tokens):
+            t = tokens[i]
+
+            if t.type == TokenTypes.word:
+                attack = PlutoWriter.__tag_attack(tokens, i)
+                if attack is not None:
+                    replacements.append((t.start, tokens[attack[1]-1].end, attack[0]))
+                    i = attack[1]
+                    continue
 
-    def __replace_rolls(self, text):
-        return re.sub("(?<!damage\s)([0-9]+d[0-9]+)\s*([+-]\s*[0-9]+)?\s*([^}])", " {@dice \g<1>\g<2>} \g<3>", text)
+                word = t.text.lower()
+                ### 'Hit: 7 ' becomes '{@h}7 ', the roll itself is handled as damage on the next token
+                if word == "hit" and i+2 < len(tokens) and tokens[i+1].type == TokenTypes.colon\
+                        and tokens[i+2].type == TokenTypes.number and tokens[i+2].end < len(text) and text[tokens[i+2].end].isspace():
+                    replacements.append((t.start, tokens[i+2].start, "{@h}"))
+                    i += 2
+                    continue
 
-    def __format_text(self, text: str) -> str:
+                ### 'DC 13' followed by a bracket, comma or space
+                if word == "dc" and i+1 < len(tokens) and tokens[i+1].type == TokenTypes.number\
+                        and tokens[i+1].end < len(text) and text[tokens[i+1].end] in "(), \t\n":
+                    replacements.append((t.start, tokens[i+1].end, "{{@dc {}}}".format(tokens[i+1].text)))
+                    i += 2
+                    continue
 
-        text = self.__replace_hit(text)
-        text = re.sub("Melee\s*or\s*Ranged\s*Weapon\s*Attack", "{@atk mw,rw}", text, re.IGNORECASE)
-        text = re.sub("Melee\s*Weapon\s*Attack:", "{@atk mw}", text, re.IGNORECASE)
-        text = re.sub("Ranged\s*Weapon\s*Attack:", "{@atk rw}", text, re.IGNORECASE)
-        text = self.__replace_damage(text)
-        text = re.sub("(?:Hit: )([0-9]+)\s", "{@h}\g<1> ", text, flags=re.IGNORECASE)
-        text = self.__replace_dcs(text)
-        text = self.__replace_rolls(text)
-        
-        return text
\ No newline at end of file
+            elif t.type in [TokenTypes.number, TokenTypes.plus, TokenTypes.minus]:
+                hit = PlutoWriter.__tag_hit(tokens, i)
+                if hit is not None:
+                    replacements.append((t.start, tokens[hit[1]-1].end, hit[0]))
+                    i = hit[1]
+                    continue
+
+            if t.type in [TokenTypes.number, TokenTypes.open_bracket, TokenTypes.dice]:
+                damage = PlutoWriter.__tag_damage(tokens, i)
+                if damage is not None:
+                    replacements.append((tokens[damage[0]].start, tokens[damage[1]-1].end, damage[2]))
+                    i = damage[3]
+                    continue
+
+            if t.type == TokenTypes.dice:
+                formula, end = dice_parser.parse_formula(tokens, i)
+                replacements.append((t.start, tokens[end-1].end, "{{@dice {}}}".format(PlutoWriter.__normalise_formula(formula))))
+                i = end
+                continue
+
+            i += 1
+
+        parts = []
+        last = 0
+        for start, end, tag in replacements:
+            parts.append(text[last:start])
+            parts.append(tag)
+            last = end
+        parts.append(text[last:])
+        return "".join(parts)
@@ -0,0 +1,292 @@
+import math
+import os
+import re
+import sqlite3
+
+from collections import defaultdict
+from configparser import ConfigParser
+from dataclasses import dataclass
+from logging import Logger
+from typing import Any, Dict, Iterable, List, Tuple
+
+from utils.datatypes import Source
+from outputs.default_writer import DefaultWriter
+from outputs.writer_interface import WriterInterface
+
+### Full-text inverted index over creature names, features, actions and spells. Each creature is one document and
+### its postings (term -> positions in each field) are kept in an SQLite file, so adding a source only writes the
+### postings of its creatures. Queries support prefixes (fright*) and phrases ("pack tactics") and are ranked
+### with BM25, weighting matches in names and titles above matches in the body text.
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_QUERY = re.compile(r'"([^"]*)"|(\S+)')
+
+### Gap left between separate entries of the same field (e.g. two features) so phrases don't match across them
+_ENTRY_GAP = 8
+
+FIELD_WEIGHTS = {
+    "name": 3.0,
+    "title": 2.0,
+    "spell": 1.5,
+    "text": 1.0,
+}
+
+### BM25 parameters
+_K1 = 1.2
+_B = 0.75
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS docs (
+        id INTEGER PRIMARY KEY,
+        source TEXT NOT NULL,
+        name TEXT NOT NULL,
+        length INTEGER NOT NULL,
+        UNIQUE(source, name)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS postings (
+        term TEXT NOT NULL,
+        doc INTEGER NOT NULL,
+        field TEXT NOT NULL,
+        positions TEXT NOT NULL
+    )''',
+    "CREATE INDEX IF NOT EXISTS postings_term ON postings(term)",
+    "CREATE INDEX IF NOT EXISTS postings_doc ON postings(doc)",
+]
+
+def tokenise(text: str) -> List[str]:
+    '''Lower case words and numbers'''
+    return _TOKEN.findall(text.lower())
+
+def creature_fields(creature: Any) -> Dict[str, List[str]]:
+    '''Text of each indexed field of a creature in the internal format'''
+    fields = {"name": [creature["name"]], "title": [], "text": [], "spell": []}
+    for kind in ["features", "action", "bonus", "reaction", "legendary", "mythic", "lair"]:
+        for entry in creature.get(kind, []):
+            fields["title"].append(entry.get("title", ""))
+            fields["text"].append(entry.get("text", ""))
+    for sc in creature.get("spellcasting", []):
+        fields["title"].append(sc.get("title", ""))
+        for level in sc.get("levels", []):
+            for spell in level.get("spells", []):
+                fields["spell"].append(spell["name"])
+    return fields
+
+def _parse_query(query: str) -> List[Tuple[str, List[str]]]:
+    '''Split a query into ("term" | "prefix" | "phrase", tokens) clauses'''
+    clauses = []
+    for phrase, word in _QUERY.findall(query):
+        if phrase:
+            tokens = tokenise(phrase)
+            if len(tokens) == 1:
+                clauses.append(("term", tokens))
+            elif len(tokens) > 1:
+                clauses.append(("phrase", tokens))
+        elif word.endswith("*") and len(tokenise(word)) == 1:
+            clauses.append(("prefix", tokenise(word)))
+        else:
+            clauses += [("term", [t]) for t in tokenise(word)]
+    return clauses
+
+@dataclass
+class SearchResult:
+    score: float
+    source: str
+    name: str
+    # Fields that matched the query
+    fields: List[str]
+
+class CreatureSearchIndex(object):
+    '''On-disk inverted index of creatures. Use add to index creatures and search to query them'''
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def clear(self):
+        '''Remove every document from the index'''
+        with self.conn:
+            self.conn.execute("DELETE FROM postings")
+            self.conn.execute("DELETE FROM docs")
+
+    def add(self, source: str, creatures: Iterable[Any]) -> int:
+        '''Index creatures (in the internal JSON format) from a source, replacing any already indexed with the same
+        source and name. Only the given creatures are touched. Returns the number indexed'''
+        count = 0
+        with self.conn:
+            for creature in creatures:
+                self.__add_creature(source, creature)
+                count += 1
+        return count
+
+    def __add_creature(self, source: str, creature: Any):
+        row = self.conn.execute("SELECT id FROM docs WHERE source = ? AND name = ?", (source, creature["name"])).fetchone()
+        if row is not None:
+            self.conn.execute("DELETE FROM postings WHERE doc = ?", (row[0],))
+            self.conn.execute("DELETE FROM docs WHERE id = ?", (row[0],))
+
+        ### term -> field -> positions, with positions counted separately in each field
+        postings = defaultdict(lambda: defaultdict(list))
+        length = 0
+        for field, entries in creature_fields(creature).items():
+            position = 0
+            for entry in entries:
+                tokens = tokenise(entry)
+                for t in tokens:
+                    postings[t][field].append(position)
+                    position += 1
+                length += len(tokens)
+                position += _ENTRY_GAP
+
+        doc = self.conn.execute("INSERT INTO docs (source, name, length) VALUES (?, ?, ?)", (source, creature["name"], length)).lastrowid
+        self.conn.executemany("INSERT INTO postings (term, doc, field, positions) VALUES (?, ?, ?, ?)",
+            [(t, doc, f, ",".join(str(p) for p in positions)) for t, fields in postings.items() for f, positions in fields.items()])
+
+    def __postings(self, terms: List[str]) -> Dict[int, Dict[str, List[int]]]:
+        '''doc -> field -> positions for any of the terms'''
+        found = defaultdict(lambda: defaultdict(list))
+        for t in terms:
+            for doc, field, positions in self.conn.execute("SELECT doc, field, positions FROM postings WHERE term = ?", (t,)):
+                found[doc][field] += [int(p) for p in positions.split(",")]
+        return found
+
+    def __expand_prefix(self, prefix: str) -> List[str]:
+        '''Every indexed term starting with prefix, found as a range over the term index'''
+        rows = self.conn.execute("SELECT DISTINCT term FROM postings WHERE term >= ? AND term < ?", (prefix, prefix + "\U0010ffff"))
+        return [r[0] for r in rows]
+
+    def __clause_matches(self, kind: str, tokens: List[str]) -> Dict[int, Dict[str, int]]:
+        '''doc -> field -> number of matches for a single query clause'''
+        if kind == "term":
+            postings = self.__postings(tokens)
+        elif kind == "prefix":
+            postings = self.__postings(self.__expand_prefix(tokens[0]))
+        else:
+            ### A phrase matches where every token follows the one before in the same field
+            per_token = [self.__postings([t]) for t in tokens]
+            docs = set(per_token[0].keys())
+            for p in per_token[1:]:
+                docs &= set(p.keys())
+            postings = {}
+            for doc in docs:
+                fields = {}
+                for field, starts in per_token[0][doc].items():
+                    matches = set(starts)
+                    for offset, p in enumerate(per_token[1:], start=1):
+                        following = set(p[doc].get(field, []))
+                        matches = {s for s in matches if s + offset in following}
+                    if matches:
+                        fields[field] = sorted(matches)
+                if fields:
+                    postings[doc] = fields
+
+        return {doc: {f: len(p) for f, p in fields.items()} for doc, fields in postings.items()}
+
+    def search(self, query: str, limit: int=20) -> List[SearchResult]:
+        '''Find creatures matching every clause of the query, best first. Clauses are words, prefixes ending in *
+        and quoted phrases'''
+        clauses = _parse_query(query)
+        if len(clauses) == 0:
+            return []
+
+        doc_count, total_length = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs").fetchone()
+        if doc_count == 0:
+            return []
+        average_length = max(total_length / doc_count, 1)
+
+        scores = None
+        matched_fields = defaultdict(set)
+        for kind, tokens in clauses:
+            matches = self.__clause_matches(kind, tokens)
+            idf = math.log(1 + (doc_count - len(matches) + 0.5) / (len(matches) + 0.5))
+            clause_scores = {}
+            for doc, fields in matches.items():
+                clause_scores[doc] = sum(FIELD_WEIGHTS[f] * n for f, n in fields.items())
+                matched_fields[doc].update(fields.keys())
+
+            ### Every clause has to match
+            if scores is None:
+                scores = {doc: [(idf, tf)] for doc, tf in clause_scores.items()}
+            else:
+                scores = {doc: s + [(idf, clause_scores[doc])] for doc, s in scores.items() if doc in clause_scores}
+            if len(scores) == 0:
+                return []
+
+        docs = {}
+        placeholders = ",".join("?" for _ in scores)
+        for doc, source, name, length in self.conn.execute(f"SELECT id, source, name, length FROM docs WHERE id IN ({placeholders})", list(scores.keys())):
+            docs[doc] = (source, name, length)
+
+        results = []
+        for doc, parts in scores.items():
+            source, name, length = docs[doc]
+            norm = _K1 * (1 - _B + _B * length / average_length)
+            score = sum(idf * tf * (_K1 + 1) / (tf + norm) for idf, tf in parts)
+            results.append(SearchResult(score, source, name, sorted(matched_fields[doc])))
+
+        results.sort(key=lambda r: (-r.score, r.name, r.source))
+        return results[:limit]
+
+class SearchIndexWriter(WriterInterface):
+    '''Add creatures to a full-text search index as they are written'''
+
+    def __init__(self, config: ConfigParser, logger: Logger, append: bool=False):
+        self.logger = logger.getChild("index_out")
+        self.config = config
+        self.append = append
+
+    @staticmethod
+    def get_long_name() -> str:
+        '''Returns a human readable name for this output writer'''
+        return "Full Text Search Index"
+
+    @staticmethod
+    def get_name() -> str:
+        '''Returns an internal name for this output writer'''
+        return "index"
+
+    @staticmethod
+    def get_filetype() -> str:
+        '''Returns the output filetype of this writer'''
+        return "index"
+
+    def write(self, filename: str, source: Source, creatures: List[Any], append: bool=None) -> bool:
+        '''Indexes the creatures in the specified index file. If append is set to false, the index is cleared first. Returns True if write is successful'''
+        return self.write_many(filename, [(source, creatures)], append)
+
+    def write_many(self, filename: str, sources: List[Tuple[Source, List[Any]]], append: bool=None) -> bool:
+        '''Indexes the creatures of several sources. Returns True if write is successful'''
+
+        ### Apply configuration overrides
+        if append is None:
+            append = self.append
+
+        ### Ensure we're writing something with the correct filetype
+        if not filename.endswith(SearchIndexWriter.get_filetype()):
+            if len(os.path.basename(filename).split(".")) > 1:
+                filename = ".".join(filename.split(".")[:-1])
+            filename += "." + SearchIndexWriter.get_filetype()
+
+        if os.path.exists(filename) and not os.path.isfile(filename):
+            self.logger.error("Output file is a directory. Can't write")
+            return False
+
+        index = CreatureSearchIndex(filename)
+        try:
+            if not append:
+                index.clear()
+            for source, creatures in sources:
+                count = index.add(DefaultWriter.prettify_name(source.name), [c.to_json() for c in creatures])
+                self.logger.debug(f"Indexed {count} creatures from {source.name}")
+        except sqlite3.Error as e:
+            self.logger.error(f"Failed to update index {filename}: {e}")
+            return False
+        finally:
+            index.close()
+
+        return True
@@ -0,0 +1,253 @@
+import json
+import os
+import sqlite3
+
+from configparser import ConfigParser
+from logging import Logger
+from typing import Any, List, Optional, Tuple
+
+from extractor import constants
+from utils.datatypes import Source
+from outputs.default_writer import DefaultWriter
+from outputs.writer_interface import WriterInterface
+
+### Creatures are stored in a normalised SQLite database so collections spanning many sources can be searched by
+### name, CR, type, size or source without loading every file. The full internal JSON of each creature is kept
+### alongside the indexed columns so nothing is lost.
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS sources (
+        id INTEGER PRIMARY KEY,
+        title TEXT NOT NULL UNIQUE,
+        pages INTEGER,
+        url TEXT,
+        authors TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS creatures (
+        id INTEGER PRIMARY KEY,
+        source_id INTEGER NOT NULL REFERENCES sources(id),
+        name TEXT NOT NULL COLLATE NOCASE,
+        cr REAL,
+        creature_type TEXT,
+        swarm INTEGER NOT NULL DEFAULT 0,
+        size TEXT,
+        alignment TEXT,
+        page INTEGER,
+        data TEXT NOT NULL,
+        UNIQUE(source_id, name)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS creature_types (
+        creature_id INTEGER NOT NULL REFERENCES creatures(id),
+        type TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS actions (
+        id INTEGER PRIMARY KEY,
+        creature_id INTEGER NOT NULL REFERENCES creatures(id),
+        kind TEXT NOT NULL,
+        title TEXT NOT NULL,
+        text TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS spells (
+        id INTEGER PRIMARY KEY,
+        creature_id INTEGER NOT NULL REFERENCES creatures(id),
+        name TEXT NOT NULL COLLATE NOCASE,
+        level TEXT,
+        frequency TEXT
+    )''',
+    "CREATE INDEX IF NOT EXISTS creatures_name ON creatures(name)",
+    "CREATE INDEX IF NOT EXISTS creatures_cr ON creatures(cr)",
+    "CREATE INDEX IF NOT EXISTS creatures_size ON creatures(size)",
+    "CREATE INDEX IF NOT EXISTS creatures_source ON creatures(source_id)",
+    "CREATE INDEX IF NOT EXISTS creature_types_creature ON creature_types(creature_id)",
+    "CREATE INDEX IF NOT EXISTS creature_types_type ON creature_types(type)",
+    "CREATE INDEX IF NOT EXISTS actions_creature ON actions(creature_id)",
+    "CREATE INDEX IF NOT EXISTS spells_creature ON spells(creature_id)",
+    "CREATE INDEX IF NOT EXISTS spells_name ON spells(name)",
+]
+
+### Keys of the internal format stored in the actions table, features are included so they can be searched too
+ACTION_KINDS = ["features", "action", "bonus", "reaction", "legendary", "mythic", "lair"]
+
+def creature_types(creature: Any) -> List[str]:
+    '''Every type of a creature in the singular. Swarms store a single, often plural, type rather than a list'''
+    types = creature.get("creature_type", {}).get("type") or []
+    if isinstance(types, str):
+        types = [types]
+
+    singular = []
+    for t in types:
+        t = t.lower().strip()
+        if t in constants.enum_values(constants.CREATURE_TYPE_PLURALS):
+            t = constants.CREATURE_TYPE_PLURALS[t].to_singular().name
+        if t and t not in singular:
+            singular.append(t)
+    return singular
+
+def connect(filename: str) -> sqlite3.Connection:
+    '''Open a creature database, creating the tables if needed'''
+    conn = sqlite3.connect(filename)
+    conn.row_factory = sqlite3.Row
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    return conn
+
+def query_creatures(conn: sqlite3.Connection, name: Optional[str]=None, cr: Optional[float]=None, min_cr: Optional[float]=None,
+        max_cr: Optional[float]=None, creature_type: Optional[str]=None, size: Optional[str]=None, source: Optional[str]=None,
+        spell: Optional[str]=None, limit: int=100) -> List[sqlite3.Row]:
+    '''Find creatures matching every given filter. Name and spell match a case insensitive prefix'''
+    where = []
+    params = []
+    if name is not None:
+        where.append("c.name >= ? AND c.name < ?")
+        params += _prefix_range(name)
+    if cr is not None:
+        where.append("c.cr = ?")
+        params.append(cr)
+    if min_cr is not None:
+        where.append("c.cr >= ?")
+        params.append(min_cr)
+    if max_cr is not None:
+        where.append("c.cr <= ?")
+        params.append(max_cr)
+    if creature_type is not None:
+        where.append("c.id IN (SELECT creature_id FROM creature_types WHERE type = ?)")
+        params.append(creature_type.lower())
+    if size is not None:
+        where.append("c.size = ?")
+        params.append(size.lower())
+    if source is not None:
+        where.append("s.title = ?")
+        params.append(source)
+    if spell is not None:
+        where.append("c.id IN (SELECT creature_id FROM spells WHERE name >= ? AND name < ?)")
+        params += _prefix_range(spell)
+
+    sql = '''SELECT c.id, c.name, c.cr, c.creature_type, c.swarm, c.size, c.alignment, c.page, c.data, s.title AS source
+        FROM creatures c JOIN sources s ON s.id = c.source_id'''
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY c.name, s.title LIMIT ?"
+    params.append(limit)
+    return conn.execute(sql, params).fetchall()
+
+def _prefix_range(prefix: str) -> List[str]:
+    '''Bounds matching every string starting with prefix, compared as a range so the name indexes can be used'''
+    return [prefix, prefix + "\U0010ffff"]
+
+class SqliteWriter(WriterInterface):
+    '''Upsert creatures into a normalised SQLite database'''
+
+    def __init__(self, config: ConfigParser, logger: Logger, append: bool=False):
+        self.logger = logger.getChild("sqlite_out")
+        self.config = config
+        self.append = append
+
+    @staticmethod
+    def get_long_name() -> str:
+        '''Returns a human readable name for this output writer'''
+        return "SQLite Database"
+
+    @staticmethod
+    def get_name() -> str:
+        '''Returns an internal name for this output writer'''
+        return "sqlite"
+
+    @staticmethod
+    def get_filetype() -> str:
+        '''Returns the output filetype of this writer'''
+        return "sqlite"
+
+    def write(self, filename: str, source: Source, creatures: List[Any], append: bool=None) -> bool:
+        '''Writes the creatures to the specified database. If append is set to true, creatures will be inserted into the existing database. Returns True if write is successful'''
+        return self.write_many(filename, [(source, creatures)], append)
+
+    def write_many(self, filename: str, sources: List[Tuple[Source, List[Any]]], append: bool=None) -> bool:
+        '''Upserts the creatures of several sources in a single transaction. Creatures with the same name and source replace existing ones. Returns True if write is successful'''
+
+        ### Apply configuration overrides
+        if append is None:
+            append = self.append
+
+        ### Ensure we're writing something with the correct filetype
+        if not filename.endswith(SqliteWriter.get_filetype()):
+            if len(os.path.basename(filename).split(".")) > 1:
+                filename = ".".join(filename.split(".")[:-1])
+            filename += "." + SqliteWriter.get_filetype()
+
+        if os.path.exists(filename) and not os.path.isfile(filename):
+            self.logger.error("Output file is a directory. Can't write")
+            return False
+
+        conn = connect(filename)
+        try:
+            with conn:
+                if not append:
+                    self.logger.debug("Clearing existing database")
+                    for table in ["spells", "actions", "creature_types", "creatures", "sources"]:
+                        conn.execute(f"DELETE FROM {table}")
+
+                for source, creatures in sources:
+                    source_id = self.__upsert_source(conn, source)
+                    for creature in creatures:
+                        self.__upsert_creature(conn, source_id, creature.to_json())
+        except sqlite3.Error as e:
+            self.logger.error(f"Failed to write to {filename}: {e}")
+            return False
+        finally:
+            conn.close()
+
+        return True
+
+    def __upsert_source(self, conn: sqlite3.Connection, source: Source) -> int:
+        '''Insert or update a source, returning its id. Sources are keyed by their prettified name like the internal format'''
+        title = DefaultWriter.prettify_name(source.name)
+        authors = json.dumps(source.authors) if source.authors else None
+        pages = source.num_pages if source.num_pages and source.num_pages > 0 else None
+
+        row = conn.execute("SELECT id FROM sources WHERE title = ?", (title,)).fetchone()
+        if row is not None:
+            conn.execute("UPDATE sources SET pages = ?, url = ?, authors = ? WHERE id = ?", (pages, source.url, authors, row["id"]))
+            return row["id"]
+        return conn.execute("INSERT INTO sources (title, pages, url, authors) VALUES (?, ?, ?, ?)",
+            (title, pages, source.url, authors)).lastrowid
+
+    def __upsert_creature(self, conn: sqlite3.Connection, source_id: int, creature: Any):
+        '''Insert or replace a creature along with its actions and spells'''
+        types = creature_types(creature)
+        values = (
+            creature.get("cr", {}).get("cr"),
+            ", ".join(types) if types else None,
+            1 if creature.get("creature_type", {}).get("swarm") else 0,
+            creature["size"][0].lower() if creature.get("size") else None,
+            creature.get("alignment"),
+            creature.get("source", {}).get("page"),
+            json.dumps(creature, separators=(",", ":")),
+        )
+
+        row = conn.execute("SELECT id FROM creatures WHERE source_id = ? AND name = ?", (source_id, creature["name"])).fetchone()
+        if row is not None:
+            creature_id = row["id"]
+            conn.execute('''UPDATE creatures SET cr = ?, creature_type = ?, swarm = ?, size = ?, alignment = ?, page = ?, data = ?
+                WHERE id = ?''', values + (creature_id,))
+            conn.execute("DELETE FROM creature_types WHERE creature_id = ?", (creature_id,))
+            conn.execute("DELETE FROM actions WHERE creature_id = ?", (creature_id,))
+            conn.execute("DELETE FROM spells WHERE creature_id = ?", (creature_id,))
+        else:
+            creature_id = conn.execute('''INSERT INTO creatures (source_id, name, cr, creature_type, swarm, size, alignment, page, data)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', (source_id, creature["name"]) + values).lastrowid
+
+        conn.executemany("INSERT INTO creature_types (creature_id, type) VALUES (?, ?)", [(creature_id, t) for t in types])
+
+        actions = []
+        for kind in ACTION_KINDS:
+            for action in creature.get(kind, []):
+                actions.append((creature_id, "feature" if kind == "features" else kind, action["title"], action.get("text")))
+        conn.executemany("INSERT INTO actions (creature_id, kind, title, text) VALUES (?, ?, ?, ?)", actions)
+
+        spells = []
+        for sc in creature.get("spellcasting", []):
+            for level in sc["levels"]:
+                for spell in level["spells"]:
+                    spells.append((creature_id, spell["name"], level.get("level"), level.get("frequency")))
+        conn.executemany("INSERT INTO spells (creature_id, name, level, frequency) VALUES (?, ?, ?, ?)", spells)
@@ -1,5 +1,5 @@
 import abc
-from typing import List, Any
+from typing import List, Any, Tuple
 import json
 
 from utils.datatypes import Source
@@ -29,6 +29,27 @@ class WriterInterface(object):
         '''Writes the creatures to the specified file. If append is set to true, creatures will be inserted into the existing file. Returns True if write is successful'''
         raise NotImplementedError("users must define a function to write to a file.")
 
+    def prepare(self, creatures: List[Any]):
+        '''Called before the creatures are handed to the selected writers, which may run at the same time. Work shared
+        between writers (e.g. compendium lookups) should be started here so it only happens once'''
+        pass
+
+    def write_many(self, filename: str, sources: List[Tuple[Source, List[Any]]], append: bool=None) -> bool:
+        '''Writes the creatures of several sources to the specified file. Writers that load the whole file should override this to only read and write it once. Returns True if every write is successful'''
+        ret = True
+        for source, creatures in sources:
+            ret &= self.write(filename, source, creatures, append)
+            append = True
+        return ret
+
+    def compact(self, filename: str, out_filename: str) -> bool:
+        '''Combines a file written in lines storage mode into this writer's JSON format. Returns True if successful'''
+        raise NotImplementedError(f"{self.get_name()} output does not support compaction")
+
+    def summary(self) -> List[str]:
+        '''Returns lines describing the work done by this writer, printed at the end of a run'''
+        return []
+
     def write_p2v(self, out_filename: str, p2vdata: List[Any], append: bool=None) -> bool:
         '''Converts from an existing p2v file into the writer format'''
 
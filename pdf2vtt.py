@@ -1,10 +1,14 @@
 import os
+import sys
 
 from data_loaders.pdf_loader import PDFLoader
 from outputs.pluto_writer import PlutoWriter
 from outputs.default_writer import DefaultWriter
 from outputs.print_writer import PrintWriter
 from outputs.fvtt_writer import FVTTWriter
+from outputs.ndjson_writer import NdjsonWriter
+from outputs.sqlite_writer import SqliteWriter
+from outputs.search_index import SearchIndexWriter
 
 from utils.config import get_config, get_argparser
 from utils.logger import get_logger
@@ -16,83 +20,106 @@ from extractor.extractor import StatblockExtractor
 from outputs.creature_printer import pretty_format_creature
 
 
-
-# Get arguments
-parser = get_argparser()
-args = parser.parse_args()
-
-# Get config file
-config = get_config(args)
-
-if not config.has_section("source"):
-    config.add_section("source")
-if args.authors:
-    authors = []
-    for a in args.authors:
-        authors += [v.strip() for v in a.split(",")]
-    config.set("source", "authors", ",".join(authors))
-if args.url:
-    config.set("source", "url", args.url)
-if args.source:
-    config.set("source", "title", args.source)
-
-
-# Setup logger
-logger = get_logger(args.debug, args.logs)
-
-### Create Extractor
-se = StatblockExtractor(config, logger)
-
-### Register Input formats
-se.register_data_loader(TextractImageLoader)
-se.register_data_loader(PDFLoader)
-
-### Register Output formats and select one
-se.register_output_writer(DefaultWriter, append=not args.overwrite)
-se.register_output_writer(PrintWriter, append=not args.overwrite)
-se.register_output_writer(FVTTWriter, append=not args.overwrite)
-output = True
-if args.format:
-    if args.format == 'none':
+### Workers started by the FVTT writer import this module again, so only run when executed directly
+if __name__ == "__main__":
+    # Get arguments
+    parser = get_argparser()
+    args = parser.parse_args()
+
+    # Get config file
+    config = get_config(args)
+
+    if not config.has_section("source"):
+        config.add_section("source")
+    if args.authors:
+        authors = []
+        for a in args.authors:
+            authors += [v.strip() for v in a.split(",")]
+        config.set("source", "authors", ",".join(authors))
+    if args.url:
+        config.set("source", "url", args.url)
+    if args.source:
+        config.set("source", "title", args.source)
+
+
+    # Setup logger
+    logger = get_logger(args.debug, args.logs)
+
+    ### Create Extractor
+    se = StatblockExtractor(config, logger)
+
+    ### Register Input formats
+    se.register_data_loader(TextractImageLoader)
+    se.register_data_loader(PDFLoader)
+
+    ### Register Output formats and select one
+    se.register_output_writer(DefaultWriter, append=not args.overwrite)
+    se.register_output_writer(PrintWriter, append=not args.overwrite)
+    se.register_output_writer(FVTTWriter, append=not args.overwrite)
+    se.register_output_writer(PlutoWriter, append=not args.overwrite)
+    se.register_output_writer(NdjsonWriter, append=not args.overwrite)
+    se.register_output_writer(SqliteWriter, append=not args.overwrite)
+    se.register_output_writer(SearchIndexWriter, append=not args.overwrite)
+    output = True
+    formats = [f.strip() for f in args.format.split(",") if f.strip()] if args.format else [FVTTWriter.get_name()]
+    for f in formats:
+        if f != 'none' and f not in se.writers_by_name:
+            parser.error("Unknown output format '{}', choose from {}".format(f, ", ".join(['none'] + list(se.writers_by_name.keys()))))
+    formats = [f for f in formats if f != 'none']
+    if len(formats) == 0:
         output = False
     else:
-        se.select_writer(args.format)
-else:
-    se.select_writer(FVTTWriter.get_name())
+        se.select_writers(formats)
 
-### Run over provided targets 
-parsed_statblocks = []
-logger.info("Loading creatures from {}".format(args.target))
+    p_func = print
 
-if args.pages:
-    pages = [int(p) for p in args.pages.split(",")]
-else:
-    pages = None
+    ### NDJSON is streamed while parsing. If it goes to stdout everything else is printed to stderr
+    for w in se.writers:
+        if isinstance(w, NdjsonWriter):
+            se.register_creature_callback(w.write_creature)
+            if w.uses_stdout():
+                p_func = lambda *a: print(*a, file=sys.stderr)
 
-results = se.parse(args.target, pages=pages)
-if not results:
-    exit()
-parsed_statblocks, statblocks = results
+    ### Run over provided targets 
+    parsed_statblocks = []
+    logger.info("Loading creatures from {}".format(args.target))
 
-p_func = print
+    if args.pages:
+        pages = [int(p) for p in args.pages.split(",")]
+    else:
+        pages = None
 
-for source_name in parsed_statblocks:
-    source, ps = parsed_statblocks[source_name]
-    p_func("Found {} statblocks in {}".format(len(ps), source.name))
+    results = se.parse(args.target, pages=pages)
+    if not results:
+        exit()
+    parsed_statblocks, statblocks = results
 
-    if output:
-        if args.output:
-            outfile = args.output
-        else:
-            outfile = "{}.{}".format(os.path.basename(source.name).split('.')[0], se.writer.get_filetype())
+    ### Sources sharing one output file are written together so the file is only loaded and saved once
+    batch = []
+    for source_name in parsed_statblocks:
+        source, ps = parsed_statblocks[source_name]
+        p_func("Found {} statblocks in {}".format(len(ps), source.name))
 
-        se.write_to_file(outfile, source, {0:ps})
+        if output:
+            if args.output:
+                batch.append((source, {0:ps}))
+            else:
+                outfile = "{}.{}".format(os.path.basename(source.name).split('.')[0], se.writer.get_filetype())
+                se.write_to_file(outfile, source, {0:ps})
 
-    if args.print:
-        for creature in ps:
-            p_func("\n" + pretty_format_creature(creature) + "\n")
+        if args.print:
+            for creature in ps:
+                p_func("\n" + pretty_format_creature(creature) + "\n")
 
+    if batch:
+        se.write_many_to_file(args.output, batch)
 
-        
+    for line in se.summary():
+        p_func(line)
 
-    
\ No newline at end of file
+    if output:
+        for w in se.writers:
+            for line in w.summary():
+                p_func(line)
+            if isinstance(w, NdjsonWriter):
+                w.close()
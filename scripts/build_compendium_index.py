@@ -0,0 +1,28 @@
+import argparse
+import configparser
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from outputs.fvtt.compendium_index import get_compendium_index, index_path
+from utils.logger import get_logger
+
+### Builds the Foundry compendium index ahead of time so the first FVTT export doesn't have to. The index is
+### otherwise built on first use and rebuilt automatically when a compendium file changes.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the Foundry compendium index used by the FVTT writer")
+    parser.add_argument("--config", "-c", type=str, default="default.conf", help="Configuration file for controlling parser")
+    parser.add_argument("--force", action="store_true", default=False, help="Rebuild even if the compendium files haven't changed")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    logger = get_logger(False)
+
+    index = get_compendium_index(config, logger, rebuild=args.force)
+    print(f"Compendium index {index_path(config)} covers {len(index.files)} files")
+    for t in index.compendia:
+        print(f"\t{t}: {len(index.compendia[t])} entries")
+    print(f"\t{len(index.image_paths)} item images, {len(index.actor_image_paths)} actor images")
@@ -0,0 +1,38 @@
+import argparse
+import configparser
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from outputs.default_writer import DefaultWriter
+from outputs.fvtt_writer import FVTTWriter
+from outputs.pluto_writer import PlutoWriter
+from outputs.line_store import with_extension
+from utils.logger import get_logger
+
+### Combines an output file written with '--storage lines' into the writer's normal aggregated JSON file. Line files
+### are cheap to append to but most tools expect the aggregated format, so run this once a batch of runs is done.
+
+WRITERS = {w.get_name(): w for w in [DefaultWriter, FVTTWriter, PlutoWriter]}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact a line storage output file into a single JSON file")
+    parser.add_argument("target", type=str, help="Line file written with '--storage lines'")
+    parser.add_argument("--format", "-f", type=str, default="fvtt", choices=list(WRITERS.keys()), help="Output format the line file was written with")
+    parser.add_argument("--output", "-o", type=str, default=None, help="Compacted output file. Defaults to the target with a .json extension")
+    parser.add_argument("--config", "-c", type=str, default="default.conf", help="Configuration file for controlling parser")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    logger = get_logger(False)
+
+    writer_type = WRITERS[args.format]
+    writer = writer_type(config, logger)
+    out_filename = args.output if args.output else with_extension(args.target, writer_type.get_filetype())
+    if os.path.abspath(out_filename) == os.path.abspath(args.target):
+        parser.error("Output file would overwrite the line file")
+
+    if writer.compact(args.target, out_filename):
+        print(f"Compacted {args.target} into {out_filename}")
@@ -1,6 +1,21 @@
-from typing import Any, List
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple
+import argparse
+import hashlib
+import io
 import json
+import os
 import sys
+import time
+
+### Diffs two internal format files. Unchanged sources and creatures are found with a plain equality check and
+### skipped straight away. Only changed creatures are diffed, only on the fields that differ, and in worker processes
+### if --workers is raised. With --cache-hashes every source and creature gets a content hash instead (a source's hash
+### covers the hashes of its creatures) that is saved next to the file, so a file is only hashed once.
+### The HTML report and the optional JSON Lines report are written as the diff runs rather than built in memory,
+### and a JSON summary with thresholds can be used to fail CI runs, e.g.
+###     python scripts/creature_diff.py old.json new.json diff.html --json diff.jsonl --summary summary.json --max-changed 50
 
 def added(s, indent):
     return "<font class='add'>" + "&nbsp"*indent + "+ {}</font>".format(s)
@@ -23,62 +38,257 @@ def header():
     </head>
     """
 
-def diff_mw_file(f_old: Any, f_new: Any, indent: int=4) -> str:
+def content_hash(obj: Any) -> str:
+    '''Stable hash of a JSON object, independent of key order'''
+    return hashlib.sha1(json.dumps(obj, sort_keys=True, separators=(",", ":")).encode("utf8")).hexdigest()
+
+def changed_fields(c_old: Any, c_new: Any) -> List[str]:
+    '''Keys of a creature whose values differ, or that only one of them has'''
+    return [k for k in list(c_old.keys()) + [k for k in c_new if k not in c_old]
+            if k not in c_old or k not in c_new or c_old[k] != c_new[k]]
+
+def diff_changed_creature(item: Tuple[Any, Any, int]) -> Tuple[List[str], List[str]]:
+    '''Diff a creature whose hash has changed, only looking at the fields that changed. Returns the changed fields
+    and the report lines'''
+    c_old, c_new, indent = item
+    fields = changed_fields(c_old, c_new)
+    keep = set(fields) | {"name"}
+    lines = diff_creature({k: v for k, v in c_old.items() if k in keep}, {k: v for k, v in c_new.items() if k in keep}, indent)
+    if len(lines) == 1:
+        ### Only fields diff_creature doesn't look at (e.g. the page) have changed
+        lines = ["&nbsp"*indent + f"<p>Changes to creature {c_old['name']}", change(f"Changed {', '.join(fields)}", indent) + "</p>"]
+    return fields, lines
+
+def hash_source(source: Any, cache: Dict[str, List[str]]) -> Tuple[str, Dict[str, Tuple[str, Any]]]:
+    '''Hash of a source and name -> (hash, creature) for its creatures. The source hash covers its details and the
+    hashes of its creatures. Creature hashes are taken from and added to cache, keyed by source title'''
+    creature_list = source.get('creatures', [])
+    hashes = cache.get(source['title'])
+    if hashes is None or len(hashes) != len(creature_list):
+        hashes = [content_hash(c) for c in creature_list]
+        cache[source['title']] = hashes
+    creatures = {c['name']: (h, c) for h, c in zip(hashes, creature_list)}
+    details = {k: v for k, v in source.items() if k != 'creatures'}
+    sha = hashlib.sha1(content_hash(details).encode("utf8"))
+    for name, (h, _) in creatures.items():
+        sha.update(f"{name}\0{h}\0".encode("utf8"))
+    return sha.hexdigest(), creatures
+
+def load_hash_cache(filename: str) -> Dict[str, List[str]]:
+    '''Creature hashes saved for an internal format file, empty if the file has changed since they were saved'''
+    path = filename + ".diff-hashes.json"
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    stat = os.stat(filename)
+    if data.get("file") != [stat.st_size, stat.st_mtime_ns]:
+        return {}
+    return data["sources"]
+
+def save_hash_cache(filename: str, cache: Dict[str, List[str]]):
+    '''Save creature hashes next to an internal format file so later diffs against it don't hash it again'''
+    stat = os.stat(filename)
+    with open(filename + ".diff-hashes.json", 'w', encoding='utf-8') as f:
+        json.dump({"file": [stat.st_size, stat.st_mtime_ns], "sources": cache}, f, separators=(",", ":"))
+
+def iter_diff(f_old: Any, f_new: Any, counts: Counter, fields: Counter, indent: int=4, workers: int=1,
+        cache_old: Optional[Dict[str, List[str]]]=None, cache_new: Optional[Dict[str, List[str]]]=None) -> Iterator[Any]:
+    '''Yield diff events in report order, counting sources, creatures and changed fields as they go. Changed
+    creatures are diffed in worker processes if workers is more than one. If both hash caches are given sources and
+    creatures are compared by hash, read from and added to the caches. Otherwise they are compared directly'''
+    hashed = cache_old is not None and cache_new is not None
     titles_old = {e['title']:e  for e in f_old}
     titles_new= {e['title']:e for e in f_new}
-    
-    lines = ["<p>Source Changes:"]
 
     ### Full sources that have been added or removed
     for t in titles_new:
         if t not in titles_old:
-            lines.append(added(f"Source: {t}", 0))
-            if "creatures" in titles_new[t]:
-                for c in titles_new[t]["creatures"]:
-                    lines.append(added(f"Creature: {c['name']}", indent))
+            counts["sources_added"] += 1
+            names = [c['name'] for c in titles_new[t].get("creatures", [])]
+            counts["creatures_added"] += len(names)
+            yield {"type": "source_added", "source": t, "creatures": names}
 
-    lines.append("</p><p>Creature Changes:")
+    yield {"type": "section"}
 
     for t in titles_old:
         if t not in titles_new:
-            lines.append(remove(f"Source: {t}", 0))
-            if "creatures" in titles_old[t]:
-                for c in titles_old[t]["creatures"]:
-                    lines.append(remove(f"Creature: {c['name']}", indent))
-
+            counts["sources_removed"] += 1
+            names = [c['name'] for c in titles_old[t].get("creatures", [])]
+            counts["creatures_removed"] += len(names)
+            yield {"type": "source_removed", "source": t, "creatures": names}
+
+    ### Compare the shared sources, planning the work for the ones that changed
+    plan = []
+    to_diff = []
     for t in titles_new:
         if t not in titles_old:
             continue
 
-        tn = titles_new[t]
-        to = titles_old[t]
-
-        cns = {c['name']: c for c in tn['creatures']}
-        cos = {c['name']: c for c in to['creatures']}
-
-        lines.append(f"Source {t}")
+        if hashed:
+            ho, cos = hash_source(titles_old[t], cache_old)
+            hn, cns = hash_source(titles_new[t], cache_new)
+            same = ho == hn
+        else:
+            ### Dict equality runs in C and stops at the first difference, much cheaper than hashing both files
+            cos = {c['name']: (None, c) for c in titles_old[t].get('creatures', [])}
+            cns = {c['name']: (None, c) for c in titles_new[t].get('creatures', [])}
+            same = titles_old[t] == titles_new[t]
+        if same:
+            counts["sources_unchanged"] += 1
+            counts["creatures_unchanged"] += len(cns)
+            plan.append((t, None, len(cns)))
+            continue
 
+        counts["sources_changed"] += 1
+        steps = []
+        unchanged = 0
         for c in cns:
             if c not in cos:
-                lines.append(added(f"Creature: {c} added to source: {t}", indent+1))
+                steps.append(("creature_added", c))
+            elif (cos[c][0] == cns[c][0]) if hashed else (cos[c][1] == cns[c][1]):
+                unchanged += 1
             else:
-                lines += diff_creature(cos[c], cns[c], indent+1)
-
+                steps.append(("creature_changed", c, cos[c][1], cns[c][1]))
+                to_diff.append((cos[c][1], cns[c][1], indent+1))
         for c in cos:
             if c not in cns:
-                lines.append(remove(f"Creature: {c} removed from source: {t}", indent+1))
-            
-    lines.append("</p>")
-
-    return """
+                steps.append(("creature_removed", c))
+        counts["creatures_unchanged"] += unchanged
+        plan.append((t, steps, unchanged))
+
+    executor = None
+    if workers > 1 and len(to_diff) > workers:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(diff_changed_creature, to_diff, chunksize=max(1, min(64, len(to_diff) // (workers * 4))))
+    else:
+        results = map(diff_changed_creature, to_diff)
+
+    try:
+        for t, steps, unchanged in plan:
+            if steps is None:
+                yield {"type": "source_unchanged", "source": t, "unchanged": unchanged}
+                continue
+
+            yield {"type": "source", "source": t}
+            for step in steps:
+                if step[0] == "creature_changed":
+                    changed, lines = next(results)
+                    counts["creatures_changed"] += 1
+                    fields.update(changed)
+                    c_old, c_new = step[2], step[3]
+                    yield {"type": "creature_changed", "source": t, "creature": step[1], "fields": changed, "html": lines,
+                           "changes": [{"field": f, "old": c_old.get(f), "new": c_new.get(f)} for f in changed]}
+                else:
+                    counts["creatures_added" if step[0] == "creature_added" else "creatures_removed"] += 1
+                    yield {"type": step[0], "source": t, "creature": step[1]}
+            yield {"type": "source_end", "source": t, "unchanged": unchanged}
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+class HtmlReport(object):
+    '''Writes diff events as an HTML report'''
+
+    def __init__(self, out: TextIO, indent: int=4):
+        self.out = out
+        self.indent = indent
+        self.first = True
+        out.write("""
     <!Doctype Html>  
     <html>
     {}
     <body>
-    {}
+    """.format(header()))
+        self.line("<p>Source Changes:")
+
+    def line(self, s: str):
+        if not self.first:
+            self.out.write("</br>")
+        self.out.write(s)
+        self.first = False
+
+    def write(self, event: Any):
+        kind = event["type"]
+        if kind == "source_added":
+            self.line(added(f"Source: {event['source']}", 0))
+            for c in event["creatures"]:
+                self.line(added(f"Creature: {c}", self.indent))
+        elif kind == "section":
+            self.line("</p><p>Creature Changes:")
+        elif kind == "source_removed":
+            self.line(remove(f"Source: {event['source']}", 0))
+            for c in event["creatures"]:
+                self.line(remove(f"Creature: {c}", self.indent))
+        elif kind == "source_unchanged":
+            self.line(f"Source {event['source']}: No changes")
+        elif kind == "source":
+            self.line(f"Source {event['source']}")
+        elif kind == "creature_added":
+            self.line(added(f"Creature: {event['creature']} added to source: {event['source']}", self.indent+1))
+        elif kind == "creature_removed":
+            self.line(remove(f"Creature: {event['creature']} removed from source: {event['source']}", self.indent+1))
+        elif kind == "creature_changed":
+            for l in event["html"]:
+                self.line(l)
+        elif kind == "source_end" and event["unchanged"]:
+            self.line("&nbsp"*(self.indent+1) + f"{event['unchanged']} creatures unchanged")
+
+    def close(self):
+        self.line("</p>")
+        self.out.write("""
     </body>
     </html>
-    """.format(header(), "</br>".join(lines))
+    """)
+
+class JsonReport(object):
+    '''Writes diff events as JSON Lines, one added, removed or changed source or creature per line'''
+
+    def __init__(self, out: TextIO):
+        self.out = out
+
+    def write(self, event: Any):
+        if event["type"] in ["section", "source", "source_end"]:
+            return
+        self.out.write(json.dumps({k: v for k, v in event.items() if k != "html"}, separators=(",", ":")))
+        self.out.write("\n")
+
+    def close(self):
+        pass
+
+def summarise(counts: Counter, fields: Counter) -> Any:
+    '''Machine readable summary of a diff'''
+    old_creatures = counts["creatures_unchanged"] + counts["creatures_changed"] + counts["creatures_removed"]
+    return {
+        "sources": {k: counts[f"sources_{k}"] for k in ["added", "removed", "changed", "unchanged"]},
+        "creatures": {k: counts[f"creatures_{k}"] for k in ["added", "removed", "changed", "unchanged"]},
+        "changed_ratio": (counts["creatures_changed"] + counts["creatures_removed"]) / old_creatures if old_creatures else 0.0,
+        "fields": dict(fields.most_common())
+    }
+
+def check_thresholds(summary: Any, max_changed: Optional[int]=None, max_removed: Optional[int]=None,
+        max_ratio: Optional[float]=None) -> List[str]:
+    '''Returns a message for every threshold the diff goes past'''
+    failures = []
+    if max_changed is not None and summary["creatures"]["changed"] > max_changed:
+        failures.append(f"{summary['creatures']['changed']} creatures changed, more than {max_changed}")
+    if max_removed is not None and summary["creatures"]["removed"] > max_removed:
+        failures.append(f"{summary['creatures']['removed']} creatures removed, more than {max_removed}")
+    if max_ratio is not None and summary["changed_ratio"] > max_ratio:
+        failures.append(f"{summary['changed_ratio']:.2%} of creatures changed or removed, more than {max_ratio:.2%}")
+    return failures
+
+def diff_mw_file(f_old: Any, f_new: Any, indent: int=4) -> str:
+    '''Diff two internal format files into a single HTML string'''
+    out = io.StringIO()
+    report = HtmlReport(out, indent)
+    for event in iter_diff(f_old, f_new, Counter(), Counter(), indent):
+        report.write(event)
+    report.close()
+    return out.getvalue()
 
 def diff_optional_feature(feature: str, c_old: Any, c_new: Any, indent: int) -> List[str]:
     diffs = []
@@ -127,12 +337,12 @@ def diff_spells(s_old: Any, s_new: Any, indent: int) -> List[str]:
     diffs = []
     for l in so:
         if l not in sn:
-            diffs.append(remove(f'Spell level {l}: {so[l]} -> None'))
-        if so[l] != sn[l]:
-            add_or_change_diff(so, sn, 'frequency', f'level {l} spell frequency', indent)
-            add_or_change_diff(so, sn, 'spells', f'level {l} spells', indent)
-            add_or_change_diff(so, sn, 'slots', f'level {l} slots', indent)
-            add_or_change_diff(so, sn, 'each', 'level {l} each setting', indent)
+            diffs.append(remove(f'Spell level {l}: {so[l]} -> None', indent))
+        elif so[l] != sn[l]:
+            diffs += add_or_change_diff(so[l], sn[l], 'frequency', f'level {l} spell frequency', indent)
+            diffs += add_or_change_diff(so[l], sn[l], 'spells', f'level {l} spells', indent)
+            diffs += add_or_change_diff(so[l], sn[l], 'slots', f'level {l} slots', indent)
+            diffs += add_or_change_diff(so[l], sn[l], 'each', f'level {l} each setting', indent)
     
     for l in sn:
         if l not in so:
@@ -170,7 +380,7 @@ def diff_creature(c_old: Any, c_new: Any, indent: int) -> List[str]:
 
     for atr in ['Name', 'Size', 'Creature Type', 'Alignment', 'AC', 'HP', 'Speed', "Abilities",
                 'Saves', 'Skills', 'Senses', 'Passive', 'Resistances', 
-                'Damange Immunities', 'Condition Immunities', 'Vulnerabilities', 
+                'Damage Immunities', 'Condition Immunities', 'Vulnerabilities', 
                 'Languages', 'CR', 'Proficiency']:
         diff_lines += diff_optional_feature(atr, c_old, c_new, indent)
 
@@ -192,24 +402,59 @@ def diff_creature(c_old: Any, c_new: Any, indent: int) -> List[str]:
     return diff_lines
 
 if __name__ == "__main__":
-
-    if len(sys.argv) >= 3:
-        old = sys.argv[1]
-        new = sys.argv[2]
-    else:
-        old = "statblocks\statblocks.mw"
-        new = "statblocks\statblocks_new.mw"
-    if len(sys.argv) == 4:
-        out = sys.argv[3]
-    else:
-        out = "diff.html"
-
-    with open(old, 'r', encoding='utf-8') as f_old:
-        with open(new, 'r', encoding='utf-8') as f_new:
-            old_data = json.load(f_old)
-            new_data = json.load(f_new)
-            result = diff_mw_file(old_data, new_data)
-
-    with open(out, 'w', encoding='utf-8') as f:
-        f.write(result)
-
+    parser = argparse.ArgumentParser(description="Diff two internal format files")
+    parser.add_argument("old", type=str, nargs="?", default="statblocks\\statblocks.mw", help="Old internal format file")
+    parser.add_argument("new", type=str, nargs="?", default="statblocks\\statblocks_new.mw", help="New internal format file")
+    parser.add_argument("out", type=str, nargs="?", default="diff.html", help="HTML report to write")
+    parser.add_argument("--json", type=str, default=None, help="Also write the changes as JSON Lines to this file")
+    parser.add_argument("--summary", type=str, default=None, help="Write a JSON summary of the diff to this file")
+    parser.add_argument("--cache-hashes", action="store_true", default=False, help="Keep creature hashes next to each input file so they are only computed once per file")
+    parser.add_argument("--workers", "-w", type=int, default=1, help="Processes used to diff changed creatures. Only worth raising when many creatures changed")
+    parser.add_argument("--max-changed", type=int, default=None, help="Fail if more creatures than this have changed")
+    parser.add_argument("--max-removed", type=int, default=None, help="Fail if more creatures than this have been removed")
+    parser.add_argument("--max-changed-ratio", type=float, default=None, help="Fail if more than this fraction of creatures have changed or been removed")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with open(args.old, 'r', encoding='utf-8') as f_old:
+        old_data = json.load(f_old)
+    with open(args.new, 'r', encoding='utf-8') as f_new:
+        new_data = json.load(f_new)
+
+    counts = Counter()
+    fields = Counter()
+    cache_old = load_hash_cache(args.old) if args.cache_hashes else None
+    cache_new = load_hash_cache(args.new) if args.cache_hashes else None
+    with open(args.out, 'w', encoding='utf-8') as f:
+        reports = [HtmlReport(f)]
+        f_json = open(args.json, 'w', encoding='utf-8') if args.json else None
+        if f_json is not None:
+            reports.append(JsonReport(f_json))
+        try:
+            for event in iter_diff(old_data, new_data, counts, fields, workers=args.workers, cache_old=cache_old, cache_new=cache_new):
+                for r in reports:
+                    r.write(event)
+            for r in reports:
+                r.close()
+        finally:
+            if f_json is not None:
+                f_json.close()
+
+    if args.cache_hashes:
+        save_hash_cache(args.old, cache_old)
+        save_hash_cache(args.new, cache_new)
+
+    summary = summarise(counts, fields)
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=4)
+
+    c = summary["creatures"]
+    print(f"Creatures: {c['changed']} changed, {c['added']} added, {c['removed']} removed, {c['unchanged']} unchanged "
+          f"in {summary['seconds']:.2f}s", file=sys.stderr)
+
+    failures = check_thresholds(summary, args.max_changed, args.max_removed, args.max_changed_ratio)
+    for failure in failures:
+        print(f"Threshold exceeded: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
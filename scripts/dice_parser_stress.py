@@ -0,0 +1,91 @@
+import argparse
+import random
+import sys
+import time
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import extractor.dice_parser as dice_parser
+
+### Fuzz and stress check for the dice parser. Generates random, malformed OCR-like lines along with
+### a set of known pathological inputs for the old regex engine and fails if any line takes longer than
+### the allowed time to parse. Lines with OCR artefacts such as superscript digits must also only produce
+### numbers and dice that int() can read.
+
+FRAGMENTS = ["1d6", "2d10", "d", "d8", "+", "-", " ", "  ", "(", ")", "3", "17", "hit", "hit:", "or", ",",
+             ".", "fire", "piercing", "damage", "two hands", "reach", "range", "80/320", "ft", "one", "target",
+             "melee", "weapon", "attack:", "to hit", "creatures", "'", "dc", "x"]
+
+def random_line(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice(FRAGMENTS) for i in range(length))
+
+def pathological_lines(n: int):
+    yield "1d6 " * n + "x"
+    yield "1" * n + "d"
+    yield "(1d6 + " * n
+    yield "or " + "1d2 + 3 " * n + "with one hand"
+    yield "hit: " + "7 " * n
+    yield ", one target" + ", abc" * n + " hit"
+    yield "melee weapon attack: +4 to hit, reach 5 ft., one target. hit: " + "5 (1d6 + 2) " * n + "bludgeoning damage"
+
+### OCR artefacts that look like digits but aren't ASCII digits
+ARTEFACT_LINES = [
+    "melee weapon attack: +4 to hit, reach 5² ft., one target. hit: 5 (1d6 + 2) bludgeoning damage",
+    "ranged weapon attack: +4 to hit, range 80/320³ ft., one target. hit: 5 (1d6¹ + 2) piercing damage",
+    "hit: 7 (2d6 + 3) slashing damage. dc 15¹ strength saving throw",
+]
+
+def bad_numbers(line: str):
+    '''Number and dice tokens of a line that int() can't read'''
+    bad = []
+    for t in dice_parser.tokenise(line.lower()):
+        if t.type in [dice_parser.TokenTypes.number, dice_parser.TokenTypes.dice]:
+            try:
+                [int(p) for p in t.text.lower().split("d")]
+            except ValueError:
+                bad.append(t.text)
+    return bad
+
+def parse(line: str):
+    text = line.lower()
+    tokens = dice_parser.tokenise(text)
+    dice_parser.parse_attack(text, tokens)
+    dice_parser.find_rolls(text, tokens)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fuzz and stress test the dice parser")
+    parser.add_argument("--lines", type=int, default=5000, help="Number of random lines to generate")
+    parser.add_argument("--length", type=int, default=200, help="Number of fragments per random line")
+    parser.add_argument("--stress-size", type=int, default=2000, help="Repetitions used for pathological lines")
+    parser.add_argument("--max-ms", type=float, default=250, help="Maximum allowed time to parse a single line")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    lines = [random_line(rng, rng.randint(1, args.length)) for i in range(args.lines)]
+    lines += list(pathological_lines(args.stress_size))
+
+    worst = (0, "")
+    failures = 0
+    for line in lines:
+        start = time.perf_counter()
+        parse(line)
+        taken = (time.perf_counter() - start) * 1000
+        if taken > worst[0]:
+            worst = (taken, line)
+        if taken > args.max_ms:
+            failures += 1
+            print(f"SLOW ({taken:.1f}ms, {len(line)} chars): {line[:80]}...")
+
+    for line in ARTEFACT_LINES:
+        parse(line)
+        bad = bad_numbers(line)
+        if bad:
+            failures += 1
+            print(f"UNREADABLE NUMBERS {bad}: {line}")
+
+    print(f"Parsed {len(lines)} lines. Slowest took {worst[0]:.1f}ms ({len(worst[1])} chars)")
+    if failures > 0:
+        print(f"{failures} lines were too slow or produced unreadable numbers")
+        sys.exit(1)
@@ -0,0 +1,84 @@
+import argparse
+import json
+import sys
+import os
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from outputs.line_store import read_lines
+from utils.near_duplicates import NearDuplicateFinder, duplicate_indexes
+
+### Finds near-duplicate creatures across internal format files (.json, or .jsonl written with '--storage lines'),
+### e.g. the same SRD monster reprinted with small edits in several books, e.g.
+###     python scripts/find_duplicates.py statblocks.json --prefer "SRD" --dedup statblocks.dedup.json
+### Clusters are printed with their canonical entry first. --dedup writes the input with only the canonical entry
+### of each cluster kept.
+
+def load_sources(filename: str) -> list:
+    '''Source entries of an internal format file'''
+    if not filename.endswith(".jsonl"):
+        with open(filename, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    entries = {}
+    for record in read_lines(filename):
+        entry = entries.setdefault(record["title"], {"source": {"title": record["title"]}, "title": record["title"], "creatures": []})
+        if "creature" in record:
+            entry["creatures"].append(record["creature"])
+    return list(entries.values())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find near-duplicate creatures across sources")
+    parser.add_argument("files", type=str, nargs="+", help="Internal format files to search")
+    parser.add_argument("--prefer", type=str, nargs="*", default=[], help="Source titles to take canonical entries from, most preferred first")
+    parser.add_argument("--threshold", type=float, default=0.5, help="Minimum estimated statblock text similarity of a candidate pair")
+    parser.add_argument("--field-threshold", type=float, default=0.8, help="Minimum field by field similarity for a pair to be duplicates")
+    parser.add_argument("--bands", type=int, default=32, help="Number of LSH bands, more bands finds less similar candidates")
+    parser.add_argument("--perms", type=int, default=128, help="Number of MinHash permutations, must be a multiple of bands")
+    parser.add_argument("--output", "-o", type=str, default=None, help="Write the clusters to a JSON file")
+    parser.add_argument("--dedup", type=str, default=None, help="Write the input sources with duplicates removed to this file")
+    parser.add_argument("--quiet", "-q", action="store_true", default=False, help="Only print the summary")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    finder = NearDuplicateFinder(num_perm=args.perms, bands=args.bands, jaccard_threshold=args.threshold, field_threshold=args.field_threshold)
+
+    sources = []
+    for f in args.files:
+        sources += load_sources(f)
+    for source_entry in sources:
+        for c in source_entry["creatures"]:
+            finder.add(source_entry["title"], c)
+    signed = time.perf_counter()
+
+    clusters = finder.clusters(prefer=args.prefer)
+    elapsed = time.perf_counter() - start
+
+    if not args.quiet:
+        for cluster in clusters:
+            print(f"{cluster.canonical.name} ({cluster.canonical.source})")
+            for d in cluster.duplicates:
+                differs = f": {', '.join(d.differs)}" if d.differs else ""
+                print(f"\t{d.similarity:.2f} {d.creature.name} ({d.creature.source}){differs}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump([c.to_json() for c in clusters], f, indent=4)
+
+    removed = duplicate_indexes(clusters)
+    if args.dedup:
+        index = 0
+        for source_entry in sources:
+            kept = []
+            for c in source_entry["creatures"]:
+                if index not in removed:
+                    kept.append(c)
+                index += 1
+            source_entry["creatures"] = kept
+        with open(args.dedup, 'w', encoding='utf-8') as f:
+            json.dump(sources, f, indent=4)
+
+    print(f"{len(finder.creatures)} creatures, {len(clusters)} clusters, {len(removed)} duplicates. "
+          f"Checked {finder.stats['candidates']} candidate pairs ({finder.stats['verified']} field by field). "
+          f"Signing took {signed - start:.2f}s, total {elapsed:.2f}s", file=sys.stderr)
@@ -0,0 +1,64 @@
+import argparse
+import json
+import re
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from extractor import constants
+from outputs.pluto_writer import PlutoWriter
+
+### Compares the single pass 5e tools tag rewriter against the original chain of substitutions over every feature
+### and action text in one or more internal format files. Whitespace is collapsed before comparing since the old
+### chain added spaces around some tags.
+
+def legacy_format_text(text: str) -> str:
+    '''The original chain of substitutions used by PlutoWriter'''
+    text = re.sub("\s([+-]?[0-9]+)\s*to\s*hit", " {@hit \g<1>} to hit", text, flags=re.IGNORECASE)
+    text = re.sub("Melee\s*or\s*Ranged\s*Weapon\s*Attack", "{@atk mw,rw}", text, re.IGNORECASE)
+    text = re.sub("Melee\s*Weapon\s*Attack:", "{@atk mw}", text, re.IGNORECASE)
+    text = re.sub("Ranged\s*Weapon\s*Attack:", "{@atk rw}", text, re.IGNORECASE)
+    text = re.sub("\s*([0-9]+\s)?(\()?((?:[+-]?\s*[0-9]+d[0-9]+\s*)+(?:[+-]?\s*[0-9]+)?)(\)?\s+)(({})\s+damage)".format("|".join(constants.enum_values(constants.DAMAGE_TYPES))),
+            " \g<1>\g<2>{@damage \g<3>}\g<4>\g<5>", text, flags=re.IGNORECASE)
+    text = re.sub("(?:Hit: )([0-9]+)\s", "{@h}\g<1> ", text, flags=re.IGNORECASE)
+    text = re.sub("\s+(dc)\s*([0-9]+)([()\s,])", " {@dc \g<2>}\g<3>", text, flags=re.IGNORECASE)
+    text = re.sub("(?<!damage\s)([0-9]+d[0-9]+)\s*([+-]\s*[0-9]+)?\s*([^}])", " {@dice \g<1>\g<2>} \g<3>", text)
+    return text
+
+def normalise(text: str) -> str:
+    '''Collapse whitespace, including inside tags'''
+    text = re.sub("\s+", " ", text).strip()
+    text = re.sub("\{\s*(@\w+)\s*([^}]*?)\s*\}", lambda m: "{" + m.group(1) + " " + re.sub("\s", "", m.group(2)) + "}", text)
+    return re.sub("\s+([.,;:)])", "\g<1>", text).replace("( ", "(")
+
+def creature_texts(creature):
+    for key in ["features", "action", "bonus", "legendary", "mythic", "reaction", "lair"]:
+        for entry in creature.get(key, []):
+            if "text" in entry:
+                yield entry["text"]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the single pass tag rewriter with the original substitution chain")
+    parser.add_argument("corpus", type=str, nargs='+', help="Internal format json files")
+    parser.add_argument("--show", type=int, default=20, help="Number of differences to print")
+    args = parser.parse_args()
+
+    total = 0
+    differences = []
+    for path in args.corpus:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        for source in data:
+            for creature in source["creatures"]:
+                for text in creature_texts(creature):
+                    total += 1
+                    old = legacy_format_text(text)
+                    new = PlutoWriter.format_text(text)
+                    if normalise(old) != normalise(new):
+                        differences.append((creature.get("name"), text, old, new))
+
+    print(f"Compared {total} texts, {len(differences)} differ")
+    for name, text, old, new in differences[:args.show]:
+        print(f"{name}:\n\tinput: {text}\n\told:   {old}\n\tnew:   {new}")
+    sys.exit(1 if len(differences) > 0 else 0)
@@ -0,0 +1,98 @@
+import argparse
+import configparser
+import random
+import string
+import sys
+import time
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import editdistance
+
+from utils.bk_tree import BKTree
+
+### Compares the BK-tree used for fuzzy compendium matching against the original linear scan. Uses the names
+### from the compendium index if a config is given, otherwise random spell-like names. Fails if the two disagree.
+
+def linear_scan(names, n, distance_threshold):
+    '''The original scan over every name sharing a first letter'''
+    best = None
+    best_dist = 1000000
+    for k in names:
+        if k[0] != n[0]:
+            continue
+        dist = editdistance.eval(n, k)
+        if dist < best_dist:
+            best = k
+            best_dist = dist
+    return best if best_dist <= distance_threshold else None
+
+def tree_search(trees, n, distance_threshold):
+    if n[0] not in trees:
+        return None
+    matches = trees[n[0]].query(n, distance_threshold)
+    return matches[0][2] if len(matches) > 0 else None
+
+def random_names(rng: random.Random, count: int):
+    syllables = ["fire", "ball", "mage", "hand", "ice", "storm", "bolt", "shield", "cure", "wounds", "light", "dark",
+                 "ness", "ray", "frost", "word", "power", "kill", "blade", "ward", "step", "misty", "gust", "wind"]
+    names = set()
+    while len(names) < count:
+        names.add(" ".join("".join(rng.choice(syllables) for i in range(rng.randint(1, 2))) for j in range(rng.randint(1, 3))))
+    return list(names)
+
+def perturb(rng: random.Random, name: str, edits: int):
+    chars = list(name)
+    for i in range(edits):
+        op = rng.randint(0, 2)
+        pos = rng.randint(1, max(1, len(chars) - 1))
+        if op == 0 and len(chars) > 2:
+            del chars[pos]
+        elif op == 1:
+            chars.insert(pos, rng.choice(string.ascii_lowercase))
+        else:
+            chars[min(pos, len(chars) - 1)] = rng.choice(string.ascii_lowercase)
+    return "".join(chars)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark BK-tree fuzzy matching against a linear scan")
+    parser.add_argument("--config", "-c", type=str, default=None, help="Use names from the compendium index for this config")
+    parser.add_argument("--type", type=str, default="item", help="Compendium type to take names from")
+    parser.add_argument("--names", type=int, default=20000, help="Number of random names if no config is given")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--threshold", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.config:
+        from outputs.fvtt.compendium_index import get_compendium_index
+        from utils.logger import get_logger
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        names = list(get_compendium_index(config, get_logger(False)).compendia[args.type].keys())
+    else:
+        names = random_names(rng, args.names)
+    names = [n for n in names if len(n) > 0]
+
+    queries = [perturb(rng, rng.choice(names), rng.randint(0, args.threshold + 1)) for i in range(args.queries)]
+
+    start = time.perf_counter()
+    trees = BKTree.by_first_letter(names)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = [linear_scan(names, q, args.threshold) for q in queries]
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    found = [tree_search(trees, q, args.threshold) for q in queries]
+    tree_time = time.perf_counter() - start
+
+    mismatches = sum(1 for e, f in zip(expected, found) if e != f)
+    print(f"{len(names)} names, {len(queries)} queries, threshold {args.threshold}")
+    print(f"Linear scan: {1000 * scan_time / len(queries):.3f}ms per query")
+    print(f"BK-tree:     {1000 * tree_time / len(queries):.3f}ms per query (built in {build_time:.2f}s)")
+    print(f"Speed up:    {scan_time / max(tree_time, 1e-9):.1f}x, {mismatches} mismatched results")
+    sys.exit(1 if mismatches > 0 else 0)
@@ -0,0 +1,75 @@
+import argparse
+import configparser
+import json
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from data_loaders.pdf_loader import PDFLoader
+from data_loaders.textract_image_loader import TextractImageLoader
+from extractor.extractor import StatblockExtractor
+from extractor.statblock_filter import StatblockFilter
+from utils.logger import get_logger
+
+### Measures how the statblock pre-filter behaves on a labelled corpus. Every candidate statblock is scored and fully
+### parsed, a false reject is a candidate below the threshold that parses into a creature listed in the labels file
+### (an internal format output of known good creatures). Without labels any valid creature counts. Candidates are
+### parsed once, by the extractor itself, and the creature each one produced is recorded as it is parsed.
+
+def load_labels(path: str):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return set(c["name"].lower() for source in data for c in source["creatures"])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report false rejects of the statblock pre-filter against a labelled corpus")
+    parser.add_argument("target", type=str, nargs='+', help="PDFs or images to scan")
+    parser.add_argument("--labels", type=str, default=None, help="Internal format json file listing the expected creatures")
+    parser.add_argument("--threshold", type=float, nargs='+', default=[0.2, 0.4, 0.6, 0.8], help="Thresholds to report on")
+    parser.add_argument("--config", "-c", type=str, default="default.conf", help="Configuration file for controlling parser")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    for section in ["default", "creature", "filter", "source"]:
+        if not config.has_section(section):
+            config.add_section(section)
+    config.set("default", "debug", "false")
+    config.set("creature", "validation", "off")
+    ### Keep every candidate so we can see what the filter would have dropped
+    config.set("filter", "threshold", "0")
+
+    logger = get_logger(False)
+    labels = load_labels(args.labels) if args.labels else None
+
+    ### (source name, statblock, creature name) for every candidate, in the order they were parsed
+    parsed = []
+    def record(source, sb, cr):
+        parsed.append((source.name, sb, cr.data["name"] if cr is not None and "name" in cr.data else None))
+
+    se = StatblockExtractor(config, logger)
+    se.register_data_loader(TextractImageLoader)
+    se.register_data_loader(PDFLoader)
+    se.register_statblock_callback(record)
+    results = se.parse(args.target)
+    if not results:
+        sys.exit(1)
+
+    ### Scores only use the line annotations, so scoring after parsing gives the same result as the extractor's filter
+    sb_filter = StatblockFilter(config, logger)
+    scores = sb_filter.score([sb for _, sb, _ in parsed])
+
+    scored = []
+    for (source_name, _, name), score in zip(parsed, scores):
+        positive = name is not None and (name.lower() in labels if labels is not None else True)
+        scored.append((score, positive, source_name, name))
+
+    num_positive = sum(1 for s in scored if s[1])
+    print(f"Scored {len(scored)} candidates, {num_positive} are creatures")
+    for t in args.threshold:
+        rejected = [s for s in scored if s[0] < t]
+        false_rejects = [s for s in rejected if s[1]]
+        print(f"Threshold {t:.2f}: rejected {len(rejected)}, false rejects {len(false_rejects)}")
+        for score, _, source_name, name in false_rejects:
+            print(f"\t{source_name}: {name} (score {score:.2f})")
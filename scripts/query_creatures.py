@@ -0,0 +1,53 @@
+import argparse
+import json
+import sys
+import os
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from outputs.sqlite_writer import connect, query_creatures
+
+### Search a creature database written with '--format sqlite', e.g. every CR 5 undead across all sources:
+###     python scripts/query_creatures.py creatures.sqlite --cr 5 --type undead
+
+def parse_cr(s: str) -> float:
+    '''Accept fractional CRs written as 1/4'''
+    if "/" in s:
+        num, den = s.split("/")
+        return float(num) / float(den)
+    return float(s)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query creatures stored by the sqlite writer")
+    parser.add_argument("database", type=str, help="Database written with '--format sqlite'")
+    parser.add_argument("--name", "-n", type=str, default=None, help="Creature name prefix (case insensitive)")
+    parser.add_argument("--cr", type=parse_cr, default=None, help="Exact challenge rating")
+    parser.add_argument("--min-cr", type=parse_cr, default=None, help="Minimum challenge rating")
+    parser.add_argument("--max-cr", type=parse_cr, default=None, help="Maximum challenge rating")
+    parser.add_argument("--type", "-t", type=str, default=None, help="Creature type, e.g. undead")
+    parser.add_argument("--size", type=str, default=None, help="Creature size, e.g. large")
+    parser.add_argument("--source", "-s", type=str, default=None, help="Source title")
+    parser.add_argument("--spell", type=str, default=None, help="Only creatures that can cast a spell starting with this name")
+    parser.add_argument("--limit", type=int, default=100, help="Maximum number of results")
+    parser.add_argument("--json", action="store_true", default=False, help="Print the full internal format JSON of each result, one per line")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.database):
+        parser.error(f"No database at {args.database}")
+
+    conn = connect(args.database)
+    start = time.perf_counter()
+    rows = query_creatures(conn, name=args.name, cr=args.cr, min_cr=args.min_cr, max_cr=args.max_cr,
+        creature_type=args.type, size=args.size, source=args.source, spell=args.spell, limit=args.limit)
+    elapsed = time.perf_counter() - start
+
+    for row in rows:
+        if args.json:
+            print(json.dumps(json.loads(row["data"]), separators=(",", ":")))
+        else:
+            cr = row["cr"]
+            cr_text = "-" if cr is None else (str(int(cr)) if cr >= 1 or cr == 0 else f"1/{round(1 / cr)}")
+            swarm = "swarm of " if row["swarm"] else ""
+            print(f"{row['name']:<32} CR {cr_text:<4} {row['size'] or '':<10} {swarm}{row['creature_type'] or ''}\t{row['source']}")
+    print(f"{len(rows)} creatures in {elapsed * 1000:.1f}ms", file=sys.stderr)
@@ -0,0 +1,246 @@
+import argparse
+import configparser
+import copy
+import json
+import statistics
+import subprocess
+import sys
+import os
+import time
+
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from creature_diff import changed_fields, iter_diff, HtmlReport
+from data_loaders.pdf_loader import PDFLoader
+from data_loaders.textract_image_loader import TextractImageLoader
+from extractor.extractor import StatblockExtractor
+from utils.logger import get_logger
+
+### Runs the extractor over a golden corpus of PDFs with known good internal format output and tracks throughput and
+### accuracy between runs. The corpus is an INI file with a [thresholds] section and one section per source, e.g.
+###
+###     [thresholds]
+###     # Fail if pages/sec falls below this fraction of the baseline
+###     throughput = 0.8
+###     # Fail if field accuracy falls by more than this
+###     accuracy = 0.01
+###     # Fail if this many fewer statblocks are found
+###     statblocks = 0
+###
+###     [srd]
+###     pdf = corpus/SRD-OGL_V5.1.pdf
+###     expected = corpus/srd.json
+###     pages = 254,255,256
+###
+### Every run is appended to a history file (JSON Lines) and compared against the median of the last few passing
+### runs, so a single noisy run doesn't become the baseline. The script exits with 1 if any source regresses.
+### Sources are loaded before the timer starts, so throughput covers finding and parsing statblocks whether or not the
+### loader cache was warm. The history records the loader cache setting of each run.
+
+### Keys that depend on where the output was written rather than on extraction
+IGNORED_FIELDS = ["source"]
+
+### What the recorded seconds cover, runs are only compared with a baseline timed the same way
+TIMED = "extraction"
+
+def field_accuracy(expected: List[Any], parsed: List[Any]) -> Dict[str, Any]:
+    '''Compare parsed creatures with the expected ones, matched by name. Every field of an expected creature is
+    counted, fields of missing creatures count as wrong'''
+    by_name = {}
+    for c in parsed:
+        by_name.setdefault(c["name"].lower(), []).append(c)
+
+    total = 0
+    correct = 0
+    matched = 0
+    wrong_fields = Counter()
+    for e in expected:
+        fields = [k for k in e.keys() if k not in IGNORED_FIELDS]
+        total += len(fields)
+        candidates = by_name.get(e["name"].lower())
+        if not candidates:
+            wrong_fields["missing creature"] += 1
+            continue
+        matched += 1
+        changed = set(changed_fields(e, candidates.pop(0)))
+        correct += sum(1 for k in fields if k not in changed)
+        wrong_fields.update(k for k in changed if k not in IGNORED_FIELDS)
+
+    return {
+        "expected": len(expected),
+        "matched": matched,
+        "extra": sum(len(v) for v in by_name.values()),
+        "field_accuracy": correct / total if total else 1.0,
+        "wrong_fields": dict(wrong_fields.most_common()),
+    }
+
+def load_expected(path: str) -> List[Any]:
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return [c for source in data for c in source["creatures"]]
+
+def loader_cache_mode(config: configparser.ConfigParser) -> str:
+    '''How sources are loaded, recorded with each run. Loading isn't timed but is reported'''
+    if not config.getboolean("default", "use_cache", fallback=True):
+        return "off"
+    return "flush" if config.getboolean("default", "flush_cache", fallback=False) else "on"
+
+def run_source(se: StatblockExtractor, name: str, section: Any, repeat: int, report_dir: Optional[str]) -> Optional[Dict[str, Any]]:
+    '''Parse one corpus source, returning its measurements. The source is loaded once and only finding and parsing the
+    statblocks is timed, so the result doesn't depend on whether the loader cache was warm. With repeat the fastest
+    of several parses is timed'''
+    pages = [int(p) for p in section.get("pages").split(",")] if section.get("pages") else None
+
+    start = time.perf_counter()
+    sources = se.load_data(section["pdf"])
+    load_seconds = time.perf_counter() - start
+    if not sources:
+        return None
+
+    seconds = None
+    for _ in range(max(repeat, 1)):
+        ### Parsing annotates the loaded lines, so every repeat starts from a fresh copy
+        copies = copy.deepcopy(sources)
+        start = time.perf_counter()
+        results = se.parse_sources(copies, pages=pages)
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+    parsed = []
+    num_pages = 0
+    for source, creatures in results[0].values():
+        parsed += [c.to_json() for c in creatures]
+        num_pages += len(pages) if pages else source.num_pages
+
+    expected = load_expected(section["expected"])
+    result = {
+        "seconds": round(seconds, 3),
+        "load_seconds": round(load_seconds, 3),
+        "pages": num_pages,
+        "pages_per_second": num_pages / seconds if seconds > 0 else 0.0,
+        "statblocks": len(parsed),
+    }
+    result.update(field_accuracy(expected, parsed))
+
+    if report_dir:
+        os.makedirs(report_dir, exist_ok=True)
+        old = [{k: v for k, v in c.items() if k not in IGNORED_FIELDS} for c in expected]
+        new = [{k: v for k, v in c.items() if k not in IGNORED_FIELDS} for c in parsed]
+        with open(os.path.join(report_dir, f"{name}.html"), 'w', encoding='utf-8') as f:
+            report = HtmlReport(f)
+            for event in iter_diff([{"title": name, "creatures": old}], [{"title": name, "creatures": new}], Counter(), Counter()):
+                report.write(event)
+            report.close()
+
+    return result
+
+def load_history(path: str) -> List[Any]:
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(l) for l in f if l.strip()]
+
+def baseline(history: List[Any], name: str, runs: int) -> Optional[Dict[str, float]]:
+    '''Median measurements of a source over its last few passing runs'''
+    ### Runs from before only extraction was timed also include loading, so they aren't comparable
+    previous = [h["sources"][name] for h in history
+                if h.get("passed") and h.get("timed") == TIMED and name in h.get("sources", {})][-runs:]
+    if len(previous) == 0:
+        return None
+    return {k: statistics.median(p[k] for p in previous) for k in ["pages_per_second", "field_accuracy", "statblocks"]}
+
+def check(result: Dict[str, Any], base: Dict[str, float], thresholds: Any) -> List[str]:
+    '''Returns a message for each threshold a source goes past'''
+    failures = []
+    throughput = thresholds.getfloat("throughput", fallback=0.8)
+    if base["pages_per_second"] > 0 and result["pages_per_second"] < base["pages_per_second"] * throughput:
+        failures.append(f"{result['pages_per_second']:.2f} pages/sec is below {throughput:.0%} of the baseline {base['pages_per_second']:.2f}")
+    accuracy = thresholds.getfloat("accuracy", fallback=0.01)
+    if result["field_accuracy"] < base["field_accuracy"] - accuracy:
+        failures.append(f"field accuracy {result['field_accuracy']:.2%} fell from {base['field_accuracy']:.2%}")
+    statblocks = thresholds.getint("statblocks", fallback=0)
+    if result["statblocks"] < base["statblocks"] - statblocks:
+        failures.append(f"found {result['statblocks']} statblocks, the baseline is {base['statblocks']:.0f}")
+    return failures
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check extraction throughput and accuracy against a golden corpus")
+    parser.add_argument("corpus", type=str, help="Corpus file listing the PDFs, their expected output and thresholds")
+    parser.add_argument("--history", type=str, default="regression_history.jsonl", help="History file results are compared with and added to")
+    parser.add_argument("--sources", type=str, nargs="*", default=None, help="Only run these corpus sources")
+    parser.add_argument("--baseline-runs", type=int, default=5, help="Number of previous passing runs the baseline is the median of")
+    parser.add_argument("--repeat", type=int, default=1, help="Parse each source this many times and time the fastest")
+    parser.add_argument("--report-dir", type=str, default=None, help="Write a creature_diff report of expected against parsed creatures for each source")
+    parser.add_argument("--no-record", action="store_true", default=False, help="Don't add this run to the history")
+    parser.add_argument("--config", "-c", type=str, default="default.conf", help="Configuration file for controlling parser")
+    args = parser.parse_args()
+
+    corpus = configparser.ConfigParser()
+    if not corpus.read(args.corpus):
+        parser.error(f"Can't read corpus file {args.corpus}")
+    if not corpus.has_section("thresholds"):
+        corpus.add_section("thresholds")
+    names = [s for s in corpus.sections() if s != "thresholds" and (args.sources is None or s in args.sources)]
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    for section in ["default", "creature", "filter", "source"]:
+        if not config.has_section(section):
+            config.add_section(section)
+    config.set("default", "debug", "false")
+
+    logger = get_logger(False)
+    se = StatblockExtractor(config, logger)
+    se.register_data_loader(TextractImageLoader)
+    se.register_data_loader(PDFLoader)
+
+    history = load_history(args.history)
+    results = {}
+    failures = []
+    for name in names:
+        result = run_source(se, name, corpus[name], args.repeat, args.report_dir)
+        if result is None:
+            failures.append(f"{name}: failed to parse {corpus[name]['pdf']}")
+            continue
+        results[name] = result
+
+        print(f"{name}: {result['statblocks']} statblocks ({result['matched']}/{result['expected']} expected, {result['extra']} extra), "
+              f"field accuracy {result['field_accuracy']:.2%}, {result['pages']} pages in {result['seconds']:.2f}s "
+              f"(loaded in {result['load_seconds']:.2f}s) "
+              f"({result['pages_per_second']:.2f} pages/sec)")
+        if result["wrong_fields"]:
+            print("\tWrong fields: " + ", ".join(f"{k} ({v})" for k, v in list(result["wrong_fields"].items())[:8]))
+
+        base = baseline(history, name, args.baseline_runs)
+        if base is None:
+            print("\tNo baseline yet")
+            continue
+        failures += [f"{name}: {f}" for f in check(result, base, corpus["thresholds"])]
+
+    passed = len(failures) == 0
+    if not args.no_record:
+        with open(args.history, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({
+                "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "revision": git_revision(),
+                "passed": passed,
+                "timed": TIMED,
+                "loader_cache": loader_cache_mode(config),
+                "sources": results
+            }, separators=(",", ":")))
+            f.write("\n")
+
+    for failure in failures:
+        print(f"Regression: {failure}", file=sys.stderr)
+    sys.exit(0 if passed else 1)
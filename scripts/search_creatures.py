@@ -0,0 +1,49 @@
+import argparse
+import json
+import sys
+import os
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from outputs.search_index import CreatureSearchIndex
+
+### Search the full-text creature index written with '--format index', e.g.
+###     python scripts/search_creatures.py creatures.index '"pack tactics"'
+###     python scripts/search_creatures.py creatures.index 'fright* undead'
+### Existing internal format files can be added to an index with --add.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search creature names, features, actions and spells")
+    parser.add_argument("index", type=str, help="Index file written with '--format index'")
+    parser.add_argument("query", type=str, nargs="?", default=None, help="Words, prefixes ending in * and quoted phrases. Every part has to match")
+    parser.add_argument("--limit", "-n", type=int, default=20, help="Maximum number of results")
+    parser.add_argument("--add", type=str, nargs="*", default=[], help="Internal format JSON files to add to the index first")
+    parser.add_argument("--json", action="store_true", default=False, help="Print results as JSON lines")
+    args = parser.parse_args()
+
+    if not args.add and not os.path.isfile(args.index):
+        parser.error(f"No index at {args.index}")
+
+    index = CreatureSearchIndex(args.index)
+
+    for f in args.add:
+        with open(f, 'r', encoding='utf-8') as fr:
+            data = json.load(fr)
+        for source_entry in data:
+            count = index.add(source_entry["title"], source_entry["creatures"])
+            print(f"Indexed {count} creatures from {source_entry['title']}", file=sys.stderr)
+
+    if args.query:
+        start = time.perf_counter()
+        results = index.search(args.query, limit=args.limit)
+        elapsed = time.perf_counter() - start
+
+        for r in results:
+            if args.json:
+                print(json.dumps({"score": round(r.score, 4), "source": r.source, "name": r.name, "fields": r.fields}))
+            else:
+                print(f"{r.score:7.3f}  {r.name:<32} {r.source:<32} {', '.join(r.fields)}")
+        print(f"{len(results)} results in {elapsed * 1000:.1f}ms", file=sys.stderr)
+
+    index.close()
@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import editdistance
+
+class BKTree(object):
+    '''Burkhard-Keller tree for finding every word within an edit distance of a query without comparing against
+    every word. Words keep their insertion order so ties can be broken the same way as a linear scan'''
+
+    def __init__(self, words: Iterable[str]=(), distance: Callable[[str, str], int]=editdistance.eval):
+        self.distance = distance
+        self.root = None
+        self.size = 0
+        for w in words:
+            self.add(w)
+
+    def add(self, word: str):
+        '''Insert a word. Nodes are [word, insertion order, {distance: child}]'''
+        node = [word, self.size, {}]
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+
+        current = self.root
+        while True:
+            d = self.distance(word, current[0])
+            if d == 0:
+                return
+            child = current[2].get(d)
+            if child is None:
+                current[2][d] = node
+                return
+            current = child
+
+    def query(self, word: str, max_distance: int) -> List[Tuple[int, int, str]]:
+        '''Returns (distance, insertion order, word) for every word within max_distance, closest first'''
+        if self.root is None:
+            return []
+
+        matches = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = self.distance(word, node[0])
+            if d <= max_distance:
+                matches.append((d, node[1], node[0]))
+            ### Triangle inequality: only children whose edge is within max_distance of d can hold matches
+            for edge, child in node[2].items():
+                if d - max_distance <= edge <= d + max_distance:
+                    stack.append(child)
+
+        matches.sort()
+        return matches
+
+    @staticmethod
+    def by_first_letter(words: Iterable[str]) -> Dict[str, BKTree]:
+        '''Build a separate tree for each first letter, for searches that only accept words starting the same way'''
+        grouped = {}
+        for w in words:
+            if len(w) > 0:
+                grouped.setdefault(w[0], []).append(w)
+        return {k: BKTree(v) for k, v in grouped.items()}
+
+    def __len__(self) -> int:
+        return self.size
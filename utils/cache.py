@@ -1,6 +1,7 @@
 from __future__ import annotations
 
-from typing import Optional, Any, Tuple
+from collections import OrderedDict
+from typing import Optional, Any, Dict, Tuple
 import os
 import json
 import logging
@@ -110,3 +111,68 @@ class CacheManager(object):
 
         
         
+
+
+class LRUCache(object):
+    '''Bounded least recently used cache that counts hits and misses. Entries can be exported and merged so
+    caches filled by worker processes can be shared'''
+
+    def __init__(self, max_size: int=4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Keys put since the counters were last reset, so a worker only sends back what it looked up itself
+        self.added = set()
+
+    def get(self, key: Any) -> Tuple[bool, Any]:
+        '''Returns (True, value) if the key is cached, otherwise (False, None)'''
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, self.entries[key]
+        self.misses += 1
+        return False, None
+
+    def put(self, key: Any, value: Any):
+        '''Store a value, evicting the least recently used entry if the cache is full'''
+        self.added.add(key)
+        self.__store(key, value)
+
+    def __store(self, key: Any, value: Any):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def reset_stats(self):
+        '''Zero the hit and miss counters and forget which entries were added, keeping the entries'''
+        self.hits = 0
+        self.misses = 0
+        self.added = set()
+
+    def snapshot(self, added_only: bool=False) -> Dict[str, Any]:
+        '''Export the entries and counters so they can be sent to (or back from) another process. With added_only
+        only the entries put since the counters were reset are exported'''
+        if added_only:
+            entries = [(k, self.entries[k]) for k in self.added if k in self.entries]
+        else:
+            entries = list(self.entries.items())
+        return {"entries": entries, "hits": self.hits, "misses": self.misses}
+
+    def merge(self, snapshot: Dict[str, Any], counters: bool=True):
+        '''Add the entries (and optionally the counters) from another cache's snapshot'''
+        for k, v in snapshot["entries"]:
+            if k not in self.entries:
+                self.__store(k, v)
+        if counters:
+            self.hits += snapshot["hits"]
+            self.misses += snapshot["misses"]
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total > 0 else 0
+        return f"{self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate), {len(self.entries)}/{self.max_size} entries"
@@ -40,6 +40,12 @@ def get_config(args : Dict[str, str]) -> configparser.ConfigParser:
         config.add_section("default")
     if not config.has_section("meta"):
         config.add_section("meta")
+    if not config.has_section("creature"):
+        config.add_section("creature")
+    if not config.has_section("filter"):
+        config.add_section("filter")
+    if not config.has_section("output"):
+        config.add_section("output")
 
     if args.cache:
         config.set("default", "cache", args.cache)
@@ -61,6 +67,29 @@ def get_config(args : Dict[str, str]) -> configparser.ConfigParser:
         config.set("meta", "authors", ", ".join(args.authors))
 
     config.set("default", "debug", 'true' if args.debug else 'false')
+
+    if args.validation:
+        config.set("creature", "validation", args.validation)
+
+    if args.prefilter_threshold is not None:
+        config.set("filter", "threshold", str(args.prefilter_threshold))
+
+    if args.storage:
+        config.set("output", "storage", args.storage)
+
+    if args.no_incremental:
+        config.set("output", "incremental", "false")
+
+    if args.prune:
+        config.set("output", "prune", "true")
+
+    if args.ndjson_target:
+        config.set("output", "ndjson-target", args.ndjson_target)
+
+    if args.workers is not None:
+        if not config.has_section("foundry"):
+            config.add_section("foundry")
+        config.set("foundry", "workers", str(args.workers))
     
     return config
 
@@ -78,7 +107,17 @@ def get_argparser() -> argparse.ArgumentParser:
     parser.add_argument("--pages", type=str, default=None, help="Comma separated list of pages to process. Load all if left blank")
 
     parser.add_argument("--output", "-o", type=str, help="Output file containing statblocks", default=None)
-    parser.add_argument("--format", '-f', type=str, help="Output format. Select 'none' to print statblocks to the terminal'", default='fvtt', choices=["none", "internal", 'text', 'fvtt'])
+    parser.add_argument("--format", '-f', type=str, help="Output format, or a comma separated list of formats to write in one run (e.g. 'fvtt,internal'). Select 'none' to print statblocks to the terminal'", default='fvtt')
+    parser.add_argument("--ndjson-target", type=str, default=None,
+        help="Where the ndjson format streams creatures, '-' for stdout (the default) or a path such as a named pipe")
+    parser.add_argument("--storage", type=str, default=None, choices=["json", "lines"],
+        help="How output files are stored. 'lines' appends one JSON document per creature so adding to a large file is cheap, use scripts/compact_output.py to produce the normal JSON file")
+    parser.add_argument("--workers", type=int, default=None,
+        help="Number of processes used to convert creatures for FVTT output. Defaults to 1 (convert in this process)")
+    parser.add_argument("--no-incremental", action='store_true', default=False,
+        help="Convert every creature again. By default creatures unchanged since the last run are reused from the existing output")
+    parser.add_argument("--prune", action='store_true', default=False,
+        help="Remove creatures of a source that are no longer found in it when the source is run again")
     
     parser.add_argument("--config", "-c", type=str, default="default.conf", help="Configuration file for controlling parser")
     parser.add_argument("--logs", "-l", type=str, default=None, help="Optional output log file")
@@ -88,6 +127,11 @@ def get_argparser() -> argparse.ArgumentParser:
     parser.add_argument("--no-cache", "-N", action='store_true', help="Don't use a cache to save the result (useful when debugging the data loader")
     parser.add_argument("--flush-cache", "-F", action="store_true", help="Dont check the local cache but do save the result.")
     
+    parser.add_argument("--validation", type=str, default=None, choices=["full", "sampled", "off"], 
+        help="Schema validation mode. 'full' checks every field as it is parsed, 'sampled' checks a sample of finished creatures, 'off' skips validation")
+    parser.add_argument("--prefilter-threshold", type=float, default=None, 
+        help="Minimum fraction of core annotations (type header, AC, HP, speed, ability scores) a candidate statblock needs before it is parsed. Set to 0 to parse every candidate")
+
     parser.add_argument("--yes", '-y', action='store_true', default=False, help="Auto accept defaults")
     parser.add_argument("--print", "-p", action='store_true', default=False, help='Print parsed statblocks to console')
     return parser
@@ -0,0 +1,122 @@
+from collections.abc import ItemsView, ValuesView
+from typing import Any, Iterator
+
+### Copy-on-write views over shared JSON-like data. Only the containers a caller actually reaches into are copied
+### (one level at a time), so patching a few fields of a large compendium entry never copies the untouched subtrees
+### and never modifies the shared original. The views are real dicts and lists so they serialise with json as normal.
+### Every method that hands out a nested value goes through __getitem__, including iteration, which also stops
+### dict(view), {**view} and update from taking the fast path that copies the raw entries.
+
+_MISSING = object()
+
+def copy_on_write(value: Any) -> Any:
+    '''Wrap dicts and lists in copy-on-write views, other values are returned unchanged'''
+    if type(value) is dict:
+        return CopyOnWriteDict(value)
+    if type(value) is list:
+        return CopyOnWriteList(value)
+    return value
+
+class CopyOnWriteDict(dict):
+    '''Shallow copy of a dict whose nested dicts and lists are copied the first time they are accessed'''
+
+    def __getitem__(self, key: Any) -> Any:
+        value = dict.__getitem__(self, key)
+        if type(value) is dict or type(value) is list:
+            value = copy_on_write(value)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key: Any, default: Any=None) -> Any:
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key: Any, default: Any=None) -> Any:
+        if key not in self:
+            dict.__setitem__(self, key, default)
+        return self[key]
+
+    def __iter__(self) -> Iterator[Any]:
+        return dict.__iter__(self)
+
+    def items(self) -> ItemsView:
+        return ItemsView(self)
+
+    def values(self) -> ValuesView:
+        return ValuesView(self)
+
+    def pop(self, key: Any, default: Any=_MISSING) -> Any:
+        if key not in self:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        value = self[key]
+        dict.__delitem__(self, key)
+        return value
+
+    def popitem(self) -> Any:
+        if len(self) == 0:
+            raise KeyError("popitem(): dictionary is empty")
+        key = next(reversed(dict.keys(self)))
+        return key, self.pop(key)
+
+    def copy(self) -> "CopyOnWriteDict":
+        return CopyOnWriteDict(self)
+
+    def __or__(self, other: Any) -> Any:
+        if not isinstance(other, dict):
+            return NotImplemented
+        new = self.copy()
+        new.update(other)
+        return new
+
+    def __ror__(self, other: Any) -> Any:
+        if not isinstance(other, dict):
+            return NotImplemented
+        new = CopyOnWriteDict(other)
+        new.update(self)
+        return new
+
+class CopyOnWriteList(list):
+    '''Shallow copy of a list whose nested dicts and lists are copied the first time they are accessed'''
+
+    def __getitem__(self, index: Any) -> Any:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        value = list.__getitem__(self, index)
+        if type(value) is dict or type(value) is list:
+            value = copy_on_write(value)
+            list.__setitem__(self, index, value)
+        return value
+
+    def __iter__(self) -> Iterator[Any]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __reversed__(self) -> Iterator[Any]:
+        for i in reversed(range(len(self))):
+            yield self[i]
+
+    def pop(self, index: int=-1) -> Any:
+        value = self[index]
+        list.__delitem__(self, index)
+        return value
+
+    def copy(self) -> "CopyOnWriteList":
+        return CopyOnWriteList(self)
+
+    def __add__(self, other: Any) -> Any:
+        if not isinstance(other, list):
+            return NotImplemented
+        return [*self, *other]
+
+    def __radd__(self, other: Any) -> Any:
+        if not isinstance(other, list):
+            return NotImplemented
+        return [*other, *self]
+
+    def __mul__(self, n: int) -> Any:
+        return list(self) * n
+
+    __rmul__ = __mul__
@@ -188,6 +188,27 @@ class Section:
         if self.page == -1 and len(self.lines) > 0:
             self.page = min([l.page for l in self.lines])
 
+        ### Running totals kept up to date as lines are added so callers don't need to rebuild the text
+        self.open_brackets = 0
+        self.close_brackets = 0
+        for l in self.lines:
+            self.__count_line(l, 1)
+
+        ### Joined text per join character, stored as [number of lines, text of the last line, text]
+        self.__text_cache = {}
+
+    def __count_line(self, line: Line, sign: int) -> None:
+        '''Add (or remove) a line's contribution to the running counters'''
+        self.open_brackets += sign * line.text.count("(")
+        self.close_brackets += sign * line.text.count(")")
+
+    @staticmethod
+    def __join_line(text: str, join_char: str) -> str:
+        '''Text a single line contributes to the section text'''
+        if len(text) > 0 and text[-1] == "-":
+            return text[:-1]
+        return text + join_char
+
     def is_empty(self) -> bool:
         '''Returns true if this section contains no lines'''
         return len(self.lines) == 0
@@ -201,6 +222,7 @@ class Section:
         self.lines.append(line)
         self.ids[line.id] = line
         self.bound = Bound.merge([self.bound, line.bound])
+        self.__count_line(line, 1)
 
         if sort:
             self.sort(sort_order)
@@ -228,6 +250,16 @@ class Section:
 
         self.lines = keep_lines
         self.bound = Bound.merge([l.bound for l in self.lines])
+        self.__count_line(line, -1)
+        self.__text_cache = {}
+
+    def append_to_last_line(self, text: str) -> None:
+        '''Add text to the end of the last line, keeping the bracket counters and joined text up to date'''
+        line = self.lines[-1]
+        self.__count_line(line, -1)
+        line.text += text
+        self.__count_line(line, 1)
+        self.__text_cache = {}
 
     def sort(self, sort_order: Section.SortOrder=None) -> None:
         '''Sort lines within section'''
@@ -236,8 +268,10 @@ class Section:
 
         if sort_order == Section.SortOrder.Vertical:
             self.lines.sort(key=lambda x: x.bound.top + 100*self.page)
+            self.__text_cache = {}
         elif sort_order == Section.SortOrder.Horizontal:
             self.lines.sort(key=lambda x: x.bound.left + 100*self.page)
+            self.__text_cache = {}
         elif sort_order == Section.SortOrder.NoSort:
             pass
 
@@ -255,14 +289,29 @@ class Section:
             attribs += l.attributes
         return attribs
 
+    def in_brackets(self) -> bool:
+        '''Returns true if the section text has more open brackets than closed ones'''
+        return self.open_brackets > self.close_brackets
+
     def get_section_text(self, join_char="\n") -> str:
-        '''Returns the total section text'''
-        text = ""
-        for i in range(len(self.lines)):
-            if len(self.lines[i].text) > 0 and self.lines[i].text[-1] == "-":
-                text += self.lines[i].text[:-1]
-            else:
-                text += self.lines[i].text + join_char
+        '''Returns the total section text. Only lines added since the last call are joined on'''
+        num_lines = len(self.lines)
+        cached = self.__text_cache.get(join_char)
+
+        ### Lines can be edited in place (e.g. the last line of a table), so check the last line we joined is unchanged
+        if cached is not None and 0 < cached[0] <= num_lines and self.lines[cached[0]-1].text == cached[1]:
+            if cached[0] == num_lines:
+                return cached[2]
+            start, parts = cached[0], [cached[2]]
+        else:
+            start, parts = 0, []
+
+        for i in range(start, num_lines):
+            parts.append(Section.__join_line(self.lines[i].text, join_char))
+        text = "".join(parts)
+
+        if num_lines > 0:
+            self.__text_cache[join_char] = [num_lines, self.lines[-1].text, text]
         return text
 
     def __contains__(self, line: Line) -> bool:
@@ -0,0 +1,231 @@
+import json
+import re
+import zlib
+
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+### Finds near-duplicate creatures, e.g. the same SRD monster reprinted with small edits in several books, without
+### comparing every pair. Each creature's normalised statblock text is split into word shingles and reduced to a
+### MinHash signature. Signatures are cut into bands and creatures sharing any band land in the same bucket, so only
+### creatures in a common bucket become candidates. Candidates are checked against the signature estimate and then
+### field by field, the same fields creature_diff compares, before being grouped into clusters.
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+### Keys and escape sequences in the JSON of a creature
+_KEY = re.compile(r'"[^"]*":|\\.')
+
+### Mersenne prime used by the MinHash permutations, shingle hashes are kept below it so products fit in 64 bits
+_PRIME = (1 << 31) - 1
+### Multiplier used to combine the word hashes of a shingle
+_SHINGLE_MULT = np.uint64(1000003)
+
+### Fields compared when verifying a candidate pair, matching scripts/creature_diff.py
+SCALAR_FIELDS = ["name", "size", "creature_type", "alignment", "ac", "hp", "speed", "abilities", "saves", "skills",
+                 "senses", "passive", "resistances", "damage_immunities", "condition_immunities", "vulnerabilities",
+                 "languages", "cr", "proficiency", "legendary_block", "lair_block", "description"]
+TITLED_FIELDS = ["features", "action", "bonus", "legendary", "mythic", "reaction", "lair", "spellcasting"]
+
+def statblock_tokens(creature: Any) -> List[str]:
+    '''Normalised words of every value in a creature, in a stable key order. Keys are left out as every creature
+    shares them, as is source and page information'''
+    if isinstance(creature, dict) and "source" in creature:
+        creature = {k: v for k, v in creature.items() if k != "source"}
+    text = _KEY.sub(" ", json.dumps(creature, sort_keys=True, ensure_ascii=False))
+    return _TOKEN.findall(text.lower())
+
+def field_similarity(c1: Any, c2: Any) -> Tuple[float, List[str]]:
+    '''Compare two creatures field by field. Identical fields score 1 and differing fields score the overlap of their
+    words. Returns the mean score and the names of the fields that differ'''
+    scores = []
+    differs = []
+
+    def compare(name: str, v1: Any, v2: Any):
+        if v1 == v2:
+            scores.append(1.0)
+            return
+        t1, t2 = set(statblock_tokens(v1)), set(statblock_tokens(v2))
+        scores.append(len(t1 & t2) / len(t1 | t2) if t1 or t2 else 0.0)
+        differs.append(name)
+
+    for f in SCALAR_FIELDS:
+        if f in c1 or f in c2:
+            compare(f, c1.get(f), c2.get(f))
+
+    for f in TITLED_FIELDS:
+        e1 = {e.get("title", ""): e for e in c1.get(f, [])}
+        e2 = {e.get("title", ""): e for e in c2.get(f, [])}
+        for title in list(e1.keys()) + [t for t in e2.keys() if t not in e1]:
+            compare(f"{f}: {title}", e1.get(title), e2.get(title))
+
+    if len(scores) == 0:
+        return 1.0, []
+    return sum(scores) / len(scores), differs
+
+@dataclass
+class CreatureRef:
+    # Position in the order creatures were added
+    index: int
+    source: str
+    name: str
+
+@dataclass
+class DuplicateMember:
+    creature: CreatureRef
+    # Field similarity to the canonical creature
+    similarity: float
+    differs: List[str] = field(default_factory=list)
+
+@dataclass
+class DuplicateCluster:
+    canonical: CreatureRef
+    duplicates: List[DuplicateMember]
+
+    def to_json(self) -> Any:
+        return {
+            "canonical": {"source": self.canonical.source, "name": self.canonical.name},
+            "duplicates": [
+                {"source": d.creature.source, "name": d.creature.name, "similarity": round(d.similarity, 4), "differs": d.differs}
+                for d in self.duplicates
+            ]
+        }
+
+class NearDuplicateFinder(object):
+    '''Collects creatures with add and groups near-duplicates with clusters. Signatures and buckets are built as
+    creatures are added so the whole run is close to linear in the number of creatures'''
+
+    def __init__(self, num_perm: int=128, bands: int=32, shingle_size: int=3, jaccard_threshold: float=0.5,
+            field_threshold: float=0.8, seed: int=1):
+        if num_perm % bands != 0:
+            raise ValueError(f"{num_perm} permutations can't be split into {bands} bands")
+
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.jaccard_threshold = jaccard_threshold
+        self.field_threshold = field_threshold
+
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, _PRIME, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, _PRIME, size=num_perm).astype(np.uint64)
+
+        self.creatures = []
+        self.refs = []
+        self.signatures = []
+        # (band, band hash) -> indexes of the creatures in the bucket
+        self.buckets = defaultdict(list)
+        self.stats = {"candidates": 0, "verified": 0}
+        self.word_hashes = {}
+
+    def __word_hash(self, word: str) -> int:
+        h = self.word_hashes.get(word)
+        if h is None:
+            h = self.word_hashes[word] = zlib.crc32(word.encode("utf8")) % _PRIME
+        return h
+
+    def shingles(self, creature: Any) -> np.ndarray:
+        '''Hashes of the overlapping word n-grams of a creature's statblock, combined from the hash of each word'''
+        words = np.array([self.__word_hash(t) for t in statblock_tokens(creature)] or [0], dtype=np.uint64)
+        n = min(self.shingle_size, len(words))
+        count = len(words) - n + 1
+        x = words[:count]
+        for k in range(1, n):
+            x = (x * _SHINGLE_MULT + words[k:k + count]) % _PRIME
+        return np.unique(x)
+
+    def signature(self, creature: Any) -> np.ndarray:
+        '''MinHash signature, the minimum of each permutation over the shingle hashes'''
+        x = self.shingles(creature)
+        return ((np.outer(x, self.a) + self.b) % _PRIME).min(axis=0)
+
+    def add(self, source: str, creature: Any) -> int:
+        '''Add a creature in the internal JSON format, returns its index'''
+        index = len(self.creatures)
+        sig = self.signature(creature)
+        self.creatures.append(creature)
+        self.refs.append(CreatureRef(index, source, creature["name"]))
+        self.signatures.append(sig)
+
+        data = sig.tobytes()
+        width = self.rows * sig.itemsize
+        for band in range(self.bands):
+            self.buckets[(band, data[band * width:(band + 1) * width])].append(index)
+        return index
+
+    def estimated_jaccard(self, i: int, j: int) -> float:
+        '''Fraction of equal signature values, an estimate of the shingle set similarity'''
+        return float(np.mean(self.signatures[i] == self.signatures[j]))
+
+    def is_duplicate(self, i: int, j: int) -> bool:
+        '''Verify a candidate pair, cheaply with the signatures first and then field by field'''
+        if self.estimated_jaccard(i, j) < self.jaccard_threshold:
+            return False
+        self.stats["verified"] += 1
+        similarity, _ = field_similarity(self.creatures[i], self.creatures[j])
+        return similarity >= self.field_threshold
+
+    def clusters(self, prefer: Optional[List[str]]=None) -> List[DuplicateCluster]:
+        '''Group the creatures added so far into clusters of near-duplicates. The canonical entry of each cluster is
+        from the earliest source in prefer, then the most complete, then the first added'''
+        parent = list(range(len(self.creatures)))
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        checked = set()
+        for members in self.buckets.values():
+            if len(members) < 2:
+                continue
+            for x, j in enumerate(members):
+                for i in members[:x]:
+                    ### Pairs already joined through other duplicates or checked in another band are skipped
+                    if find(i) == find(j) or (i, j) in checked:
+                        continue
+                    checked.add((i, j))
+                    self.stats["candidates"] += 1
+                    if self.is_duplicate(i, j):
+                        parent[find(j)] = find(i)
+
+        groups = defaultdict(list)
+        for i in range(len(self.creatures)):
+            groups[find(i)].append(i)
+
+        rank = {s: n for n, s in enumerate(prefer or [])}
+        clusters = []
+        pending = [m for m in groups.values() if len(m) > 1]
+        while pending:
+            members = pending.pop(0)
+            canonical = min(members, key=lambda i: (rank.get(self.refs[i].source, len(rank)), -self.__completeness(i), i))
+            duplicates = []
+            ### Joining pairs chains clusters together (A~B and B~C puts C with A), so every member is checked against
+            ### the canonical entry. Members too far from it are grouped again on their own
+            rest = []
+            for i in members:
+                if i == canonical:
+                    continue
+                similarity, differs = field_similarity(self.creatures[canonical], self.creatures[i])
+                if similarity >= self.field_threshold:
+                    duplicates.append(DuplicateMember(self.refs[i], similarity, differs))
+                else:
+                    rest.append(i)
+            if duplicates:
+                clusters.append(DuplicateCluster(self.refs[canonical], duplicates))
+            if len(rest) > 1:
+                pending.append(rest)
+
+        clusters.sort(key=lambda c: c.canonical.index)
+        return clusters
+
+    def __completeness(self, i: int) -> int:
+        creature = self.creatures[i]
+        return sum(1 for f in SCALAR_FIELDS if creature.get(f)) + sum(len(creature.get(f, [])) for f in TITLED_FIELDS)
+
+def duplicate_indexes(clusters: List[DuplicateCluster]) -> Dict[int, CreatureRef]:
+    '''Index of every non-canonical creature mapped to the canonical creature that replaces it'''
+    return {d.creature.index: c.canonical for c in clusters for d in c.duplicates}